@@ -37,6 +37,7 @@ setup(
     author='Jeff Croft',
     url='http://github.com/jcroft/django-spots',
     packages=packages,
+    package_data={'spots': ['media/spots/js/*.js']},
     install_requires = [
         'geopy >= 0.94.1',
     ],
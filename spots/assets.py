@@ -0,0 +1,70 @@
+import threading
+
+from django.conf import settings
+from django.core.signals import request_started
+
+
+_request_local = threading.local()
+
+
+
+
+def get_media_url():
+  """ Returns the URL the spots media directory is served from. """
+  return getattr(settings, 'SPOTS_MEDIA_URL', settings.MEDIA_URL + 'spots/')
+
+
+def _maps_loader():
+  return u'<script src="http://maps.google.com/maps?file=api&amp;v=2&amp;key=%s" type="text/javascript"></script>\n' % settings.GOOGLE_MAPS_API_KEY
+
+
+def _maps_widgets():
+  return u'<script src="%sjs/maps.js" type="text/javascript"></script>\n' % get_media_url()
+
+
+# Each asset, in the order they have to appear on the page.
+ASSETS = (
+  ('maps', _maps_loader),
+  ('widgets', _maps_widgets),
+)
+REQUIRES = {
+  'widgets': ('maps',),
+}
+
+
+
+
+def _get_emitted():
+  emitted = getattr(_request_local, 'emitted', None)
+  if emitted is None:
+    emitted = _request_local.emitted = set()
+  return emitted
+
+
+def reset_assets(**kwargs):
+  """
+  Forgets which assets have been emitted. Connected to request_started, so
+  each page starts afresh; call it yourself when rendering outside a request.
+  """
+  _request_local.emitted = set()
+
+
+def render_assets(*names):
+  """
+  Returns the HTML for the named assets, and anything they require, that
+  hasn't been emitted yet on the current page. Widgets and template tags call
+  this where they need an asset, so each is only included once per page.
+  """
+  needed = set(names)
+  for name in names:
+    needed.update(REQUIRES.get(name, ()))
+  emitted = _get_emitted()
+  output = []
+  for name, render in ASSETS:
+    if name in needed and name not in emitted:
+      emitted.add(name)
+      output.append(render())
+  return u"".join(output)
+
+
+request_started.connect(reset_assets)
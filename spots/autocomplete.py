@@ -0,0 +1,114 @@
+import threading
+import unicodedata
+from bisect import bisect_left, insort
+
+from spots.catalog import city_catalog
+
+
+
+
+def normalize_name(name):
+  """ Returns a name folded to lowercase ASCII, with its whitespace collapsed. """
+  if isinstance(name, unicode):
+    name = unicodedata.normalize('NFKD', name).encode('ascii', 'ignore')
+  return " ".join(name.lower().split())
+
+
+class CityIndex(object):
+  """
+  An in-memory prefix index over the names of every City. Each city is
+  indexed by full_name_ascii() and us_bias_name_ascii(), lowercased, in one
+  sorted list, so a prefix search is a bisect plus a short scan.
+
+  The index is built from the city catalog on first use. When the catalog
+  changes, the cities changed in place are re-indexed; if it was reloaded,
+  the index is rebuilt from it, still without touching the database.
+  """
+  def __init__(self):
+    self.lock = threading.RLock()
+    self.revision = None
+    self.keys = []
+    self.names = {}
+
+  def _keys_for(self, record):
+    return set([normalize_name(record.full_name_ascii), normalize_name(record.us_bias_name_ascii)])
+
+  def _add(self, record):
+    keys = self._keys_for(record)
+    self.names[record.id] = (record.full_name, keys)
+    for key in keys:
+      insort(self.keys, (key, record.id))
+
+  def _remove(self, city_id):
+    name, keys = self.names.pop(city_id, (None, ()))
+    for key in keys:
+      position = bisect_left(self.keys, (key, city_id))
+      if position < len(self.keys) and self.keys[position] == (key, city_id):
+        del self.keys[position]
+
+  def _ensure_current(self):
+    # Only copy the catalog's records when the index has to be rebuilt.
+    revision = city_catalog.get_revision()
+    if revision == self.revision:
+      return
+    changed = None
+    if self.revision is not None:
+      changed = city_catalog.changes_since(self.revision)
+    if changed is None:
+      records, revision = city_catalog.records()
+      self.keys = []
+      self.names = {}
+      for record in records:
+        keys = self._keys_for(record)
+        self.names[record.id] = (record.full_name, keys)
+        self.keys.extend([ (key, record.id) for key in keys ])
+      self.keys.sort()
+    else:
+      for city_id in changed:
+        self._remove(city_id)
+        record = city_catalog.by_id.get(city_id)
+        if record is not None:
+          self._add(record)
+    self.revision = revision
+
+  def search(self, prefix, limit=10):
+    """
+    Returns up to "limit" (id, full name) tuples for the cities with a name
+    starting with the given prefix, in alphabetical order.
+    """
+    prefix = normalize_name(prefix)
+    if not prefix:
+      return []
+    results = []
+    self.lock.acquire()
+    try:
+      self._ensure_current()
+      position = bisect_left(self.keys, (prefix,))
+      seen = set()
+      while position < len(self.keys) and len(results) < limit:
+        key, city_id = self.keys[position]
+        if not key.startswith(prefix):
+          break
+        if city_id not in seen:
+          seen.add(city_id)
+          results.append((city_id, self.names[city_id][0]))
+        position += 1
+    finally:
+      self.lock.release()
+    return results
+
+  def get_id(self, name):
+    """ Returns the id of the city with exactly the given name, or None. """
+    key = normalize_name(name)
+    self.lock.acquire()
+    try:
+      self._ensure_current()
+      position = bisect_left(self.keys, (key,))
+      if position < len(self.keys) and self.keys[position][0] == key:
+        return self.keys[position][1]
+      return None
+    finally:
+      self.lock.release()
+
+
+city_index = CityIndex()
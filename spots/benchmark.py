@@ -0,0 +1,336 @@
+import datetime
+import gc
+import random
+import resource
+import sys
+import threading
+import time
+from decimal import Decimal
+
+from django.contrib.auth.models import AnonymousUser
+from django.db import connection, transaction
+from django.forms.models import modelform_factory
+from django.http import HttpRequest, QueryDict
+from django.template.defaultfilters import slugify
+from django.utils.datastructures import MergeDict
+
+from spots.export import iterate_in_chunks
+from spots.instrumentation import get_query_count, percentile
+from spots.models import City, Neighborhood
+
+
+SCALES = {
+  '10k': 10000,
+  '100k': 100000,
+  '1m': 1000000,
+}
+SPOTS_PER_CITY = 100
+NEIGHBORHOODS_PER_CITY = 4
+INSERT_BATCH_SIZE = 5000
+PERCENTILES = (50, 90, 99)
+US_STATES = ('ks', 'mo', 'ne', 'ok', 'co', 'ia', 'il', 'tx', 'ca', 'ny', 'wa', 'or', 'fl', 'ga', 'mn')
+
+
+
+
+def _insert_rows(table, columns, rows):
+  """ Inserts rows of values for the given columns of a table, INSERT_BATCH_SIZE at a time. """
+  qn = connection.ops.quote_name
+  sql = "INSERT INTO %s (%s) VALUES (%s)" % (qn(table), ", ".join([ qn(column) for column in columns ]), ", ".join(["%s"] * len(columns)))
+  cursor = connection.cursor()
+  for start in range(0, len(rows), INSERT_BATCH_SIZE):
+    cursor.executemany(sql, rows[start:start + INSERT_BATCH_SIZE])
+  transaction.commit_unless_managed()
+
+
+def _filler_value(field, i):
+  """ Returns a value for a required spot field the benchmark doesn't know about. """
+  if field.has_default():
+    return field.get_default()
+  if field.null:
+    return None
+  if field.get_internal_type() in ('CharField', 'SlugField', 'TextField'):
+    return ("%s-%d" % (field.name, i))[:field.max_length or None]
+  if field.get_internal_type() in ('DateTimeField', 'DateField'):
+    return datetime.datetime.now()
+  if field.get_internal_type() in ('IntegerField', 'PositiveIntegerField', 'SmallIntegerField', 'PositiveSmallIntegerField', 'BooleanField'):
+    return 0
+  raise ValueError("Don't know how to fill in %s.%s." % (field.model.__name__, field.name))
+
+
+def generate_dataset(model, count, seed=0):
+  """
+  Fills the database with count synthetic spots of the given model, spread
+  around count / SPOTS_PER_CITY cities in the continental US, each with
+  NEIGHBORHOODS_PER_CITY neighborhoods. Every spot is in one neighborhood.
+  Rows go straight into the tables, so no signals are sent, and are made
+  INSERT_BATCH_SIZE at a time, so generating doesn't inflate the memory use
+  the benchmarks measure. Returns the number of cities.
+  """
+  rng = random.Random(seed)
+  city_count = max(10, count // SPOTS_PER_CITY)
+  cities = []
+  for i in range(city_count):
+    state = US_STATES[i % len(US_STATES)]
+    name = "Benchmark City %d" % i
+    latitude, longitude = rng.uniform(26, 48), rng.uniform(-123, -70)
+    cities.append((name, state.upper(), '', '', 'us', slugify("%s %s us" % (name, state)), Decimal("%.6f" % latitude), Decimal("%.6f" % longitude), ''))
+  _insert_rows(City._meta.db_table, ('city', 'state', 'county', 'province', 'country', 'slug', 'latitude', 'longitude', 'description'), cities)
+  city_rows = list(City.objects.filter(city__startswith="Benchmark City ").values_list('id', 'latitude', 'longitude'))
+
+  _insert_rows(Neighborhood._meta.db_table, ('city_id', 'name', 'slug'), [ (city_id, "Neighborhood %d" % n, "neighborhood-%d" % n) for city_id, latitude, longitude in city_rows for n in range(NEIGHBORHOODS_PER_CITY) ])
+  neighborhoods = {}
+  for id, city_id in Neighborhood.objects.filter(city__city__startswith="Benchmark City ").values_list('id', 'city'):
+    neighborhoods.setdefault(city_id, []).append(id)
+
+  fields = [ field for field in model._meta.local_fields if not field.primary_key ]
+  columns = [ field.column for field in fields ]
+  rows = []
+  for i in range(count):
+    city_id, latitude, longitude = city_rows[i % len(city_rows)]
+    values = {
+      'address': "%d Benchmark St" % i,
+      'city': city_id,
+      'latitude': Decimal("%.6f" % (float(latitude) + rng.gauss(0, 0.1))),
+      'longitude': Decimal("%.6f" % (float(longitude) + rng.gauss(0, 0.1))),
+      'neighborhoods_checked': True,
+    }
+    row = []
+    for field in fields:
+      if field.name in values:
+        row.append(values[field.name])
+      else:
+        row.append(_filler_value(field, i))
+    rows.append(tuple(row))
+    if len(rows) >= INSERT_BATCH_SIZE:
+      _insert_rows(model._meta.db_table, columns, rows)
+      rows = []
+  _insert_rows(model._meta.db_table, columns, rows)
+
+  m2m = model._meta.get_field('neighborhoods')
+  m2m_columns = (m2m.m2m_column_name(), m2m.m2m_reverse_name())
+  links = []
+  for spot in iterate_in_chunks(model._default_manager.all(), ('city',), INSERT_BATCH_SIZE):
+    links.append((spot['id'], rng.choice(neighborhoods[spot['city']])))
+    if len(links) >= INSERT_BATCH_SIZE:
+      _insert_rows(m2m.m2m_db_table(), m2m_columns, links)
+      links = []
+  _insert_rows(m2m.m2m_db_table(), m2m_columns, links)
+  return city_count
+
+
+
+
+class StubGeocoder(object):
+  """
+  Stands in for Google and Urban Mapping while the benchmark runs, so form
+  saves are timed without the network or the geocoder's sleeps. Addresses
+  geocode to a random benchmark city.
+  """
+  def __init__(self, seed=0):
+    self.rng = random.Random(seed)
+    self.cities = list(City.objects.filter(city__startswith="Benchmark City ")[:100])
+    self.patched = []
+
+  def location_from_address(self, address):
+    city = self.rng.choice(self.cities)
+    return (address, (city.latitude, city.longitude))
+
+  def city(self, *args):
+    return self.rng.choice(self.cities)
+
+  def address(self, *args):
+    return "1 Benchmark St"
+
+  def neighborhoods(self, method=''):
+    import xml.etree.ElementTree as ET
+    return lambda **params: ET.Element('neighborhoods')
+
+  def _patch(self, module, name, value):
+    self.patched.append((module, name, hasattr(module, name), getattr(module, name, None)))
+    setattr(module, name, value)
+
+  def install(self):
+    from spots import forms, models
+    for module in (forms, models):
+      self._patch(module, 'get_location_from_address', self.location_from_address)
+      self._patch(module, 'get_city_from_address', self.city)
+      self._patch(module, 'get_city_from_point', self.city)
+      self._patch(module, 'get_address_from_location', self.address)
+      self._patch(module, 'get_address_from_point', self.address)
+    self._patch(models, 'UrbanMappingClient', self.neighborhoods)
+    self._patch(time, 'sleep', lambda seconds: None)
+
+  def uninstall(self):
+    while self.patched:
+      module, name, existed, value = self.patched.pop()
+      if existed:
+        setattr(module, name, value)
+      else:
+        delattr(module, name)
+
+
+class LocalCache(object):
+  """
+  Swaps the cache for a new local-memory one while the benchmark runs, so
+  the generations it bumps and the pages it caches stay out of the site's
+  shared cache.
+  """
+  def __init__(self):
+    from django.core.cache import get_cache
+    self.cache = get_cache('locmem://')
+    self.patched = []
+
+  def install(self):
+    import django.core.cache
+    shared = django.core.cache.cache
+    for name, module in sys.modules.items():
+      if module is None or not (name == 'django.core.cache' or name.split('.')[0] == 'spots'):
+        continue
+      if getattr(module, 'cache', None) is shared:
+        self.patched.append((module, shared))
+        module.cache = self.cache
+
+  def uninstall(self):
+    while self.patched:
+      module, value = self.patched.pop()
+      module.cache = value
+
+
+
+
+def get_resident_memory():
+  """
+  Returns the resident memory of this process right now, in kilobytes, or
+  None where /proc isn't available.
+  """
+  try:
+    statm = open('/proc/self/statm')
+    try:
+      pages = int(statm.read().split()[1])
+    finally:
+      statm.close()
+  except (IOError, OSError, ValueError, IndexError):
+    return None
+  return pages * resource.getpagesize() // 1024
+
+
+def get_peak_memory():
+  """ Returns the peak resident memory of this process so far, in kilobytes. """
+  peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  if peak > 1 << 30:
+    # Mac OS X reports bytes rather than kilobytes.
+    peak = peak // 1024
+  return peak
+
+
+class MemorySampler(threading.Thread):
+  """
+  Reads the resident memory every "interval" seconds until stopped, keeping
+  the highest reading, so the peak while an operation runs can be measured
+  however high the process's peak was before it.
+  """
+  def __init__(self, interval=0.001):
+    threading.Thread.__init__(self)
+    self.setDaemon(True)
+    self.interval = interval
+    self.peak = get_resident_memory()
+    self.stopped = threading.Event()
+
+  def run(self):
+    while not self.stopped.isSet():
+      self.peak = max(self.peak, get_resident_memory())
+      self.stopped.wait(self.interval)
+
+  def stop(self):
+    """ Stops sampling and returns the peak, in kilobytes. """
+    self.stopped.set()
+    self.join()
+    self.peak = max(self.peak, get_resident_memory())
+    return self.peak
+
+
+def get_request(**query):
+  """ Returns an anonymous GET request for benchmarking views. """
+  request = HttpRequest()
+  request.method = 'GET'
+  request.path = '/'
+  request.GET = QueryDict('', mutable=True)
+  request.GET.update(query)
+  request.REQUEST = MergeDict(request.POST, request.GET)
+  request.user = AnonymousUser()
+  return request
+
+
+def time_operation(operation, arguments):
+  """
+  Calls operation once for each item in arguments and returns a dict with
+  the latency percentiles (in milliseconds), the mean number of queries per
+  call and the peak memory used while the calls ran (in kilobytes, above
+  what was resident before them). Where the resident memory can't be read,
+  the growth in the process's peak is reported instead.
+  """
+  timings, queries = [], []
+  gc.collect()
+  resident = get_resident_memory()
+  if resident is None:
+    sampler, peak = None, get_peak_memory()
+  else:
+    sampler = MemorySampler()
+    sampler.start()
+  try:
+    for argument in arguments:
+      count = get_query_count()
+      started = time.time()
+      result = operation(argument)
+      if hasattr(result, '__iter__') and not isinstance(result, dict):
+        list(result)
+      timings.append((time.time() - started) * 1000)
+      queries.append(get_query_count() - count)
+  finally:
+    if sampler is not None:
+      peak = sampler.stop()
+  if sampler is not None:
+    memory = peak - resident
+  else:
+    memory = get_peak_memory() - peak
+  timings.sort()
+  stats = dict([ ('p%d' % percent, percentile(timings, percent)) for percent in PERCENTILES ])
+  stats.update({
+    'calls': len(timings),
+    'max': timings and timings[-1],
+    'queries': queries and float(sum(queries)) / len(queries),
+    'memory': memory,
+  })
+  return stats
+
+
+def get_operations(model):
+  """
+  Returns a list of (name, operation) for every benchmark. Each operation is
+  called with one of the sample spots.
+  """
+  from spots import views
+  from spots.forms import SpotForm
+  manager = model._default_manager
+  form_class = modelform_factory(model, form=SpotForm, fields=('address',))
+  counter = [0]
+
+  def save_form(spot):
+    counter[0] += 1
+    form = form_class({'address': "%d Benchmark Ave" % counter[0]})
+    if form.is_valid():
+      return form.save()
+    raise ValueError(form.errors)
+
+  return [
+    ('within_radius_of_location', lambda spot: manager.within_radius_of_location(spot.location(), radius_miles=5)),
+    ('nearby_spots', lambda spot: spot.nearby_spots()),
+    ('nearby_spots (no neighbour table)', lambda spot: spot.nearby_spots(num=None)),
+    ('closest_spots', lambda spot: manager.closest_spots(spot)),
+    ('City.nearby_cities', lambda spot: spot.city.nearby_cities(num=10)),
+    ('spot_list', lambda spot: views.spot_list(get_request(order_by='-id'), queryset=manager.all(), paginate_by=50)),
+    ('spot_list relevant_to_spot', lambda spot: views.spot_list(get_request(order_by='distance'), queryset=manager.filter(city=spot.city_id), relevant_to_spot=spot, paginate_by=50)),
+    ('spot_list_for_country', lambda spot: views.spot_list_for_country(get_request(), 'us', queryset=manager.all())),
+    ('SpotForm save', save_form),
+  ]
@@ -0,0 +1,235 @@
+import time
+from hashlib import md5
+from urllib import urlencode
+
+from django.conf import settings
+from django.core.cache import cache
+from django.template.defaultfilters import slugify
+from django.utils.functional import wraps
+from django.views.decorators.http import condition
+
+from spots.instrumentation import record_cache_lookup
+
+
+CACHE_PREFIX = getattr(settings, 'SPOTS_CACHE_PREFIX', 'spots')
+CACHE_TIMEOUT = getattr(settings, 'SPOTS_CACHE_TIMEOUT', 60 * 10)
+GENERATION_TIMEOUT = 60 * 60 * 24 * 30
+
+
+
+
+def get_scope_name(prefix, *bits):
+  """
+  Returns the name of a geographic scope, like "city-us-ks-lawrence". This is
+  the same format build_breadcrumbs uses for view_name. Empty bits are skipped,
+  so a city without a state or province gives "city-au-sydney".
+  """
+  return "-".join([prefix] + [slugify(bit) for bit in bits if bit])
+
+
+def get_state_for_city(city):
+  """ Returns the state (if USA) or province (otherwise) of a city. """
+  if city.country == "us":
+    return city.state
+  return city.province
+
+
+def get_scopes_for_city(city):
+  """
+  Returns the names of all the scopes whose pages list spots in the given city:
+  all spots, the country, the state (or province) and the city itself.
+  """
+  state = get_state_for_city(city)
+  scopes = ['spots', get_scope_name('country', city.country)]
+  if state:
+    scopes.append(get_scope_name('state', city.country, state))
+  else:
+    # Cities without a state or province are served by the state view, too.
+    scopes.append(get_scope_name('state', city.country, city.city))
+  scopes.append(get_scope_name('city', city.country, state, city.city))
+  return scopes
+
+
+def get_scope_for_neighborhood(neighborhood, city=None):
+  """ Returns the name of the scope for a neighborhood's spot list. """
+  city = city or neighborhood.city
+  return get_scope_name('neighborhood', city.country, get_state_for_city(city), city.city, neighborhood.slug)
+
+
+def get_scope_for_spot(spot, city=None):
+  """ Returns the name of the scope for a spot's detail page. """
+  city = city or spot.city
+  return get_scope_name('spot', city.country, get_state_for_city(city), city.city, getattr(spot, 'slug', spot.pk))
+
+
+
+
+def _generation_key(scope):
+  return "%s:generation:%s" % (CACHE_PREFIX, scope)
+
+
+def _new_generation():
+  # Generations start at the current time, so a generation that was evicted
+  # from the cache is never reused for stale entries.
+  return int(time.time() * 1000)
+
+
+def get_scope_generation(scope):
+  """
+  Returns the current generation of a scope. Every cache key for the scope
+  includes it, so bumping the generation invalidates them all at once.
+  Returns None if the cache doesn't keep it, like the dummy backend; nothing
+  for the scope can be cached then, as it could never be invalidated.
+  """
+  key = _generation_key(scope)
+  generation = cache.get(key)
+  if generation is None:
+    cache.add(key, _new_generation(), GENERATION_TIMEOUT)
+    generation = cache.get(key)
+  return generation
+
+
+def bump_scope_generation(scope):
+  """ Bumps the generation of a scope and returns the new one. """
+  key = _generation_key(scope)
+  try:
+    return cache.incr(key)
+  except ValueError:
+    generation = _new_generation()
+    cache.set(key, generation, GENERATION_TIMEOUT)
+    return generation
+
+
+def invalidate_scopes(scopes):
+  """ Bumps the generation of each of the given scopes. """
+  for scope in set(scopes):
+    bump_scope_generation(scope)
+
+
+def get_normalized_query(request):
+  """ Returns the GET parameters of a request as a sorted, URL-encoded string. """
+  items = []
+  for key, values in sorted(request.GET.lists()):
+    for value in sorted(values):
+      items.append((key.encode('utf-8'), value.encode('utf-8')))
+  return urlencode(items)
+
+
+def get_cache_key(scope, name, query=''):
+  """
+  Returns a cache key for something named "name" in the current generation of
+  the given scope, optionally varying on a normalized query string. Returns
+  None if the scope has no generation, in which case don't cache.
+  """
+  generation = get_scope_generation(scope)
+  if generation is None:
+    return None
+  return "%s:%s:%s:%s:%s" % (CACHE_PREFIX, name, scope, generation, md5(query).hexdigest())
+
+
+def _is_cacheable(request, kwargs):
+  if request.method != 'GET':
+    return False
+  if hasattr(request, 'user') and request.user.is_authenticated():
+    return False
+  # Views calling other views pass their own queryset and context. Those
+  # responses belong to the caller's scope, not the callee's.
+  if 'queryset' in kwargs or 'extra_context' in kwargs:
+    return False
+  return True
+
+
+def cache_spots_view(prefix, *url_bits):
+  """
+  Decorator that caches the full response of a spots list view for anonymous
+  GET requests. The scope is built from the prefix and the named URL arguments,
+  so @cache_spots_view('city', 'country', 'state', 'city') caches city_detail
+  under "city-us-ks-lawrence".
+  """
+  def decorator(view):
+    def _wrapped(request, *args, **kwargs):
+      if not _is_cacheable(request, kwargs):
+        return view(request, *args, **kwargs)
+      scope = get_scope_name(prefix, *[kwargs.get(bit) for bit in url_bits])
+      key = get_cache_key(scope, 'response', get_normalized_query(request))
+      if key is None:
+        return view(request, *args, **kwargs)
+      response = cache.get(key)
+      record_cache_lookup('cache.view', response is not None)
+      if response is None:
+        response = view(request, *args, **kwargs)
+        if response.status_code == 200:
+          cache.set(key, response, CACHE_TIMEOUT)
+      return response
+    return wraps(view)(_wrapped)
+  return decorator
+
+
+def spots_etag(prefix, *url_bits):
+  """
+  Decorator adding conditional GET support to a spots view. The ETag is built
+  from the generation of the view's scope and the normalized query string, so
+  it changes exactly when the cached response would be invalidated, and a
+  matching If-None-Match gets a 304 without the view running. Without a
+  generation, there's no ETag, as it would never change.
+  """
+  def etag_func(request, *args, **kwargs):
+    if not _is_cacheable(request, kwargs):
+      return None
+    scope = get_scope_name(prefix, *[kwargs.get(bit) for bit in url_bits])
+    generation = get_scope_generation(scope)
+    if generation is None:
+      return None
+    return md5("%s:%s:%s" % (scope, generation, get_normalized_query(request))).hexdigest()
+  return condition(etag_func=etag_func)
+
+
+
+
+def city_changed(sender, instance, **kwargs):
+  """ Signal handler invalidating the scopes of a saved or deleted City. """
+  invalidate_scopes(get_scopes_for_city(instance))
+
+
+def neighborhood_changed(sender, instance, **kwargs):
+  """ Signal handler invalidating the scopes of a saved or deleted Neighborhood. """
+  invalidate_scopes(get_scopes_for_city(instance.city) + [get_scope_for_neighborhood(instance)])
+
+
+def spot_changed(sender, instance, **kwargs):
+  """
+  Signal handler invalidating the scopes of a saved or deleted spot: its city
+  and everything above it, its neighborhoods, and its own detail page.
+  """
+  scopes = []
+  for city in getattr(instance, '_cache_cities', [instance.city]):
+    if city is None:
+      continue
+    scopes += get_scopes_for_city(city)
+    scopes.append(get_scope_for_spot(instance, city))
+    if instance.pk:
+      scopes += [ get_scope_for_neighborhood(neighborhood, city) for neighborhood in instance.neighborhoods.all() ]
+  invalidate_scopes(scopes)
+
+
+def spot_pre_save(sender, instance, **kwargs):
+  """
+  Signal handler remembering the city and location a spot is moving away
+  from, so both the old and the new ones are invalidated once it is saved.
+  A spot that didn't move has no locations to invalidate. The old values
+  come from the spot's change tracking, so nothing is fetched to compare.
+  """
+  cities = [instance.city]
+  locations = [instance.location()]
+  if instance.pk:
+    changed = instance.get_changed_fields()
+    if 'city' in changed:
+      old_city = instance.get_original_city()
+      if old_city is not None:
+        cities.append(old_city)
+    if 'latitude' in changed or 'longitude' in changed:
+      locations.append(instance.get_original_location())
+    else:
+      locations = []
+  instance._cache_cities = cities
+  instance._cache_locations = locations
@@ -0,0 +1,283 @@
+import threading
+import time
+
+from django.conf import settings
+from django.core.signals import request_started
+from django.core.urlresolvers import reverse
+from django.template.defaultfilters import slugify
+
+from spots.cache import bump_scope_generation, get_scope_generation
+
+
+SCOPE = 'cities'
+CHECK_INTERVAL = getattr(settings, 'SPOTS_CATALOG_CHECK_INTERVAL', 5)
+CHANGE_LOG_SIZE = 100
+CITY_FIELDS = ('id', 'city', 'state', 'county', 'province', 'country', 'slug', 'latitude', 'longitude', 'description')
+
+_request_local = threading.local()
+
+
+
+
+class CityRecord(object):
+  """
+  A compact, read-only copy of a City row. URLs for the city, its state and
+  its neighborhoods and spots are worked out the first time they're asked for
+  and then kept; saving the city replaces its record, so they're rebuilt when
+  its slug changes. to_city() makes a City instance from the record without
+  a query.
+  """
+  __slots__ = CITY_FIELDS + ('full_name', 'full_name_ascii', 'us_bias_name_ascii', '_url', '_state_url', '_neighborhood_urls', '_spot_urls')
+
+  def __init__(self, city):
+    for field in CITY_FIELDS:
+      setattr(self, field, getattr(city, field))
+    self.full_name = city.full_name()
+    self.full_name_ascii = city.full_name_ascii()
+    self.us_bias_name_ascii = city.us_bias_name_ascii()
+    self._url = None
+    self._state_url = None
+    self._neighborhood_urls = {}
+    self._spot_urls = {}
+
+  def region(self):
+    """ Returns the (country, state or province slug) this city is listed under. """
+    if self.country == "us":
+      return (self.country, slugify(self.state))
+    return (self.country, slugify(self.province))
+
+  def to_city(self):
+    from spots.models import City
+    return City(**dict((field, getattr(self, field)) for field in CITY_FIELDS))
+
+  def url(self):
+    if self._url is None:
+      self._url = self.to_city()._get_absolute_url()
+    return self._url
+
+  def state_url(self):
+    if self._state_url is None:
+      self._state_url = self.to_city()._get_state_url()
+    return self._state_url
+
+  def neighborhood_url(self, slug):
+    """ Returns the URL to the neighborhood with the given slug in this city, or None if it hasn't got one. """
+    if slug not in self._neighborhood_urls:
+      url = None
+      if self.country == "us" or self.province:
+        country, state = self.region()
+        url = reverse('spot_list_for_neighborhood', kwargs={'country': slugify(country), 'state': state, 'city': slugify(self.city), 'slug': slug})
+      self._neighborhood_urls[slug] = url
+    return self._neighborhood_urls[slug]
+
+  def spot_url(self, slug):
+    """ Returns the URL to the spot with the given slug in this city, or None if it hasn't got one. """
+    if slug not in self._spot_urls:
+      url = None
+      if self.country == "us" or self.province:
+        country, state = self.region()
+        url = reverse('spot_detail', kwargs={'country': slugify(country), 'state': state, 'city': slugify(self.city), 'slug': slug})
+      self._spot_urls[slug] = url
+    return self._spot_urls[slug]
+
+
+
+
+class CityCatalog(object):
+  """
+  A process-local catalog of every City, indexed by id, slug, full name and
+  (country, state or province slug). It's loaded on first use.
+
+  Every change to a City bumps the "cities" generation in the shared cache.
+  Changes made in this process are applied to the catalog in place; if the
+  generation moves on for any other reason, another process changed a city,
+  and the catalog catches up by reloading just the cities in the change feed
+  (see spots.changes) since it last looked. The generation is checked once
+  per request, and at most every CHECK_INTERVAL seconds outside of requests.
+  If the cache doesn't keep it, the change feed is checked instead. Loads
+  and catch-ups always read from the primary, never a replica, so no change
+  the cursor moves past is missed.
+
+  Each city changed in place, and each reload, moves the catalog's revision
+  on. Other
+  in-memory structures built from the catalog use it, with changes_since(),
+  to catch up without rebuilding.
+  """
+  def __init__(self):
+    self.lock = threading.RLock()
+    self.generation = None
+    self.cursor = None
+    self.revision = 0
+    self.loaded_revision = 0
+    self.change_log = []
+    self.by_id = {}
+    self.by_slug = {}
+    self.by_name = {}
+    self.by_region = {}
+
+  def _add(self, record):
+    self.by_id[record.id] = record
+    self.by_slug[record.slug] = record
+    self.by_name[record.full_name.lower()] = record
+    self.by_region.setdefault(record.region(), []).append(record)
+
+  def _remove(self, city_id):
+    record = self.by_id.pop(city_id, None)
+    if record is None:
+      return
+    self.by_slug.pop(record.slug, None)
+    self.by_name.pop(record.full_name.lower(), None)
+    region = self.by_region.get(record.region(), [])
+    if record in region:
+      region.remove(record)
+
+  def _load(self):
+    from spots.changes import get_latest_cursor
+    from spots.models import City
+    from spots.routers import using_primary
+    # Take the cursor first, so cities changed during the load are caught up on.
+    cursor = get_latest_cursor()
+    self.by_id, self.by_slug, self.by_name, self.by_region = {}, {}, {}, {}
+    for city in using_primary(City.objects.all()):
+      self._add(CityRecord(city))
+    # Changes that hadn't settled when the cursor was taken may not have
+    # been loaded, so the next check catches up.
+    self.generation = None
+    self.cursor = cursor
+    self.revision += 1
+    self.loaded_revision = self.revision
+    self.change_log = []
+
+  def _catch_up(self, generation):
+    from spots.changes import get_changed_objects_since
+    from spots.models import City
+    from spots.routers import using_primary
+    from spots.rows import get_in_bulk
+    changed, cursor, settled = get_changed_objects_since(self.cursor, [City])
+    city_ids = [ city_id for model, city_id in changed ]
+    cities = get_in_bulk(using_primary(City.objects.all()), city_ids)
+    for city_id in city_ids:
+      self._remove(city_id)
+      if city_id in cities:
+        self._add(CityRecord(cities[city_id]))
+      self.revision += 1
+      self.change_log.append((self.revision, city_id))
+    self.change_log = self.change_log[-CHANGE_LOG_SIZE:]
+    # Until every change has settled, the generation is forgotten, so the
+    # next check catches up again.
+    self.generation = settled and generation or None
+    self.cursor = cursor
+
+  def _ensure_current(self):
+    now = time.time()
+    checked_at = getattr(_request_local, 'checked_at', None)
+    if self.cursor is not None and checked_at is not None and now - checked_at < CHECK_INTERVAL:
+      return
+    generation = get_scope_generation(SCOPE)
+    self.lock.acquire()
+    try:
+      if self.cursor is None:
+        self._load()
+      elif generation is None or generation != self.generation:
+        self._catch_up(generation)
+    finally:
+      self.lock.release()
+    _request_local.checked_at = now
+
+  def clear(self):
+    """
+    Empties the catalog, so it's loaded again on next use. Call it after
+    changing cities without sending signals, like with raw SQL.
+    """
+    self.lock.acquire()
+    try:
+      self.by_id, self.by_slug, self.by_name, self.by_region = {}, {}, {}, {}
+      self.generation = None
+      self.cursor = None
+    finally:
+      self.lock.release()
+
+  def get(self, id):
+    """ Returns the CityRecord with the given id, or None. """
+    self._ensure_current()
+    try:
+      return self.by_id.get(int(id))
+    except (TypeError, ValueError):
+      return None
+
+  def get_by_slug(self, slug):
+    """ Returns the CityRecord with the given slug, or None. """
+    self._ensure_current()
+    return self.by_slug.get(slug)
+
+  def get_by_full_name(self, name):
+    """ Returns the CityRecord whose full_name() is the given string, ignoring case, or None. """
+    self._ensure_current()
+    return self.by_name.get(u" ".join(name.split()).lower())
+
+  def get_for_region(self, country, state):
+    """ Returns the CityRecords in a country and state (or province), given as a slug. """
+    self._ensure_current()
+    return list(self.by_region.get((country, slugify(state)), []))
+
+  def get_revision(self):
+    """ Returns the catalog's current revision. """
+    self._ensure_current()
+    return self.revision
+
+  def records(self):
+    """ Returns all the CityRecords, and the revision they're from. """
+    self._ensure_current()
+    self.lock.acquire()
+    try:
+      return self.by_id.values(), self.revision
+    finally:
+      self.lock.release()
+
+  def changes_since(self, revision):
+    """
+    Returns the ids of the cities changed in place since the given revision,
+    or None if the catalog has been reloaded since then (or the changes are
+    too old to remember), in which case everything should be rebuilt.
+    """
+    self.lock.acquire()
+    try:
+      if revision < self.loaded_revision or revision < self.revision - len(self.change_log):
+        return None
+      return [ city_id for change_revision, city_id in self.change_log if change_revision > revision ]
+    finally:
+      self.lock.release()
+
+  def _city_changed(self, instance, deleted):
+    self.lock.acquire()
+    try:
+      generation = bump_scope_generation(SCOPE)
+      if self.generation is None or generation != self.generation + 1:
+        # Someone else changed a city too; catch up on next use.
+        _request_local.checked_at = None
+        return
+      self._remove(instance.id)
+      if not deleted:
+        self._add(CityRecord(instance))
+      self.generation = generation
+      self.revision += 1
+      self.change_log = (self.change_log + [(self.revision, instance.id)])[-CHANGE_LOG_SIZE:]
+    finally:
+      self.lock.release()
+
+  def city_saved(self, sender, instance, **kwargs):
+    """ Signal handler updating the catalog for a saved City. """
+    self._city_changed(instance, deleted=False)
+
+  def city_deleted(self, sender, instance, **kwargs):
+    """ Signal handler dropping a deleted City from the catalog. """
+    self._city_changed(instance, deleted=True)
+
+
+def reset_checked(**kwargs):
+  """ Signal handler making the catalog check its generation at the start of each request. """
+  _request_local.checked_at = None
+
+
+city_catalog = CityCatalog()
+request_started.connect(reset_checked)
@@ -0,0 +1,163 @@
+import datetime
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+SETTLE_SECONDS = getattr(settings, 'SPOTS_CHANGE_SETTLE_SECONDS', 10)
+
+
+
+
+def record_change(instance, action):
+  """
+  Records that an object was saved or deleted. The object's previous change
+  is dropped, so each object has one row, and the new row's id is the
+  object's modification sequence number. The old row is dropped and the new
+  one made in one transaction, so the object is never left without one.
+  """
+  from spots.models import SpotChange
+  content_type = ContentType.objects.get_for_model(instance)
+  def replace():
+    SpotChange.objects.filter(content_type=content_type, object_id=instance.pk).delete()
+    return SpotChange.objects.create(content_type=content_type, object_id=instance.pk, action=action)
+  return transaction.commit_on_success(replace)()
+
+
+def object_saved(sender, instance, **kwargs):
+  """ Signal handler recording a saved spot, city or neighborhood. """
+  record_change(instance, 'saved')
+
+
+def object_deleted(sender, instance, **kwargs):
+  """ Signal handler recording a deleted spot, city or neighborhood as a tombstone. """
+  record_change(instance, 'deleted')
+
+
+
+
+def get_settled_time():
+  """
+  Returns the time changes have to have been made by to be settled. Change
+  ids come from an autoincrement column, so a transaction can take an id and
+  commit after another that took a later one; a cursor moved past the later
+  one would skip the earlier for good. Cursors are only moved past changes
+  SETTLE_SECONDS old, by when anything that took an earlier id has committed.
+  """
+  return datetime.datetime.now() - datetime.timedelta(seconds=SETTLE_SECONDS)
+
+
+def get_changes_since(cursor=0, limit=DEFAULT_LIMIT, models=None):
+  """
+  Returns (changes, cursor, more): the SpotChanges after the given cursor,
+  oldest first, at most limit of them; the cursor to ask for the next page
+  with; and whether there are more. Pass models to only see changes to
+  those models. Start from a cursor of 0 to see every object once. Changes
+  are only listed once they've settled (see get_settled_time), so the feed
+  runs SETTLE_SECONDS behind.
+  """
+  from spots.models import SpotChange
+  settled = get_settled_time()
+  changes = SpotChange.objects.filter(id__gt=cursor).select_related('content_type')
+  if models is not None:
+    changes = changes.filter(content_type__in=[ ContentType.objects.get_for_model(model) for model in models ])
+  changes = list(changes.order_by('id')[:limit + 1])
+  more = len(changes) > limit
+  changes = changes[:limit]
+  for index, change in enumerate(changes):
+    if change.changed > settled:
+      changes, more = changes[:index], False
+      break
+  if changes:
+    cursor = changes[-1].id
+  return changes, cursor, more
+
+
+def get_latest_cursor():
+  """
+  Returns the cursor of the latest settled change, to follow changes from
+  now on. It's read from the primary, as the in-memory indexes rely on it.
+  """
+  from spots.models import SpotChange
+  from spots.routers import using_primary
+  unsettled = list(using_primary(SpotChange.objects.filter(changed__gt=get_settled_time()).order_by('id')).values_list('id', flat=True)[:1])
+  if unsettled:
+    return unsettled[0] - 1
+  latest = list(using_primary(SpotChange.objects.order_by('-id')).values_list('id', flat=True)[:1])
+  return latest and latest[0] or 0
+
+
+def get_changed_objects_since(cursor, models):
+  """
+  Returns (changed, cursor, settled): a (model, id) tuple for every object of
+  the given models saved or deleted after the cursor, oldest change first;
+  the cursor to carry on from; and whether every change had settled (see
+  get_settled_time). The cursor isn't moved past the first change that
+  hadn't, so it and those after it are listed again next time. For in-memory
+  indexes catching up with changes made by other processes, which can apply
+  a change twice; only ids are fetched, from the primary.
+  """
+  from spots.models import SpotChange
+  from spots.routers import using_primary
+  content_types = dict([ (ContentType.objects.get_for_model(model).id, model) for model in models ])
+  settled_time = get_settled_time()
+  changed, settled, position = [], True, cursor
+  while True:
+    rows = list(using_primary(SpotChange.objects.filter(id__gt=position, content_type__in=content_types.keys())).order_by('id').values_list('id', 'content_type', 'object_id', 'changed')[:MAX_LIMIT])
+    for id, content_type_id, object_id, when in rows:
+      changed.append((content_types[content_type_id], object_id))
+      settled = settled and when <= settled_time
+      if settled:
+        cursor = id
+    if rows:
+      position = rows[-1][0]
+    if len(rows) < MAX_LIMIT:
+      return changed, cursor, settled
+
+
+def _describe(model, ids):
+  # Returns a dict mapping the ids of existing objects of a model to dicts
+  # of what a syncing client needs to know about them.
+  from spots.catalog import city_catalog
+  from spots.models import City, Neighborhood, Spot
+  from spots.rows import get_spot_rows_in_bulk
+  if model is City:
+    records = [ city_catalog.get(id) for id in ids ]
+    return dict([ (record.id, {'name': record.full_name, 'slug': record.slug, 'latitude': record.latitude and float(record.latitude), 'longitude': record.longitude and float(record.longitude), 'url': record.url()}) for record in records if record ])
+  if model is Neighborhood:
+    return dict([ (neighborhood.id, {'name': neighborhood.name, 'slug': neighborhood.slug, 'city': neighborhood.city_id, 'url': neighborhood.get_absolute_url()}) for neighborhood in Neighborhood.objects.filter(id__in=ids) ])
+  if issubclass(model, Spot):
+    rows = get_spot_rows_in_bulk(model._default_manager.all(), ids)
+    return dict([ (id, {'address': row.address, 'city': row.city_id, 'latitude': row.latitude and float(row.latitude), 'longitude': row.longitude and float(row.longitude), 'url': row.url}) for id, row in rows.items() ])
+  return {}
+
+
+def serialize_changes(changes):
+  """
+  Returns a list of dicts for the changes, for a JSON feed. Saved objects
+  come with their current data, fetched in one query per model; deleted
+  ones, and objects deleted since, have none.
+  """
+  ids_by_model = {}
+  for change in changes:
+    if change.action == 'saved':
+      ids_by_model.setdefault(change.content_type.model_class(), []).append(change.object_id)
+  data = {}
+  for model, ids in ids_by_model.items():
+    if model is not None:
+      data[model] = _describe(model, ids)
+  serialized = []
+  for change in changes:
+    model = change.content_type.model_class()
+    serialized.append({
+      'seq': change.id,
+      'type': "%s.%s" % (change.content_type.app_label, change.content_type.model),
+      'id': change.object_id,
+      'action': change.action,
+      'changed': change.changed.isoformat(),
+      'data': data.get(model, {}).get(change.object_id),
+    })
+  return serialized
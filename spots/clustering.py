@@ -0,0 +1,174 @@
+import math
+
+from django.conf import settings
+from django.core.cache import cache
+
+from spots.cache import CACHE_PREFIX, GENERATION_TIMEOUT
+from spots.export import filter_by_bbox
+from spots.instrumentation import record_cache_lookup
+
+
+TILE_SIZE = 256
+MAX_ZOOM = 21
+MAX_TILES = getattr(settings, 'SPOTS_CLUSTER_MAX_TILES', 64)
+CELLS_PER_TILE = getattr(settings, 'SPOTS_CLUSTER_CELLS_PER_TILE', 4)
+MAX_LATITUDE = 85.05112878
+
+
+
+
+def _clamp_latitude(latitude):
+  return max(-MAX_LATITUDE, min(MAX_LATITUDE, latitude))
+
+
+def get_world_pixel(latitude, longitude, zoom):
+  """
+  Returns the (x, y) Web Mercator pixel position of a location at the given
+  zoom level, the same projection Google Maps uses for its tiles.
+  """
+  scale = TILE_SIZE * 2 ** zoom
+  sin_latitude = math.sin(math.radians(_clamp_latitude(float(latitude))))
+  x = (float(longitude) + 180.0) / 360.0 * scale
+  y = (0.5 - math.log((1 + sin_latitude) / (1 - sin_latitude)) / (4 * math.pi)) * scale
+  return (min(max(x, 0), scale - 1), min(max(y, 0), scale - 1))
+
+
+def get_tile_for_location(latitude, longitude, zoom):
+  """ Returns the (x, y) tile containing a location at the given zoom level. """
+  x, y = get_world_pixel(latitude, longitude, zoom)
+  return (int(x // TILE_SIZE), int(y // TILE_SIZE))
+
+
+def get_tile_bbox(x, y, zoom):
+  """ Returns the (west, south, east, north) bounding box of a tile. """
+  tiles = 2 ** zoom
+  def latitude(tile_y):
+    return math.degrees(math.atan(math.sinh(math.pi * (1 - 2.0 * tile_y / tiles))))
+  return (x * 360.0 / tiles - 180.0, latitude(y + 1), (x + 1) * 360.0 / tiles - 180.0, latitude(y))
+
+
+def get_tiles_for_bbox(bbox, zoom, max_tiles=None):
+  """
+  Returns the (x, y) tiles covering a (west, south, east, north) bounding box
+  at the given zoom level. Handles boxes that cross the antimeridian. Raises
+  ValueError if there are more than max_tiles of them.
+  """
+  west, south, east, north = bbox
+  tiles = 2 ** zoom
+  x_min, y_min = get_tile_for_location(north, west, zoom)
+  x_max, y_max = get_tile_for_location(south, east, zoom)
+  if west <= east:
+    columns = x_max - x_min + 1
+  else:
+    # Wrapping around can reach the starting column again (always, at zoom
+    # 0), and no tile should be visited twice.
+    columns = min(tiles, tiles - x_min + x_max + 1)
+  if max_tiles is not None and columns * (y_max - y_min + 1) > max_tiles:
+    raise ValueError("The bounding box covers too many tiles at zoom level %s." % zoom)
+  xs = []
+  for column in range(columns):
+    x = (x_min + column) % tiles
+    if x not in xs:
+      xs.append(x)
+  return [ (x, y) for x in xs for y in range(y_min, y_max + 1) ]
+
+
+
+
+def _tile_cache_key(model, x, y, zoom):
+  return "%s:clusters:%s:%d:%d:%d" % (CACHE_PREFIX, model._meta.db_table, zoom, x, y)
+
+
+def cluster_locations(locations, zoom, cell_size=float(TILE_SIZE) / CELLS_PER_TILE):
+  """
+  Groups (latitude, longitude) locations into grid cells cell_size pixels
+  wide at the given zoom level. Returns a dict for each cell with locations
+  in it: the count, centroid and bounding box of those locations.
+  """
+  cells = {}
+  for latitude, longitude in locations:
+    if latitude is None or longitude is None:
+      continue
+    pixel_x, pixel_y = get_world_pixel(latitude, longitude, zoom)
+    cell = (int(pixel_x // cell_size), int(pixel_y // cell_size))
+    latitude, longitude = float(latitude), float(longitude)
+    if cell in cells:
+      cluster = cells[cell]
+      cluster['count'] += 1
+      cluster['latitude'] += latitude
+      cluster['longitude'] += longitude
+      west, south, east, north = cluster['bbox']
+      cluster['bbox'] = [min(west, longitude), min(south, latitude), max(east, longitude), max(north, latitude)]
+    else:
+      cells[cell] = {'count': 1, 'latitude': latitude, 'longitude': longitude, 'bbox': [longitude, latitude, longitude, latitude]}
+  clusters = []
+  for cluster in cells.values():
+    cluster['latitude'] = cluster['latitude'] / cluster['count']
+    cluster['longitude'] = cluster['longitude'] / cluster['count']
+    clusters.append(cluster)
+  return clusters
+
+
+def compute_clusters_for_tile(queryset, x, y, zoom):
+  """
+  Returns the clusters for one tile. The tile is split into a grid of
+  CELLS_PER_TILE x CELLS_PER_TILE cells, and each cell with spots in it
+  becomes a cluster.
+  """
+  spots = filter_by_bbox(queryset, get_tile_bbox(x, y, zoom)).values_list('latitude', 'longitude')
+  # Spots on a tile's edge are matched by both tiles' bounding boxes.
+  locations = ( location for location in spots.iterator() if None not in location and get_tile_for_location(location[0], location[1], zoom) == (x, y) )
+  return cluster_locations(locations, zoom)
+
+
+def get_clusters_for_tile(queryset, x, y, zoom):
+  """ Returns the clusters for one tile, from the cache when possible. """
+  key = _tile_cache_key(queryset.model, x, y, zoom)
+  clusters = cache.get(key)
+  record_cache_lookup('cache.clusters', clusters is not None)
+  if clusters is None:
+    clusters = compute_clusters_for_tile(queryset, x, y, zoom)
+    cache.set(key, clusters, GENERATION_TIMEOUT)
+  return clusters
+
+
+def get_clusters(queryset, bbox, zoom):
+  """
+  Returns the clusters for all the tiles covering a (west, south, east, north)
+  bounding box at the given zoom level. Raises ValueError if the box covers
+  more than MAX_TILES tiles. Cached clusters are shared by every caller
+  clustering the same model, so pass all the spots of a model.
+  """
+  clusters = []
+  for x, y in get_tiles_for_bbox(bbox, zoom, MAX_TILES):
+    clusters += get_clusters_for_tile(queryset, x, y, zoom)
+  return clusters
+
+
+def invalidate_clusters_for_location(model, location):
+  """
+  Drops the cached clusters of every tile containing the location, at every
+  zoom level. Only those tiles can have been changed by a spot there.
+  """
+  latitude, longitude = location
+  if latitude is None or longitude is None:
+    return
+  for zoom in range(MAX_ZOOM + 1):
+    x, y = get_tile_for_location(latitude, longitude, zoom)
+    cache.delete(_tile_cache_key(model, x, y, zoom))
+
+
+
+
+def spot_saved(sender, instance, **kwargs):
+  """
+  Signal handler dropping the cached clusters where a spot was and where it
+  is now. Spots that didn't move leave the clusters alone.
+  """
+  for location in getattr(instance, '_cache_locations', [instance.location()]):
+    invalidate_clusters_for_location(sender, location)
+
+
+def spot_deleted(sender, instance, **kwargs):
+  """ Signal handler dropping the cached clusters where a spot was. """
+  invalidate_clusters_for_location(sender, instance.location())
@@ -0,0 +1,147 @@
+from django.conf import settings
+from django.db import connection
+from django.db.models import Q
+from django.utils import simplejson
+
+from spots.rows import get_row_fields, get_spot_url
+
+
+CHUNK_SIZE = 2000
+EXPORT_FORMATS = {
+  'geojson': 'application/json',
+  'ndjson': 'application/x-ndjson',
+}
+
+
+
+
+def iterate_in_chunks(queryset, fields, chunk_size=CHUNK_SIZE):
+  """
+  Yields value dicts for the given fields of every object in the queryset.
+  Rows are fetched chunk_size at a time, paging on the primary key rather
+  than with OFFSET, so memory use stays flat however large the queryset is.
+  """
+  fields = tuple(fields)
+  if 'id' not in fields:
+    fields = ('id',) + fields
+  last_id = None
+  while True:
+    chunk = queryset.order_by('id')
+    if last_id is not None:
+      chunk = chunk.filter(id__gt=last_id)
+    rows = list(chunk.values(*fields)[:chunk_size])
+    if not rows:
+      break
+    for row in rows:
+      yield row
+    last_id = rows[-1]['id']
+
+
+def filter_by_bbox(queryset, bbox):
+  """
+  Filters a queryset of spots to a bounding box given as a
+  (west, south, east, north) tuple. A box whose west edge is greater than
+  its east edge crosses the antimeridian.
+  """
+  west, south, east, north = bbox
+  queryset = queryset.filter(latitude__range=(south, north))
+  if west <= east:
+    return queryset.filter(longitude__range=(west, east))
+  return queryset.filter(Q(longitude__gte=west) | Q(longitude__lte=east))
+
+
+def get_column_sql(model, name):
+  """
+  Returns the quoted column of a model's field, qualified with the table
+  that holds it, for use in extra() SQL. With multi-table inheritance,
+  that's the parent's table for the fields the model inherits.
+  """
+  qn = connection.ops.quote_name
+  field, owner, direct, m2m = model._meta.get_field_by_name(name)
+  return "%s.%s" % (qn((owner or model)._meta.db_table), qn(field.column))
+
+
+def get_floor_sql(expression):
+  """ Returns SQL for the floor of an expression, as an integer. """
+  # SQLite has no FLOOR(), so round towards zero and correct negatives.
+  engine = getattr(connection, 'vendor', None) or getattr(settings, 'DATABASE_ENGINE', '')
+  if 'sqlite' in engine:
+    return "(CAST(%s AS INTEGER) - (%s < CAST(%s AS INTEGER)))" % (expression, expression, expression)
+  return "FLOOR(%s)" % expression
+
+
+def parse_bbox(value):
+  """
+  Parses a "west,south,east,north" string into a tuple of floats. Returns None
+  if the string isn't a valid bounding box.
+  """
+  try:
+    west, south, east, north = [ float(bit) for bit in value.split(',') ]
+  except (AttributeError, ValueError):
+    return None
+  if south > north or not (-90 <= south <= 90 and -90 <= north <= 90):
+    return None
+  if not (-180 <= west <= 180 and -180 <= east <= 180):
+    return None
+  return (west, south, east, north)
+
+
+
+
+def _float_or_none(value):
+  if value is None:
+    return None
+  return float(value)
+
+
+def iterate_spot_rows(queryset, chunk_size=CHUNK_SIZE):
+  """
+  Yields a dict for each spot in the queryset with just what an export needs:
+  id, latitude, longitude, address and URL. Only the row fields are fetched,
+  chunk_size at a time, and each dict is made straight from the values, so
+  no model instances or SpotRows are made.
+  """
+  for values in iterate_in_chunks(queryset, get_row_fields(queryset.model), chunk_size):
+    yield {
+      'id': values['id'],
+      'latitude': _float_or_none(values['latitude']),
+      'longitude': _float_or_none(values['longitude']),
+      'address': values['address'],
+      'url': get_spot_url(values['city'], values.get('slug')),
+    }
+
+
+def geojson_feature(row):
+  """ Returns a GeoJSON Feature dict for a spot row. """
+  if row['latitude'] is None or row['longitude'] is None:
+    geometry = None
+  else:
+    geometry = {'type': 'Point', 'coordinates': [row['longitude'], row['latitude']]}
+  return {
+    'type': 'Feature',
+    'id': row['id'],
+    'geometry': geometry,
+    'properties': {'address': row['address'], 'url': row['url']},
+  }
+
+
+def stream_geojson(rows):
+  """ Yields a GeoJSON FeatureCollection for the rows, one feature at a time. """
+  yield '{"type": "FeatureCollection", "features": ['
+  separator = ''
+  for row in rows:
+    yield separator + simplejson.dumps(geojson_feature(row))
+    separator = ',\n'
+  yield ']}\n'
+
+
+def stream_ndjson(rows):
+  """ Yields the rows as newline-delimited JSON, one spot per line. """
+  for row in rows:
+    yield simplejson.dumps(row) + '\n'
+
+
+STREAMERS = {
+  'geojson': stream_geojson,
+  'ndjson': stream_ndjson,
+}
@@ -2,6 +2,8 @@ from django.forms.fields import CharField
 from django.forms.util import ErrorList
 from django.core.exceptions import ValidationError
 
+from spots.autocomplete import city_index
+from spots.lookups import get_city_by_full_name, get_city_by_id
 from spots.widgets import *
 from spots.utils import *
 
@@ -13,7 +15,13 @@ class CityField(CharField):
   widget = CityInput
   def clean(self, value):
     if value:
-      city = get_city_from_address(value.encode('ascii', 'xmlcharrefreplace'))
+      # Cities picked from the autocomplete, or picked earlier, are posted
+      # back by name. Only geocode what doesn't match a city we already know.
+      city = get_city_by_id(city_index.get_id(value))
+      if city is None:
+        city = get_city_by_full_name(value)
+      if city is None:
+        city = get_city_from_address(value.encode('ascii', 'xmlcharrefreplace'))
       if city is None:
         raise ValidationError(self.error_messages['invalid'])
       return city
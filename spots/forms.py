@@ -29,6 +29,14 @@ class SpotForm(forms.ModelForm):
     longitude = self.cleaned_data.get("longitude")
     address = self.cleaned_data.get("address")
     city = self.cleaned_data.get("city")
+
+    # An existing spot whose address hasn't changed doesn't need geocoding again.
+    spot = self.instance
+    if address and spot.pk and address == spot.address and spot.latitude and spot.longitude and spot.city_id:
+      self.cleaned_data['latitude'] = str(spot.latitude)
+      self.cleaned_data['longitude'] = str(spot.longitude)
+      self.cleaned_data['city'] = spot.city
+      return self.cleaned_data
     
     if address or latitude or longitude:
       try:
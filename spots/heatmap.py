@@ -0,0 +1,161 @@
+import math
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count
+
+from spots.cache import CACHE_PREFIX, GENERATION_TIMEOUT, get_scope_generation
+from spots.export import get_column_sql, get_floor_sql
+from spots.instrumentation import record_cache_lookup
+
+
+# Cell sizes, in degrees, that heatmaps can be binned at.
+RESOLUTIONS = tuple(getattr(settings, 'SPOTS_HEATMAP_RESOLUTIONS', (10, 5, 1, 0.5, 0.1, 0.05, 0.01)))
+BLOCK_CELLS = 32
+MAX_BLOCKS = getattr(settings, 'SPOTS_HEATMAP_MAX_BLOCKS', 64)
+
+
+
+
+def get_cell(latitude, longitude, resolution):
+  """ Returns the (row, column) of the grid cell a location is in, at the given resolution. """
+  return (int(math.floor((float(latitude) + 90) / resolution)), int(math.floor((float(longitude) + 180) / resolution)))
+
+
+def get_block(latitude, longitude, resolution):
+  """ Returns the (row, column) of the block of BLOCK_CELLS x BLOCK_CELLS cells a location is in. """
+  row, column = get_cell(latitude, longitude, resolution)
+  return (row // BLOCK_CELLS, column // BLOCK_CELLS)
+
+
+def get_block_bbox(row, column, resolution):
+  """ Returns the (west, south, east, north) bounds of a block. """
+  size = BLOCK_CELLS * resolution
+  return (column * size - 180, row * size - 90, (column + 1) * size - 180, (row + 1) * size - 90)
+
+
+def get_blocks_for_bbox(bbox, resolution, max_blocks=MAX_BLOCKS):
+  """
+  Returns the (row, column) of every block covering a (west, south, east,
+  north) bounding box. A box whose west edge is greater than its east edge
+  crosses the antimeridian. Raises ValueError if there'd be more than
+  max_blocks.
+  """
+  west, south, east, north = bbox
+  bottom, left = get_block(south, west, resolution)
+  top, right = get_block(min(north, 89.999999), min(east, 179.999999), resolution)
+  last_column = get_block(0, 179.999999, resolution)[1]
+  if west > east:
+    # At coarse resolutions the wrapped part can reach back into the columns
+    # already covered; each block is only counted once.
+    columns = list(range(left, last_column + 1)) + [ column for column in range(0, right + 1) if column < left ]
+  else:
+    columns = list(range(left, right + 1))
+  if len(columns) * (top - bottom + 1) > max_blocks:
+    raise ValueError("That box needs more than %s blocks at a resolution of %s degrees; use a coarser resolution." % (max_blocks, resolution))
+  return [ (row, column) for row in range(bottom, top + 1) for column in columns ]
+
+
+def compute_block(model, row, column, resolution):
+  """
+  Returns [row, column, count] for every cell of a block with spots (or
+  cities) of the given model in it. Counting is done by the database, with
+  a GROUP BY on the quantized coordinates.
+  """
+  latitude, longitude = get_column_sql(model, 'latitude'), get_column_sql(model, 'longitude')
+  # The resolution is written into the SQL, rather than passed as a parameter,
+  # so the GROUP BY expressions are the same as the selected ones.
+  select = {
+    'cell_row': get_floor_sql("((%s + 90) / %r)" % (latitude, float(resolution))),
+    'cell_column': get_floor_sql("((%s + 180) / %r)" % (longitude, float(resolution))),
+  }
+  west, south, east, north = get_block_bbox(row, column, resolution)
+  spots = model._default_manager.filter(latitude__gte=south, latitude__lt=north, longitude__gte=west, longitude__lt=east)
+  cells = spots.order_by().extra(select=select).values('cell_row', 'cell_column').annotate(count=Count('id'))
+  return [ [int(cell['cell_row']), int(cell['cell_column']), int(cell['count'])] for cell in cells ]
+
+
+def _block_cache_key(model, row, column, resolution):
+  # Returns None for city blocks when the cache keeps no generation for
+  # cities, as then there'd be no telling when the counts went stale.
+  key = "%s:heatmap:%s:%s:%s:%s" % (CACHE_PREFIX, model._meta.db_table, resolution, row, column)
+  if model._meta.app_label == 'spots' and model._meta.object_name == 'City':
+    # Cities are few and rarely change, so any change to one drops them all.
+    generation = get_scope_generation('cities')
+    if generation is None:
+      return None
+    key += ":%s" % generation
+  return key
+
+
+def get_block_counts(model, row, column, resolution):
+  """ Returns the cell counts for one block, from the cache when possible. """
+  key = _block_cache_key(model, row, column, resolution)
+  if key is None:
+    return compute_block(model, row, column, resolution)
+  cells = cache.get(key)
+  record_cache_lookup('cache.heatmap', cells is not None)
+  if cells is None:
+    cells = compute_block(model, row, column, resolution)
+    cache.set(key, cells, GENERATION_TIMEOUT)
+  return cells
+
+
+def get_heatmap(model, bbox, resolution):
+  """
+  Returns [latitude, longitude, count] for the center of every grid cell
+  with spots (or cities) of the given model in it, in a (west, south, east,
+  north) bounding box. The resolution is the cell size in degrees, and must
+  be one of RESOLUTIONS. Counts are cached in blocks of cells, which are
+  dropped as spots in them change. Raises ValueError for an unknown
+  resolution or a box too big for it.
+  """
+  if resolution not in RESOLUTIONS:
+    raise ValueError("The resolution should be one of %s." % ", ".join([ str(r) for r in RESOLUTIONS ]))
+  west, south, east, north = bbox
+  # Keep the cells that overlap the box, going by their centers.
+  margin = resolution / 2.0
+  cells = []
+  for row, column in get_blocks_for_bbox(bbox, resolution):
+    for cell_row, cell_column, count in get_block_counts(model, row, column, resolution):
+      latitude = (cell_row + 0.5) * resolution - 90
+      longitude = (cell_column + 0.5) * resolution - 180
+      if not south - margin < latitude < north + margin:
+        continue
+      if west <= east and not west - margin < longitude < east + margin:
+        continue
+      if west > east and east + margin <= longitude <= west - margin:
+        continue
+      cells.append([latitude, longitude, count])
+  return cells
+
+
+def invalidate_heatmap_for_location(model, location):
+  """
+  Drops the cached counts of the block containing the location, at every
+  resolution. Only those blocks can have been changed by a spot there.
+  """
+  latitude, longitude = location
+  if latitude is None or longitude is None:
+    return
+  for resolution in RESOLUTIONS:
+    row, column = get_block(latitude, longitude, resolution)
+    key = _block_cache_key(model, row, column, resolution)
+    if key is not None:
+      cache.delete(key)
+
+
+
+
+def spot_saved(sender, instance, **kwargs):
+  """
+  Signal handler dropping the cached heatmap counts where a spot was and
+  where it is now. Spots that didn't move leave them alone.
+  """
+  for location in getattr(instance, '_cache_locations', [instance.location()]):
+    invalidate_heatmap_for_location(sender, location)
+
+
+def spot_deleted(sender, instance, **kwargs):
+  """ Signal handler dropping the cached heatmap counts where a spot was. """
+  invalidate_heatmap_for_location(sender, instance.location())
@@ -0,0 +1,197 @@
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection
+from django.utils.functional import wraps
+
+
+_sink = None
+_sink_loaded = False
+_queries = threading.local()
+
+
+
+
+class LoggingSink(object):
+  """ A metrics sink writing each measurement to the "spots.metrics" logger. """
+  def __init__(self):
+    self.logger = logging.getLogger('spots.metrics')
+
+  def record(self, kind, name, value):
+    self.logger.info("%s %s %s", kind, name, value)
+
+
+class MemorySink(object):
+  """
+  A metrics sink keeping counts, and every timing and value, in memory.
+  Handy for benchmarks; summary() gives counts and percentiles.
+  """
+  def __init__(self):
+    self.counts = {}
+    self.timings = {}
+
+  def record(self, kind, name, value):
+    if kind == 'count':
+      self.counts[name] = self.counts.get(name, 0) + value
+    else:
+      self.timings.setdefault(name, []).append(value)
+
+  def summary(self):
+    """ Returns a dict of counts, and of (calls, p50, p90, p99, max) for each timing or value. """
+    summary = {'counts': dict(self.counts), 'timings': {}}
+    for name, values in self.timings.items():
+      values = sorted(values)
+      summary['timings'][name] = (len(values), percentile(values, 50), percentile(values, 90), percentile(values, 99), values[-1])
+    return summary
+
+
+class CountingCursor(object):
+  """ Wraps a database cursor, counting the queries run through it in this thread. """
+  def __init__(self, cursor):
+    self.cursor = cursor
+
+  def execute(self, *args, **kwargs):
+    _queries.count = getattr(_queries, 'count', 0) + 1
+    return self.cursor.execute(*args, **kwargs)
+
+  def executemany(self, *args, **kwargs):
+    _queries.count = getattr(_queries, 'count', 0) + 1
+    return self.cursor.executemany(*args, **kwargs)
+
+  def __getattr__(self, name):
+    return getattr(self.cursor, name)
+
+  def __iter__(self):
+    return iter(self.cursor)
+
+
+
+
+def percentile(values, percent):
+  """ Returns the given percentile of a sorted list of numbers. """
+  if not values:
+    return None
+  index = min(len(values) - 1, int(round(percent / 100.0 * (len(values) - 1))))
+  return values[index]
+
+
+def get_query_count():
+  """
+  Returns the number of queries this thread has run since it first asked;
+  take the difference of two calls to count the queries in between. Unlike
+  connection.queries, this doesn't depend on DEBUG: the first call wraps the
+  connection's cursors in a CountingCursor.
+  """
+  if not getattr(connection, '_spots_counting_queries', False):
+    cursor = connection.cursor
+    connection.cursor = lambda: CountingCursor(cursor())
+    connection._spots_counting_queries = True
+  return getattr(_queries, 'count', 0)
+
+
+
+
+def get_sink():
+  """
+  Returns the metrics sink named by the SPOTS_METRICS_SINK setting (a dotted
+  path to a class or an instance), or None if metrics are off, which they are
+  by default. Sinks have a record(kind, name, value) method, where kind is
+  "count", "timing" (in milliseconds) or "value" (any other measurement to
+  keep a histogram of).
+  """
+  global _sink, _sink_loaded
+  if not _sink_loaded:
+    path = getattr(settings, 'SPOTS_METRICS_SINK', None)
+    if path:
+      module_name, attribute = path.rsplit('.', 1)
+      sink = getattr(__import__(module_name, {}, {}, [attribute]), attribute)
+      if isinstance(sink, type):
+        sink = sink()
+      _sink = sink
+    _sink_loaded = True
+  return _sink
+
+
+def set_sink(sink):
+  """ Replaces the metrics sink; None turns metrics off. Returns the old sink. """
+  global _sink, _sink_loaded
+  old = get_sink()
+  _sink, _sink_loaded = sink, True
+  return old
+
+
+def increment(name, value=1):
+  """ Adds to a counter, if metrics are on. """
+  sink = _sink_loaded and _sink or get_sink()
+  if sink is not None:
+    sink.record('count', name, value)
+
+
+def record_timing(name, milliseconds):
+  """ Records a latency, in milliseconds, if metrics are on. """
+  sink = _sink_loaded and _sink or get_sink()
+  if sink is not None:
+    sink.record('timing', name, milliseconds)
+
+
+def timed(name):
+  """
+  Decorator counting the calls to a function and timing them under the given
+  name. With metrics off, the function is called straight through.
+  """
+  def decorator(function):
+    def _wrapped(*args, **kwargs):
+      sink = _sink_loaded and _sink or get_sink()
+      if sink is None:
+        return function(*args, **kwargs)
+      started = time.time()
+      try:
+        return function(*args, **kwargs)
+      finally:
+        sink.record('count', name, 1)
+        sink.record('timing', name, (time.time() - started) * 1000)
+    return wraps(function)(_wrapped)
+  return decorator
+
+
+def sleep(seconds, name):
+  """
+  Sleeps for the given number of seconds, like time.sleep, recording the
+  time spent under "<name>.sleep". The geocoders' rate-limiting pauses go
+  through this, so they show up apart from the calls themselves.
+  """
+  sink = _sink_loaded and _sink or get_sink()
+  if sink is not None:
+    sink.record('count', name + '.sleep', 1)
+    sink.record('timing', name + '.sleep', seconds * 1000)
+  time.sleep(seconds)
+
+
+def record_cache_lookup(name, hit):
+  """ Counts a cache lookup as "<name>.hit" or "<name>.miss", if metrics are on. """
+  sink = _sink_loaded and _sink or get_sink()
+  if sink is not None:
+    sink.record('count', name + (hit and '.hit' or '.miss'), 1)
+
+
+def instrument_view(name):
+  """
+  Decorator timing a spots view under "view.<name>" and recording how many
+  queries it made under "view.<name>.queries", whether DEBUG is on or not.
+  """
+  def decorator(view):
+    def _wrapped(request, *args, **kwargs):
+      sink = _sink_loaded and _sink or get_sink()
+      if sink is None:
+        return view(request, *args, **kwargs)
+      queries = get_query_count()
+      started = time.time()
+      try:
+        return view(request, *args, **kwargs)
+      finally:
+        sink.record('timing', 'view.' + name, (time.time() - started) * 1000)
+        sink.record('value', 'view.%s.queries' % name, get_query_count() - queries)
+    return wraps(view)(_wrapped)
+  return decorator
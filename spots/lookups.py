@@ -0,0 +1,23 @@
+from spots.catalog import city_catalog
+
+
+
+
+def get_city_by_id(id):
+  """
+  Returns the City with the given id, or None if there isn't one. The City
+  is made from the in-memory city catalog, without a query.
+  """
+  record = city_catalog.get(id)
+  return record and record.to_city()
+
+
+def get_city_by_full_name(name):
+  """
+  Returns the City whose full_name() matches the given string (ignoring case
+  and extra whitespace), or None if no known city does. A form posting back
+  the name of an existing city resolves it without a query or a trip to the
+  geocoder.
+  """
+  record = city_catalog.get_by_full_name(name)
+  return record and record.to_city()
@@ -0,0 +1,86 @@
+import random
+import sys
+from optparse import make_option
+
+from django.core.management.base import CommandError
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db.models import get_model
+
+from spots.benchmark import SCALES, PERCENTILES, LocalCache, StubGeocoder, generate_dataset, get_operations, time_operation
+from spots.catalog import city_catalog
+from spots.models import *
+from spots.neighbors import rebuild_neighbors
+
+class Command(BaseCommand):
+  help = "Times the spatial queries, list views and form saves against a synthetic dataset in a test database."
+  args = "app_label.ModelName"
+  option_list = BaseCommand.option_list + (
+    make_option('--scale', dest='scale', default='10k', help="Number of spots to generate: %s." % ", ".join(sorted(SCALES.keys()))),
+    make_option('--calls', dest='calls', type='int', default=50, help="Number of calls to time for each operation."),
+    make_option('--seed', dest='seed', type='int', default=0, help="Seed for the synthetic data and the spots sampled."),
+    make_option('--noinput', action='store_false', dest='interactive', default=True, help="Don't ask before replacing an old test database."),
+  )
+
+  def handle(self, *args, **options):
+    """
+    Creates a test database, fills it with synthetic cities, neighborhoods
+    and spots of the given spot model, and times each benchmark operation on
+    a sample of the spots. For each one, it prints latency percentiles, the
+    mean number of queries and the peak memory it used. The geocoders are
+    stubbed out, a local-memory cache stands in for the shared one, and the
+    test database is destroyed afterwards.
+    """
+    if len(args) != 1:
+      raise CommandError("Give the spot model to benchmark as app_label.ModelName.")
+    try:
+      app_label, model_name = args[0].split('.')
+    except ValueError:
+      raise CommandError("Models should be given as app_label.ModelName, not %r." % args[0])
+    model = get_model(app_label, model_name)
+    if model is None or not issubclass(model, Spot):
+      raise CommandError("%s is not a spot model." % args[0])
+    if options['scale'] not in SCALES:
+      raise CommandError("Scale should be one of %s." % ", ".join(sorted(SCALES.keys())))
+    count = SCALES[options['scale']]
+
+    old_name = connection.settings_dict['NAME']
+    local_cache = LocalCache()
+    local_cache.install()
+    try:
+      connection.creation.create_test_db(verbosity=0, autoclobber=not options['interactive'])
+      city_catalog.clear()
+      try:
+        self.run(model, count, options['calls'], options['seed'])
+      finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        city_catalog.clear()
+    finally:
+      local_cache.uninstall()
+
+  def run(self, model, count, calls, seed):
+    sys.stdout.write("Generating %s spots...\n" % count)
+    city_count = generate_dataset(model, count, seed)
+    city_catalog.clear()
+    sys.stdout.write("Generated %s spots in %s cities. Building neighbours...\n" % (count, city_count))
+    rebuild_neighbors(model)
+
+    rng = random.Random(seed)
+    ids = rng.sample(xrange(count), min(calls, count))
+    spots = model._default_manager.select_related('city').order_by('id')
+    sample = [ spots[i] for i in ids ]
+
+    geocoder = StubGeocoder(seed)
+    geocoder.install()
+    try:
+      header = "%-36s %6s" % ("operation", "calls") + "".join([ " %9s" % ("p%d ms" % percent) for percent in PERCENTILES ]) + " %9s %8s %10s\n" % ("max ms", "queries", "memory kB")
+      sys.stdout.write(header)
+      for name, operation in get_operations(model):
+        try:
+          stats = time_operation(operation, sample)
+        except Exception as e:
+          sys.stdout.write("%-36s failed: %s\n" % (name, e))
+          continue
+        sys.stdout.write("%-36s %6d" % (name, stats['calls']) + "".join([ " %9.2f" % stats['p%d' % percent] for percent in PERCENTILES ]) + " %9.2f %8.1f %10d\n" % (stats['max'], stats['queries'], stats['memory']))
+    finally:
+      geocoder.uninstall()
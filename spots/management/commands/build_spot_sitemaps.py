@@ -0,0 +1,48 @@
+import os
+import sys
+from optparse import make_option
+
+from django.contrib.sites.models import Site
+from django.core.management.base import CommandError
+from django.core.management.base import BaseCommand
+from django.db.models import get_model
+
+from spots.models import *
+from spots.sitemaps import SHARD_SIZE, write_sitemaps
+
+class Command(BaseCommand):
+  help = "Writes sharded sitemaps of every city, neighborhood and spot, with an index."
+  args = "directory [app_label.ModelName ...]"
+  option_list = BaseCommand.option_list + (
+    make_option('--base-url', dest='base_url', default=None, help="The site's URL, like http://example.com. Defaults to the current Site's domain."),
+    make_option('--shard-size', dest='shard_size', type='int', default=SHARD_SIZE, help="The most URLs to put in one sitemap file."),
+    make_option('--gzip', action='store_true', dest='compress', default=False, help="Gzip the sitemap files (the index isn't)."),
+  )
+
+  def handle(self, *args, **options):
+    """
+    Writes the sitemaps into the given directory, for the given spot models,
+    or for every installed Spot subclass if none are given. Run it regularly
+    (from cron, say) and serve the directory from the site's root.
+    """
+    if not args:
+      raise CommandError("Give the directory to write the sitemaps to.")
+    directory = args[0]
+    if not os.path.isdir(directory):
+      raise CommandError("%s is not a directory." % directory)
+    if len(args) > 1:
+      spot_models = []
+      for label in args[1:]:
+        try:
+          app_label, model_name = label.split('.')
+        except ValueError:
+          raise CommandError("Models should be given as app_label.ModelName, not %r." % label)
+        model = get_model(app_label, model_name)
+        if model is None or not issubclass(model, Spot):
+          raise CommandError("%s is not a spot model." % label)
+        spot_models.append(model)
+    else:
+      spot_models = get_spot_models()
+    base_url = (options['base_url'] or "http://%s" % Site.objects.get_current().domain).rstrip('/')
+    filenames = write_sitemaps(directory, base_url, spot_models, options['shard_size'], options['compress'])
+    sys.stdout.write("Wrote %s sitemap files to %s.\n" % (len(filenames), directory))
@@ -0,0 +1,37 @@
+import sys
+
+from django.core.management.base import CommandError
+from django.core.management.base import BaseCommand
+from django.db.models import get_model
+
+from spots.models import *
+from spots.neighbors import rebuild_neighbors
+
+class Command(BaseCommand):
+  help = "Rebuilds the precomputed nearest neighbours of every spot."
+  args = "[app_label.ModelName ...]"
+
+  def handle(self, *args, **kwargs):
+    """
+    Recomputes the SpotNeighbor table for the given spot models, or for every
+    installed Spot subclass if none are given. Saving, moving and deleting
+    spots keeps the table up to date after that, so this is only needed when
+    it's first created, or when a change was left for it because it touched
+    more than SPOTS_MAX_NEIGHBOR_REFRESH spots.
+    """
+    if args:
+      spot_models = []
+      for label in args:
+        try:
+          app_label, model_name = label.split('.')
+        except ValueError:
+          raise CommandError("Models should be given as app_label.ModelName, not %r." % label)
+        model = get_model(app_label, model_name)
+        if model is None or not issubclass(model, Spot):
+          raise CommandError("%s is not a spot model." % label)
+        spot_models.append(model)
+    else:
+      spot_models = get_spot_models()
+    for model in spot_models:
+      count = rebuild_neighbors(model)
+      sys.stdout.write("Rebuilt neighbours for %s %s.\n" % (count, model._meta.verbose_name_plural))
@@ -14,7 +14,8 @@ class Command(BaseCommand):
     any neighborhoods itself, try to find the neighborhoods. This is here because
     we sometimes reach the Urban Mapping API daily query limit, and some spots get
     added without neighborhoods. This runs regularly, and tries to add those missing
-    neighborhoods.
+    neighborhoods. Their lookup is forced, since the spots themselves haven't
+    changed.
     """
     city_list = []
     for neighborhood in Neighborhood.objects.all():
@@ -23,4 +24,4 @@ class Command(BaseCommand):
     for city in city_list:
       spots = Spot.objects.filter(city=city, neighborhoods=None)
       for spot in spots:
-        spot.save()
\ No newline at end of file
+        spot._update_neighborhoods(force=True)
\ No newline at end of file
@@ -1,12 +1,20 @@
 from decimal import Decimal
 
 from django.db import models
-from django.db.models import signals
-from django.contrib.contenttypes.models import ContentType
-
-from spots.models import *
 
 class SpotManager(models.Manager):
+
+  def for_read(self):
+    """
+    Returns a QuerySet reading from the database spots.routers picks: a
+    replica inside read-only views, the primary after a write. Without
+    multiple database support it's just get_query_set().
+    """
+    from spots.routers import get_read_database
+    queryset = self.get_query_set()
+    if hasattr(queryset, 'using'):
+      return queryset.using(get_read_database())
+    return queryset
   
   def within_radius_of_location(self, location, radius_miles=1):
     """
@@ -17,7 +25,19 @@ class SpotManager(models.Manager):
     longitude = location[1]
     radius_miles = Decimal(str(radius_miles))
     radius = Decimal(radius_miles/Decimal("69.04"))
-    return self.filter(latitude__range=(latitude - radius,latitude + radius)).filter(longitude__range=(longitude - radius,longitude + radius))
+    return self.for_read().filter(latitude__range=(latitude - radius,latitude + radius)).filter(longitude__range=(longitude - radius,longitude + radius))
+    
+  def within_bbox(self, south, west, north, east, limit=500, sample='grid'):
+    """
+    Returns a QuerySet of at most "limit" spots inside the given bounds,
+    ordered by id. If west is greater than east, the box crosses the
+    antimeridian. When there are more spots than the limit, a deterministic
+    sample is returned: "grid" spreads it evenly over the box, "stride"
+    spreads it evenly by id, and None takes the first spots by id.
+    """
+    from spots.viewport import get_spots_in_bbox
+    spots, sampled = get_spots_in_bbox(self.for_read(), (west, south, east, north), limit, sample)
+    return spots
     
   def closest_spots(self, this_spot, mile_limit=25):
     """ 
@@ -32,4 +52,39 @@ class SpotManager(models.Manager):
         distance = this_spot._get_distance_to_spot(spot)
         direction = this_spot._get_compass_direction_to_spot(spot)
         spot_dict_list.append({ 'distance': float(distance), 'spot': spot, 'direction': direction })
-    return dictsort(spot_dict_list, 'distance')
\ No newline at end of file
+    return dictsort(spot_dict_list, 'distance')
+
+  def changes_since(self, cursor=0, limit=100):
+    """
+    Returns (changes, cursor, more) for the spots of this model saved or
+    deleted after the given cursor. See spots.changes.get_changes_since.
+    """
+    from spots.changes import get_changes_since
+    return get_changes_since(cursor, limit, models=[self.model])
+
+  def rows(self, queryset=None):
+    """
+    Yields every spot, or every spot in the given queryset of this model, as
+    a lightweight SpotRow (id, address, coordinates, city id, slug and URL),
+    ordered by id, without making model instances. The rows are fetched a
+    chunk at a time, so the table is never held in memory at once. Use
+    spots.rows.get_spot_rows for a sliced queryset.
+    """
+    from spots.rows import iterate_spot_rows_in_chunks
+    if queryset is None:
+      queryset = self.get_query_set()
+    return iterate_spot_rows_in_chunks(queryset)
+
+
+
+
+class SpotChangeManager(models.Manager):
+
+  def since(self, cursor=0, limit=100, models=None):
+    """
+    Returns (changes, cursor, more) for the spots, cities and neighborhoods
+    saved or deleted after the given cursor, optionally only those of the
+    given models. See spots.changes.get_changes_since.
+    """
+    from spots.changes import get_changes_since
+    return get_changes_since(cursor, limit, models)
@@ -0,0 +1,61 @@
+// Sets up the maps for django-spots form widgets. Each widget only renders
+// its markup and a few data attributes; this script does the rest, once for
+// every widget on the page.
+
+// Returns a GLatLng for a latitude and longitude given as numbers or strings,
+// or null if either isn't a number.
+function spots_lat_lng(latitude, longitude) {
+  latitude = parseFloat(latitude);
+  longitude = parseFloat(longitude);
+  if (isNaN(latitude) || isNaN(longitude)) {
+    return null;
+  }
+  return new GLatLng(latitude, longitude);
+}
+
+function spots_create_address_map(wrapper) {
+  if (!GBrowserIsCompatible()) {
+    return null;
+  }
+  var canvas = wrapper.find('.address-map').get(0);
+  var input = jQuery('#' + wrapper.attr('data-input'));
+  var point = null;
+  
+  // Start at the spot being edited, or the user's location, if the page has
+  // them, and otherwise at the widget's default point.
+  if (typeof(spot) !== 'undefined') {
+    point = spots_lat_lng(spot.latitude, spot.longitude);
+  }
+  if (!point && typeof(user) !== 'undefined') {
+    point = spots_lat_lng(user.latitude, user.longitude);
+  }
+  if (!point) {
+    point = spots_lat_lng(wrapper.attr('data-latitude'), wrapper.attr('data-longitude'));
+  }
+  if (!point) {
+    return null;
+  }
+  
+  var map = new GMap2(canvas);
+  map.setCenter(point, 14, G_PHYSICAL_MAP);
+  map.addControl(new GSmallZoomControl());
+  var marker = new GMarker(point, { clickable:true, draggable:true });
+  GEvent.addListener(marker, "dragend", function(){
+    input.val(marker.getPoint());
+  });
+  map.addOverlay(marker);
+  return map;
+}
+
+jQuery(document).ready(function(){
+  jQuery('.address-map-wrapper').each(function(){
+    var wrapper = jQuery(this);
+    var map = spots_create_address_map(wrapper);
+    wrapper.find('.address-map-open').click(function(e){
+      e.preventDefault();
+      wrapper.find('.address-map').toggle();
+      if (map) { map.zoomIn(); }
+    });
+    wrapper.find('.address-map').hide();
+  });
+});
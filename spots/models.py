@@ -1,7 +1,9 @@
 import unicodedata
+from decimal import Decimal
 
 from django.db import models
 from django.db.models import permalink, signals
+from django.core.exceptions import ImproperlyConfigured, ValidationError
 from django.contrib.contenttypes.models import ContentType
 from django.template.defaultfilters import slugify
 from django.utils.encoding import force_unicode
@@ -11,9 +13,8 @@ from django.contrib.sites.models import Site
 from django.contrib.localflavor.us.models import USStateField, PhoneNumberField
 from django.contrib.localflavor.us.us_states import STATE_CHOICES
 
-from geopy import geocoders
-from geopy.geocoders.google import Google
-
+from spots import instrumentation
+from spots.catalog import city_catalog
 from spots.constants import *
 from spots.managers import *
 from spots.utils import *
@@ -75,9 +76,24 @@ class City(models.Model):
     return City.objects.filter(latitude__range=(self.latitude - radius,self.latitude + radius)).filter(longitude__range=(self.longitude - radius,self.longitude + radius)).exclude(id=self.id)
 
 
-  @permalink
   def get_absolute_url(self):
     """ Returns the URL to this city's detail view page. """
+    record = self.id and city_catalog.get(self.id)
+    if record and record.slug == self.slug:
+      return record.url()
+    return self._get_absolute_url()
+
+
+  def get_state_url(self):
+    """ Returns the URL to the state detail view for the state or province of this city. """
+    record = self.id and city_catalog.get(self.id)
+    if record and record.slug == self.slug:
+      return record.state_url()
+    return self._get_state_url()
+
+
+  @permalink
+  def _get_absolute_url(self):
     if self.country == "us":
       return ('city_detail', None, {'country': slugify(self.country), 'state': slugify(self.state), 'city': slugify(self.city)})
     else:
@@ -86,22 +102,21 @@ class City(models.Model):
       else:
         # Sort of ugly hack -- state detail view will check for cites without a state or province and
         # redirect them to the city detail view if appropriate.
-        return ('state_detail', None, {'country': slugify(self.country), 'state': slugify(self.city)})
+        return ('spot_list_for_state', None, {'country': slugify(self.country), 'state': slugify(self.city)})
 
 
   @permalink
-  def get_state_url(self):
-    """ Returns the URL to the state detail view for the state or province of this city. """
+  def _get_state_url(self):
     if self.country == "us":
-      return ('state_detail', None, {'country': slugify(self.country), 'state': slugify(self.state)})
+      return ('spot_list_for_state', None, {'country': slugify(self.country), 'state': slugify(self.state)})
     else:
-      return ('state_detail', None, {'country': slugify(self.country), 'state': slugify(self.province)})
+      return ('spot_list_for_state', None, {'country': slugify(self.country), 'state': slugify(self.province)})
 
 
   @permalink
   def get_country_url(self):
     """ Returns the URL to the city detail view for the country of this city. """
-    return ('country_detail', None, {'country': slugify(self.country)})
+    return ('spot_list_for_country', None, {'country': slugify(self.country)})
 
   
   def save(self, *args, **kwargs):
@@ -136,14 +151,24 @@ class Neighborhood(models.Model):
     return ", ".join(b for b in (self.name, self.city.full_name()) if b)
 
 
-  @permalink
   def get_absolute_url(self):
-    """ Returns the URL to the detail page for this Neighborhood. """
+    """
+    Returns the URL to the detail page for this Neighborhood. The URL is
+    built from the city catalog, so the city isn't fetched to do it.
+    """
+    record = self.city_id and city_catalog.get(self.city_id)
+    if record:
+      return record.neighborhood_url(self.slug)
+    return self._get_absolute_url()
+
+
+  @permalink
+  def _get_absolute_url(self):
     if self.city.country == "us":
-      return ('neighborhood_detail', None, {'country': slugify(self.city.country), 'state': slugify(self.city.state), 'city': slugify(self.city.city), 'neighborhood_slug': self.slug})
+      return ('spot_list_for_neighborhood', None, {'country': slugify(self.city.country), 'state': slugify(self.city.state), 'city': slugify(self.city.city), 'slug': self.slug})
     else:
       if self.city.province:
-        return ('neighborhood_detail', None, {'country': slugify(self.city.country), 'state': slugify(self.city.province), 'city': slugify(self.city.city), 'neighborhood_slug': self.slug})
+        return ('spot_list_for_neighborhood', None, {'country': slugify(self.city.country), 'state': slugify(self.city.province), 'city': slugify(self.city.city), 'slug': self.slug})
     return
 
 
@@ -163,8 +188,11 @@ class Spot(models.Model):
   city                  = models.ForeignKey(City, blank=True, null=True, related_name="%(class)ss", editable=False)
   neighborhoods         = models.ManyToManyField(Neighborhood, blank=True, null=True, related_name="%(class)ss", editable=False)
   neighborhoods_checked = models.BooleanField(default=False)
-  latitude              = models.DecimalField(blank=True, null=True, max_digits=11, decimal_places=6, editable=False)
-  longitude             = models.DecimalField(blank=True, null=True, max_digits=11, decimal_places=6, editable=False)
+  latitude              = models.DecimalField(blank=True, null=True, max_digits=11, decimal_places=6, editable=False, db_index=True)
+  longitude             = models.DecimalField(blank=True, null=True, max_digits=11, decimal_places=6, editable=False, db_index=True)
+
+  # Changes to these fields mean the spot may need geocoding or its neighborhoods looking up again.
+  TRACKED_FIELDS = ('address', 'latitude', 'longitude', 'city')
 
   
   class Meta:
@@ -175,6 +203,76 @@ class Spot(models.Model):
     return u"%s" % self.address
 
   
+  def get_absolute_url(self):
+    """
+    Returns the URL to this spot's detail page, built from its city's record
+    in the catalog and its slug, or None if its city has no state or
+    province to list it under. Spot models without a slug field should
+    override this.
+    """
+    slug = getattr(self, 'slug', None)
+    record = self.city_id and slug and city_catalog.get(self.city_id)
+    if record:
+      return record.spot_url(slug)
+    return None
+
+
+  def _get_tracked_values(self):
+    """
+    Returns the current values of the tracked fields, keyed by field name.
+    Deferred fields are left out rather than loaded.
+    """
+    values = {}
+    for name in self.TRACKED_FIELDS:
+      field = self._meta.get_field(name)
+      if field.attname not in self.__dict__:
+        continue
+      value = self.__dict__[field.attname]
+      if not field.rel and value not in (None, ''):
+        try:
+          value = field.to_python(value)
+        except (TypeError, ValueError, ValidationError):
+          pass
+      values[name] = value
+    return values
+
+
+  def _remember_tracked_values(self):
+    self._tracked_values = self._get_tracked_values()
+
+
+  def get_changed_fields(self):
+    """
+    Returns the names of the tracked fields that have changed since this spot
+    was loaded or last saved. Every tracked field counts as changed on a spot
+    that hasn't been saved yet.
+    """
+    original = getattr(self, '_tracked_values', None)
+    if not self.pk or original is None:
+      return list(self.TRACKED_FIELDS)
+    current = self._get_tracked_values()
+    return [ name for name in self.TRACKED_FIELDS if name not in original or current.get(name) != original[name] ]
+
+
+  def has_changed(self, *names):
+    """ Returns True if any of the named tracked fields (or any at all, if none are named) has changed. """
+    changed = self.get_changed_fields()
+    return bool([ name for name in (names or self.TRACKED_FIELDS) if name in changed ])
+
+
+  def get_original_location(self):
+    """ Returns the (latitude, longitude) this spot had when it was loaded or last saved. """
+    original = getattr(self, '_tracked_values', {})
+    return (original.get('latitude'), original.get('longitude'))
+
+
+  def get_original_city(self):
+    """ Returns the City this spot was in when it was loaded or last saved, or None. """
+    city_id = getattr(self, '_tracked_values', {}).get('city')
+    record = city_id and city_catalog.get(city_id)
+    return record and record.to_city() or None
+
+
   def location(self):
     """
     Returns a tuple of this spot, like (latitude, longitude).
@@ -193,9 +291,16 @@ class Spot(models.Model):
   def nearby_spots(self, num=10, mile_limit=25):
     """ 
     Returns the "num" closest spots to this one. Limits to spots within
-    a given mile_limit, which defaults to 25 miles.
+    a given mile_limit, which defaults to 25 miles. If the precomputed
+    SpotNeighbor table holds enough neighbours, they're read from there;
+    spots it has none for yet are searched for.
     """
     from django.template.defaultfilters import dictsort
+    from spots.neighbors import NEIGHBOR_COUNT, NEIGHBOR_MILE_LIMIT, get_nearby_spots
+    if num is not None and num <= NEIGHBOR_COUNT and mile_limit <= NEIGHBOR_MILE_LIMIT:
+      nearby = get_nearby_spots(self, num, mile_limit)
+      if nearby is not None:
+        return nearby
     spots_within_limit = self.__class__.objects.within_radius_of_location(
       location=self.location(), 
       radius_miles=mile_limit,
@@ -213,13 +318,7 @@ class Spot(models.Model):
     """ 
     Returns the distance, in miles, between the current Spot and a (lat, lng) tuple.
     """
-    import math
-    latitude, longitude = location
-    rad = math.pi / 180.0
-    y_distance = (float(latitude) - float(self.latitude)) * 69.04
-    x_distance = (math.cos(float(self.latitude) * rad) + math.cos(float(latitude) * rad)) * (float(longitude) - float(self.longitude)) * (69.04 / 2)
-    distance = math.sqrt( y_distance**2 + x_distance**2 )
-    return distance
+    return get_distance_between_locations(self.location(), location)
 
   
   def _get_distance_to_spot(self, spot):
@@ -230,17 +329,7 @@ class Spot(models.Model):
 
   
   def _get_bearing_to_location(self, location):
-    import math
-    latitude, longitude = location
-    lat1 = float(latitude)
-    lat2 = float(self.latitude)
-    lon1 = float(longitude)
-    lon2 = float(self.longitude)
-    dLon = lon2 - lon1
-    y = math.sin(dLon) * math.cos(lat2)
-    x = math.cos(lat1) * math.sin(lat2) - math.sin(lat1) * math.cos(lat2) * math.cos(dLon)
-    degrees_180 = math.degrees(math.atan2(y, x))
-    return (degrees_180 + 360) % 360
+    return get_bearing_between_locations(self.location(), location)
  
   
   def _get_bearing_to_spot(self, spot):
@@ -304,34 +393,47 @@ class Spot(models.Model):
     return get_city_from_address(self.address)
 
 
-  def _set_address(self, save=True):
-    if self.latitude and self.longitude and not self.address:
+  def _set_address(self, save=True, force=False):
+    """
+    Fills in a missing address by reverse geocoding the spot's location. This
+    is only tried when the location has changed, or always if force is True;
+    an address that's already there is never replaced.
+    """
+    if force or self.has_changed('latitude', 'longitude'):
+      if self.latitude and self.longitude and not self.address:
         self.address = self._get_address_from_location()
     if save:
       self.save()
 
   
-  def _set_city(self, save=True):
-    if self.latitude and self.longitude and not self.city:
+  def _set_city(self, save=True, force=False):
+    """
+    Fills in a missing city from the spot's location or address. This is only
+    tried when they have changed, or always if force is True; a city that's
+    already set is never replaced.
+    """
+    if force or self.has_changed('address', 'latitude', 'longitude'):
+      if self.latitude and self.longitude and not self.city:
         self.city = self._get_city_from_location()
-    if self.address and not self.city:
-      self.city = self._get_city_from_address()
+      if self.address and not self.city:
+        self.city = self._get_city_from_address()
     if save:
       self.save()
 
 
-  def _update_neighborhoods(self, save=True):
+  def _update_neighborhoods(self, save=True, force=False):
     """
     Gets the neighborhoods associated with this spot from Urban Mapping, creates
-    them if necessary, and relates them to this spot.
+    them if necessary, and relates them to this spot. Moving a spot marks its
+    neighborhoods as unchecked, so they're only looked up again when they may
+    have changed, or always if force is True.
     """
-    if hasattr(settings, 'URBAN_MAPPING_API_KEY') and not self.neighborhoods_checked:
+    if hasattr(settings, 'URBAN_MAPPING_API_KEY') and (force or not self.neighborhoods_checked):
       self.neighborhoods.clear()
       urban_mapping_api = UrbanMappingClient(method="getNeighborhoodsByLatLng")
       params = { 'apikey': settings.URBAN_MAPPING_API_KEY, 'lat': self.latitude, 'lng': self.longitude, 'results': 'many' }
       try:
-        import time
-        time.sleep(2)
+        instrumentation.sleep(2, 'urban_mapping')
         neighborhoods = urban_mapping_api(**params)
         for neighborhood in neighborhoods.getiterator('neighborhood'):
           neighborhood_name = neighborhood.find('name').text.replace('  ', '').replace('\n', '').replace('\t', '')
@@ -347,3 +449,112 @@ class Spot(models.Model):
       if save:
         self.save()
     return self
+
+
+  def update_location_details(self, force=False):
+    """
+    Fills in the address and city, saves the spot, and looks up its
+    neighborhoods, doing each only if the fields it depends on have changed.
+    Pass force=True to try them all regardless; the address and city are
+    still only filled in if they're missing.
+    """
+    self._set_address(save=False, force=force)
+    self._set_city(save=False, force=force)
+    self.save()
+    return self._update_neighborhoods(force=force)
+
+
+
+
+
+def get_spot_models():
+  """ Returns all the installed models that subclass Spot. """
+  return [ model for model in models.get_models() if issubclass(model, Spot) ]
+
+
+def get_default_spot_model():
+  """
+  Returns the spot model views list when they aren't given a queryset: the
+  one named by SPOTS_DEFAULT_MODEL, as "app_label.ModelName", or else the
+  only installed spot model. Raises ImproperlyConfigured if there's no
+  telling which.
+  """
+  label = getattr(settings, 'SPOTS_DEFAULT_MODEL', None)
+  if label:
+    model = models.get_model(*label.split('.'))
+    if model is None or not issubclass(model, Spot):
+      raise ImproperlyConfigured("SPOTS_DEFAULT_MODEL should name an installed spot model, not %r." % label)
+    return model
+  spot_models = get_spot_models()
+  if len(spot_models) != 1:
+    raise ImproperlyConfigured("There are %d spot models installed; set SPOTS_DEFAULT_MODEL to the one views should list, or pass them a queryset." % len(spot_models))
+  return spot_models[0]
+
+
+
+
+class SpotNeighbor(models.Model):
+  """
+  One of a spot's nearest neighbours, with the distance (in miles) and bearing
+  to it. Spot is abstract, so spots of any model are referred to by content
+  type and id. These are maintained by spots.neighbors.
+  """
+  content_type  = models.ForeignKey(ContentType)
+  object_id     = models.PositiveIntegerField()
+  neighbor_id   = models.PositiveIntegerField(db_index=True)
+  rank          = models.PositiveSmallIntegerField()
+  distance      = models.FloatField()
+  bearing       = models.FloatField()
+
+
+  def __unicode__(self):
+    return u"%s -> %s" % (self.object_id, self.neighbor_id)
+
+
+  class Meta:
+    unique_together = (('content_type', 'object_id', 'rank'),)
+
+
+
+
+class SpotChange(models.Model):
+  """
+  The latest change to a spot, city or neighborhood, for clients syncing by
+  deltas. Each object keeps one row, replaced whenever it's saved or
+  deleted, so the ids form a modification sequence and deletions are kept
+  as tombstones. These are maintained by spots.changes.
+  """
+  ACTION_CHOICES = (
+    ('saved', 'Saved'),
+    ('deleted', 'Deleted'),
+  )
+  content_type  = models.ForeignKey(ContentType)
+  object_id     = models.PositiveIntegerField()
+  action        = models.CharField(max_length=10, choices=ACTION_CHOICES)
+  changed       = models.DateTimeField(auto_now_add=True)
+
+  objects       = SpotChangeManager()
+
+
+  def __unicode__(self):
+    return u"%s %s %s" % (self.content_type, self.object_id, self.action)
+
+
+  class Meta:
+    ordering = ('id',)
+
+
+
+
+def _spot_model_prepared(sender, **kwargs):
+  """
+  Connects the receivers in spots.signals for each concrete spot model as
+  it's defined. Spot models live in other modules, which import this one
+  first, so spots.signals and the modules it wires up can import models
+  from here without a cycle.
+  """
+  if issubclass(sender, Spot) and not sender._meta.abstract:
+    from spots.signals import connect_spot_model
+    connect_spot_model(sender)
+
+signals.class_prepared.connect(_spot_model_prepared)
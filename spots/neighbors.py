@@ -0,0 +1,239 @@
+import heapq
+import math
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection, transaction
+
+from spots.export import filter_by_bbox
+from spots.models import SpotNeighbor
+from spots.utils import get_bearing_between_locations, get_bounding_box, get_compass_direction_from_bearing, get_distance_between_locations
+
+
+NEIGHBOR_COUNT = getattr(settings, 'SPOTS_NEIGHBOR_COUNT', 10)
+NEIGHBOR_MILE_LIMIT = getattr(settings, 'SPOTS_NEIGHBOR_MILE_LIMIT', 25)
+MAX_NEIGHBOR_REFRESH = getattr(settings, 'SPOTS_MAX_NEIGHBOR_REFRESH', 100)
+BATCH_SIZE = 1000
+
+
+
+
+class SpotGrid(object):
+  """
+  Buckets (id, latitude, longitude) rows into cells "miles" tall, so the spots
+  near a location can be found without comparing it against every spot.
+  """
+  def __init__(self, rows, miles=NEIGHBOR_MILE_LIMIT):
+    self.cell_size = float(miles) / 69.04
+    self.cells = {}
+    for row in rows:
+      self.cells.setdefault(self._cell(row[1], row[2]), []).append(row)
+
+  def _cell(self, latitude, longitude):
+    return (int(math.floor(latitude / self.cell_size)), int(math.floor(longitude / self.cell_size)))
+
+  def near(self, latitude, longitude):
+    """ Yields the rows in every cell that can hold spots within "miles" of the location. """
+    row, column = self._cell(latitude, longitude)
+    # Cells are as wide as they are tall in degrees, so away from the equator
+    # more of them are needed to cover the same number of miles.
+    span = int(math.ceil(1 / max(math.cos(math.radians(latitude)), 0.01)))
+    for cell_row in (row - 1, row, row + 1):
+      for cell_column in range(column - span, column + span + 1):
+        for spot in self.cells.get((cell_row, cell_column), ()):
+          yield spot
+
+
+def get_spot_rows(queryset):
+  """ Returns (id, latitude, longitude) float rows for the located spots in a queryset. """
+  return [ (id, float(latitude), float(longitude)) for id, latitude, longitude in queryset.values_list('id', 'latitude', 'longitude').iterator() if latitude is not None and longitude is not None ]
+
+
+def rank_neighbors(origin, candidates, count=NEIGHBOR_COUNT, miles=NEIGHBOR_MILE_LIMIT):
+  """
+  Returns (distance, neighbor_id, bearing) tuples for the "count" candidate
+  rows closest to the origin row, nearest first, leaving out the origin and
+  anything further than "miles" away.
+  """
+  id, latitude, longitude = origin
+  ranked = []
+  for candidate_id, candidate_latitude, candidate_longitude in candidates:
+    if candidate_id == id:
+      continue
+    distance = get_distance_between_locations((latitude, longitude), (candidate_latitude, candidate_longitude))
+    if distance <= miles:
+      ranked.append((distance, candidate_id, candidate_latitude, candidate_longitude))
+  return [ (distance, neighbor_id, get_bearing_between_locations((latitude, longitude), (neighbor_latitude, neighbor_longitude))) for distance, neighbor_id, neighbor_latitude, neighbor_longitude in heapq.nsmallest(count, ranked) ]
+
+
+
+
+def _insert_neighbors(content_type, neighbor_lists):
+  """
+  Inserts the rows for a dict mapping spot ids to the lists returned by
+  rank_neighbors. Rows go in with executemany, BATCH_SIZE at a time.
+  """
+  qn = connection.ops.quote_name
+  columns = ('content_type_id', 'object_id', 'neighbor_id', 'rank', 'distance', 'bearing')
+  sql = "INSERT INTO %s (%s) VALUES (%s)" % (qn(SpotNeighbor._meta.db_table), ", ".join([ qn(column) for column in columns ]), ", ".join(["%s"] * len(columns)))
+  cursor = connection.cursor()
+  batch = []
+  for object_id, neighbors in neighbor_lists.iteritems():
+    for rank, (distance, neighbor_id, bearing) in enumerate(neighbors):
+      batch.append((content_type.id, object_id, neighbor_id, rank, distance, bearing))
+      if len(batch) >= BATCH_SIZE:
+        cursor.executemany(sql, batch)
+        batch = []
+  if batch:
+    cursor.executemany(sql, batch)
+  transaction.commit_unless_managed()
+
+
+def save_neighbors(content_type, neighbor_lists):
+  """ Replaces the stored neighbours of the spots in neighbor_lists. """
+  object_ids = neighbor_lists.keys()
+  for start in range(0, len(object_ids), BATCH_SIZE):
+    SpotNeighbor.objects.filter(content_type=content_type, object_id__in=object_ids[start:start + BATCH_SIZE]).delete()
+  _insert_neighbors(content_type, neighbor_lists)
+
+
+def rebuild_neighbors(model):
+  """
+  Recomputes the neighbours of every spot of the given model from scratch.
+  All the spots' coordinates are bucketed in a SpotGrid, so each spot is only
+  compared with the spots in the cells around it. Returns the number of spots.
+  """
+  content_type = ContentType.objects.get_for_model(model)
+  rows = get_spot_rows(model._default_manager.all())
+  grid = SpotGrid(rows)
+  cursor = connection.cursor()
+  cursor.execute("DELETE FROM %s WHERE %s = %%s" % (connection.ops.quote_name(SpotNeighbor._meta.db_table), connection.ops.quote_name('content_type_id')), [content_type.id])
+  neighbor_lists = {}
+  for row in rows:
+    neighbor_lists[row[0]] = rank_neighbors(row, grid.near(row[1], row[2]))
+    if len(neighbor_lists) >= BATCH_SIZE:
+      _insert_neighbors(content_type, neighbor_lists)
+      neighbor_lists = {}
+  _insert_neighbors(content_type, neighbor_lists)
+  return len(rows)
+
+
+def rank_neighbors_around(model, row, miles=NEIGHBOR_MILE_LIMIT):
+  """
+  Ranks the neighbours of a spot row against the spots of the model within
+  "miles" of it, read from the database.
+  """
+  candidates = get_spot_rows(filter_by_bbox(model._default_manager.all(), get_bounding_box(row[1:], miles)))
+  return rank_neighbors(row, candidates, miles=miles)
+
+
+def get_stored_neighbors(content_type, object_ids):
+  """
+  Returns a dict mapping each spot id to its stored neighbours, as the
+  (distance, neighbor_id, bearing) lists rank_neighbors returns.
+  """
+  neighbor_lists = dict([ (object_id, []) for object_id in object_ids ])
+  for start in range(0, len(object_ids), BATCH_SIZE):
+    rows = SpotNeighbor.objects.filter(content_type=content_type, object_id__in=object_ids[start:start + BATCH_SIZE]).order_by('object_id', 'rank')
+    for object_id, distance, neighbor_id, bearing in rows.values_list('object_id', 'distance', 'neighbor_id', 'bearing'):
+      neighbor_lists[object_id].append((distance, neighbor_id, bearing))
+  return neighbor_lists
+
+
+def get_farthest_neighbor_distances(content_type, object_ids):
+  """
+  Returns a dict mapping the ids of the spots with a full list of
+  NEIGHBOR_COUNT stored neighbours to the distance to the farthest of them.
+  """
+  distances = {}
+  for start in range(0, len(object_ids), BATCH_SIZE):
+    rows = SpotNeighbor.objects.filter(content_type=content_type, object_id__in=object_ids[start:start + BATCH_SIZE], rank=NEIGHBOR_COUNT - 1)
+    distances.update(rows.values_list('object_id', 'distance'))
+  return distances
+
+
+def refresh_neighbors_of(model, spot_id, location=None):
+  """
+  Brings the stored neighbours up to date after the spot with the given id
+  is created or moved to a (latitude, longitude) location, or deleted, when
+  there's no location. The spot's own neighbours are ranked afresh, but the
+  only other spots touched are those that listed it, and those it's now no
+  further from than their farthest stored neighbour, which it's merged into.
+  Spots it has moved away from are ranked again against the spots around
+  them. If more than MAX_NEIGHBOR_REFRESH spots would change, they're left
+  for the rebuild_spot_neighbors command.
+  """
+  content_type = ContentType.objects.get_for_model(model)
+  listed_by = set(SpotNeighbor.objects.filter(content_type=content_type, neighbor_id=spot_id).values_list('object_id', flat=True))
+  neighbor_lists = {}
+  gained = {}
+  if location is not None and None not in location:
+    origin = (spot_id, float(location[0]), float(location[1]))
+    nearby = get_spot_rows(filter_by_bbox(model._default_manager.all(), get_bounding_box(location, NEIGHBOR_MILE_LIMIT)))
+    neighbor_lists[spot_id] = rank_neighbors(origin, nearby)
+    for id, latitude, longitude in nearby:
+      distance = get_distance_between_locations((latitude, longitude), origin[1:])
+      if id != spot_id and distance <= NEIGHBOR_MILE_LIMIT:
+        gained[id] = (distance, spot_id, get_bearing_between_locations((latitude, longitude), origin[1:]))
+    farthest = get_farthest_neighbor_distances(content_type, gained.keys())
+    gained = dict([ (id, neighbor) for id, neighbor in gained.iteritems() if id not in farthest or neighbor[0] <= farthest[id] ])
+  stale = listed_by.union(gained)
+  stale.discard(spot_id)
+  if len(stale) > MAX_NEIGHBOR_REFRESH:
+    stale = set()
+  stored = get_stored_neighbors(content_type, list(stale))
+  rerank = []
+  for id in stale:
+    neighbors = [ neighbor for neighbor in stored[id] if neighbor[1] != spot_id ]
+    if id in gained:
+      neighbors = sorted(neighbors + [gained[id]])[:NEIGHBOR_COUNT]
+    if len(neighbors) < len(stored[id]) == NEIGHBOR_COUNT:
+      # The spot has left a full list, so whatever is next nearest, beyond
+      # the rest of the list, has to be looked for.
+      rerank.append(id)
+    else:
+      neighbor_lists[id] = neighbors
+  if rerank:
+    for row in get_spot_rows(model._default_manager.filter(id__in=rerank)):
+      # The search starts at twice the old farthest neighbour, which is
+      # enough unless spots are sparse further out.
+      miles = min(stored[row[0]][-1][0] * 2, NEIGHBOR_MILE_LIMIT)
+      neighbor_lists[row[0]] = rank_neighbors_around(model, row, miles)
+      if len(neighbor_lists[row[0]]) < NEIGHBOR_COUNT and miles < NEIGHBOR_MILE_LIMIT:
+        neighbor_lists[row[0]] = rank_neighbors_around(model, row)
+  if neighbor_lists:
+    save_neighbors(content_type, neighbor_lists)
+
+
+def get_nearby_spots(spot, num=NEIGHBOR_COUNT, mile_limit=NEIGHBOR_MILE_LIMIT):
+  """
+  Returns the "num" closest spots to a spot within mile_limit, as dicts like
+  Spot.nearby_spots returns, read from the SpotNeighbor table. Returns None
+  if the table holds no neighbours for the spot, as it won't until
+  rebuild_spot_neighbors has been run.
+  """
+  content_type = ContentType.objects.get_for_model(spot)
+  neighbors = list(SpotNeighbor.objects.filter(content_type=content_type, object_id=spot.pk).order_by('rank')[:num])
+  if not neighbors:
+    return None
+  neighbors = [ neighbor for neighbor in neighbors if neighbor.distance <= mile_limit ]
+  spots = spot.__class__._default_manager.in_bulk([ neighbor.neighbor_id for neighbor in neighbors ])
+  return [ {'distance': neighbor.distance, 'spot': spots[neighbor.neighbor_id], 'direction': get_compass_direction_from_bearing(neighbor.bearing)} for neighbor in neighbors if neighbor.neighbor_id in spots ]
+
+
+
+
+def spot_saved(sender, instance, **kwargs):
+  """
+  Signal handler refreshing the neighbours of a spot that has been created or
+  moved, and of the spots around it. Spots that didn't move leave the
+  neighbours alone.
+  """
+  if getattr(instance, '_cache_locations', [instance.location()]):
+    refresh_neighbors_of(sender, instance.pk, instance.location())
+
+
+def spot_deleted(sender, instance, **kwargs):
+  """ Signal handler dropping a deleted spot's neighbours and refreshing the spots that listed it. """
+  SpotNeighbor.objects.filter(content_type=ContentType.objects.get_for_model(sender), object_id=instance.pk).delete()
+  refresh_neighbors_of(sender, instance.pk)
@@ -0,0 +1,144 @@
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.utils.functional import wraps
+
+
+READ_DATABASES = getattr(settings, 'SPOTS_READ_DATABASES', ())
+PIN_COOKIE = getattr(settings, 'SPOTS_PRIMARY_PIN_COOKIE', 'spots_primary')
+PIN_SECONDS = getattr(settings, 'SPOTS_PRIMARY_PIN_SECONDS', 10)
+
+_state = threading.local()
+
+
+
+
+def get_read_database():
+  """
+  Returns the alias of the database to read spots from. That's a replica
+  from SPOTS_READ_DATABASES inside a read-only view, unless the user wrote
+  something recently or the current request has written; otherwise it's
+  "default", the primary.
+  """
+  if getattr(_state, 'pinned', False):
+    return 'default'
+  return getattr(_state, 'replica', None) or 'default'
+
+
+def pin_primary(sender=None, **kwargs):
+  """
+  Sends the rest of the current request's reads to the primary. Connected to
+  the save and delete signals, so reads that follow a write to a spots model
+  see it.
+  """
+  if sender is None or _is_spots_model(sender):
+    _state.pinned = True
+
+
+def _is_pinned(request):
+  try:
+    return float(request.COOKIES.get(PIN_COOKIE, 0)) > time.time()
+  except ValueError:
+    return False
+
+
+def read_from_replica(view):
+  """
+  Decorator for read-only spots views, sending their reads to a replica. A
+  user who wrote something in the last SPOTS_PRIMARY_PIN_SECONDS keeps
+  reading from the primary, so they see their own changes. When decorated
+  views call each other, the outermost one picks the replica for the whole
+  request.
+  """
+  def _wrapped(request, *args, **kwargs):
+    depth = getattr(_state, 'depth', 0)
+    if not depth:
+      _state.pinned = _is_pinned(request)
+      _state.replica = READ_DATABASES and random.choice(READ_DATABASES) or None
+    _state.depth = depth + 1
+    try:
+      return view(request, *args, **kwargs)
+    finally:
+      _state.depth = depth
+      if not depth:
+        _state.pinned = False
+        _state.replica = None
+  return wraps(view)(_wrapped)
+
+
+def using_read_database(queryset):
+  """
+  Returns the queryset bound to the database get_read_database() returns
+  now. Querysets that are evaluated after the view has returned, like those
+  streamed into a response, need it, as the choice is forgotten by then.
+  Without multiple database support, the queryset is returned as it is.
+  """
+  if hasattr(queryset, 'using'):
+    return queryset.using(get_read_database())
+  return queryset
+
+
+def using_primary(queryset):
+  """
+  Returns the queryset bound to the primary, wherever the current view is
+  reading from. The in-memory indexes load and catch up with it: they move
+  on to the change feed cursor they read, so reading from a lagging replica
+  would skip changes for good. Without multiple database support, the
+  queryset is returned as it is.
+  """
+  if hasattr(queryset, 'using'):
+    return queryset.using('default')
+  return queryset
+
+
+def pin_primary_after_write(view):
+  """
+  Decorator for views that write spots. After a POST, the user's reads stick
+  to the primary for SPOTS_PRIMARY_PIN_SECONDS, until the replicas have
+  caught up.
+  """
+  def _wrapped(request, *args, **kwargs):
+    response = view(request, *args, **kwargs)
+    if request.method == 'POST' and READ_DATABASES:
+      response.set_cookie(PIN_COOKIE, str(int(time.time() + PIN_SECONDS)), max_age=PIN_SECONDS)
+    return response
+  return wraps(view)(_wrapped)
+
+
+def _is_spots_model(model):
+  from spots.models import Spot
+  return model._meta.app_label == 'spots' or issubclass(model, Spot)
+
+
+
+
+class SpotsReplicaRouter(object):
+  """
+  A database router for Django's multiple database support. Add it to
+  DATABASE_ROUTERS and list the replica aliases in SPOTS_READ_DATABASES.
+  Reads of spots, cities and neighborhoods go where get_read_database() says;
+  all writes, and every other app's models, are left on the default database.
+  Without multiple database support, the router is simply never consulted
+  and everything reads from the one database.
+  """
+  def db_for_read(self, model, **hints):
+    if _is_spots_model(model):
+      return get_read_database()
+    return None
+
+  def db_for_write(self, model, **hints):
+    if _is_spots_model(model):
+      return 'default'
+    return None
+
+  def allow_relation(self, obj1, obj2, **hints):
+    if _is_spots_model(obj1.__class__) or _is_spots_model(obj2.__class__):
+      return True
+    return None
+
+  def allow_syncdb(self, db, model):
+    if _is_spots_model(model):
+      return db == 'default'
+    return None
@@ -0,0 +1,119 @@
+from spots.catalog import city_catalog
+
+
+ROW_FIELDS = ('id', 'address', 'latitude', 'longitude', 'city')
+# Ids looked up per query by the in_bulk helpers. SQLite allows at most 999
+# parameters in a query, and huge IN clauses are slow everywhere else.
+BULK_SIZE = 500
+
+
+
+
+def get_spot_url(city_id, slug):
+  """ Returns the URL of the spot with the given slug in a city, from the city catalog, or None. """
+  record = city_id and slug and city_catalog.get(city_id)
+  if record:
+    return record.spot_url(slug)
+  return None
+
+
+
+
+class SpotRow(object):
+  """
+  A compact, read-only stand-in for a spot, holding just what lists, maps
+  and exports need: id, address, coordinates, city id, slug (if the model has
+  one) and URL. The URL is worked out when the row is made, from the city
+  catalog. Rows have the location() and get_absolute_url() of a spot, so
+  templates and distance helpers can use them in place of spots.
+  """
+  __slots__ = ('id', 'address', 'latitude', 'longitude', 'city_id', 'slug', 'url')
+
+  def __init__(self, id, address, latitude, longitude, city_id, slug=None):
+    self.id = id
+    self.address = address
+    self.latitude = latitude
+    self.longitude = longitude
+    self.city_id = city_id
+    self.slug = slug
+    self.url = get_spot_url(city_id, slug)
+
+  @property
+  def pk(self):
+    return self.id
+
+  @property
+  def city(self):
+    record = self.city_id and city_catalog.get(self.city_id)
+    return record and record.to_city() or None
+
+  def __unicode__(self):
+    return u"%s" % self.address
+
+  def __eq__(self, other):
+    return isinstance(other, SpotRow) and self.id == other.id
+
+  def __ne__(self, other):
+    return not self == other
+
+  def __hash__(self):
+    return hash(self.id)
+
+  def location(self):
+    return (self.latitude, self.longitude)
+
+  def get_absolute_url(self):
+    return self.url
+
+
+
+
+def get_row_fields(model):
+  """ Returns the fields to fetch for rows of the given spot model. """
+  if 'slug' in [ field.name for field in model._meta.fields ]:
+    return ROW_FIELDS + ('slug',)
+  return ROW_FIELDS
+
+
+def get_spot_rows(queryset):
+  """
+  Returns a SpotRow for each spot in the queryset, keeping its order and
+  slicing. Only the row fields are selected, so no model instances are made
+  and subclass tables that aren't needed aren't joined.
+  """
+  return [ SpotRow(*values) for values in queryset.values_list(*get_row_fields(queryset.model)).iterator() ]
+
+
+def iterate_spot_rows_in_chunks(queryset, chunk_size=None):
+  """
+  Yields a SpotRow for each spot in the queryset, ordered by id. The rows are
+  fetched with spots.export.iterate_in_chunks, so however large the queryset
+  is, only one chunk of it is held in memory. Sliced querysets can't be
+  paged like this; use get_spot_rows for those.
+  """
+  from spots.export import CHUNK_SIZE, iterate_in_chunks
+  fields = get_row_fields(queryset.model)
+  for values in iterate_in_chunks(queryset, fields, chunk_size or CHUNK_SIZE):
+    yield SpotRow(*[ values[field] for field in fields ])
+
+
+def get_in_bulk(queryset, ids):
+  """ Like queryset.in_bulk(ids), but looks the ids up BULK_SIZE at a time. """
+  ids = list(ids)
+  objects = {}
+  for start in range(0, len(ids), BULK_SIZE):
+    objects.update(queryset.in_bulk(ids[start:start + BULK_SIZE]))
+  return objects
+
+
+def get_spot_rows_in_bulk(queryset, ids):
+  """
+  Returns a dict mapping each of the given ids to its SpotRow, like in_bulk().
+  The ids are looked up BULK_SIZE at a time.
+  """
+  ids = list(ids)
+  rows = {}
+  for start in range(0, len(ids), BULK_SIZE):
+    for row in get_spot_rows(queryset.filter(id__in=ids[start:start + BULK_SIZE])):
+      rows[row.id] = row
+  return rows
@@ -0,0 +1,300 @@
+import heapq
+import re
+import threading
+import time
+
+from django.conf import settings
+from django.core.signals import request_started
+
+from spots.autocomplete import normalize_name
+from spots.cache import bump_scope_generation, get_scope_generation
+from spots.catalog import city_catalog
+from spots.export import CHUNK_SIZE, iterate_in_chunks
+
+
+SCOPE = 'search'
+CHECK_INTERVAL = getattr(settings, 'SPOTS_SEARCH_CHECK_INTERVAL', 5)
+MIN_SCORE = getattr(settings, 'SPOTS_SEARCH_MIN_SCORE', 0.3)
+# Text scores are divided by 1 + distance / DISTANCE_SCALE, so a spot this many
+# miles away needs twice the text score of one right here to rank the same.
+DISTANCE_SCALE = getattr(settings, 'SPOTS_SEARCH_DISTANCE_SCALE', 10.0)
+# The most text matches search_spots considers, however many spots match.
+MAX_CANDIDATES = getattr(settings, 'SPOTS_SEARCH_MAX_CANDIDATES', 1000)
+
+_request_local = threading.local()
+_word_re = re.compile(r'[a-z0-9]+')
+
+
+
+
+def get_trigrams(text):
+  """
+  Returns the set of trigrams of the words in a string, after folding it to
+  lowercase ASCII. Words are padded, so short words and word starts count.
+  """
+  trigrams = set()
+  for word in _word_re.findall(normalize_name(text or '')):
+    word = "  %s " % word
+    for i in range(len(word) - 2):
+      trigrams.add(word[i:i + 3])
+  return trigrams
+
+
+def _model_label(model):
+  return "%s.%s" % (model._meta.app_label, model._meta.module_name)
+
+
+
+
+class TextIndex(object):
+  """
+  An in-process trigram index over spot addresses, city names (as
+  full_name_ascii()) and neighborhood names. Documents are keyed by
+  (kind, id), where kind is "city", "neighborhood" or a spot model's
+  "app_label.modelname".
+
+  The index is built on first use. Saves and deletes in this process that
+  change an indexed name update it in place, and bump the "search"
+  generation in the shared cache. If the generation moves on for any other
+  reason, another process changed something, and the index catches up by
+  re-indexing just the objects in the change feed (see spots.changes) since
+  it last looked. Like the city catalog, the generation is checked once per
+  request, and at most every CHECK_INTERVAL seconds outside of requests; if
+  the cache doesn't keep it, the change feed is checked instead. As with
+  the catalog, loads and catch-ups read from the primary.
+  """
+  def __init__(self):
+    self.lock = threading.RLock()
+    self.generation = None
+    self.cursor = None
+    self.postings = {}
+    self.documents = {}
+
+  def _add(self, key, text):
+    self._remove(key)
+    trigrams = get_trigrams(text)
+    if not trigrams:
+      return
+    for trigram in trigrams:
+      self.postings.setdefault(trigram, set()).add(key)
+    self.documents[key] = (len(trigrams), trigrams)
+
+  def _remove(self, key):
+    document = self.documents.pop(key, None)
+    if document is None:
+      return
+    for trigram in document[1]:
+      keys = self.postings.get(trigram)
+      if keys is not None:
+        keys.discard(key)
+        if not keys:
+          del self.postings[trigram]
+
+  def _load(self):
+    from spots.changes import get_latest_cursor
+    from spots.models import Neighborhood, get_spot_models
+    from spots.routers import using_primary
+    # Take the cursor first, so objects changed during the load are caught up on.
+    cursor = get_latest_cursor()
+    self.postings, self.documents = {}, {}
+    records, revision = city_catalog.records()
+    for record in records:
+      self._add(('city', record.id), record.full_name_ascii)
+    for row in iterate_in_chunks(using_primary(Neighborhood.objects.all()), ('name',)):
+      self._add(('neighborhood', row['id']), row['name'])
+    for model in get_spot_models():
+      label = _model_label(model)
+      for row in iterate_in_chunks(using_primary(model._default_manager.all()), ('address',), CHUNK_SIZE):
+        self._add((label, row['id']), row['address'])
+    # Changes that hadn't settled when the cursor was taken may not have
+    # been loaded, so the next check catches up.
+    self.generation = None
+    self.cursor = cursor
+
+  def _catch_up(self, generation):
+    from spots.changes import get_changed_objects_since
+    from spots.models import City, Neighborhood, get_spot_models
+    from spots.routers import using_primary
+    from spots.rows import BULK_SIZE
+    fields = {City: None, Neighborhood: 'name'}
+    for model in get_spot_models():
+      fields[model] = 'address'
+    changed, cursor, settled = get_changed_objects_since(self.cursor, fields.keys())
+    ids_by_model = {}
+    for model, id in changed:
+      ids_by_model.setdefault(model, []).append(id)
+    for model, ids in ids_by_model.items():
+      if model is City:
+        kind, texts = 'city', {}
+        for id in ids:
+          record = city_catalog.get(id)
+          if record is not None:
+            texts[id] = record.full_name_ascii
+      else:
+        kind = model is Neighborhood and 'neighborhood' or _model_label(model)
+        texts = {}
+        for start in range(0, len(ids), BULK_SIZE):
+          texts.update(dict(using_primary(model._default_manager.filter(id__in=ids[start:start + BULK_SIZE])).values_list('id', fields[model])))
+      for id in ids:
+        if id in texts:
+          self._add((kind, id), texts[id])
+        else:
+          self._remove((kind, id))
+    # Until every change has settled, the generation is forgotten, so the
+    # next check catches up again.
+    self.generation = settled and generation or None
+    self.cursor = cursor
+
+  def _ensure_current(self):
+    now = time.time()
+    checked_at = getattr(_request_local, 'checked_at', None)
+    if self.cursor is not None and checked_at is not None and now - checked_at < CHECK_INTERVAL:
+      return
+    generation = get_scope_generation(SCOPE)
+    self.lock.acquire()
+    try:
+      if self.cursor is None:
+        self._load()
+      elif generation is None or generation != self.generation:
+        self._catch_up(generation)
+    finally:
+      self.lock.release()
+    _request_local.checked_at = now
+
+  def search(self, query, kinds=None, limit=None):
+    """
+    Returns (score, kind, id) for the documents matching a query, best first.
+    The score is the Dice coefficient of the query's and the document's
+    trigrams, between 0 and 1; documents scoring under MIN_SCORE are left
+    out. Pass kinds to only search documents of those kinds, and limit to
+    only keep that many of the best, without sorting the rest.
+    """
+    trigrams = get_trigrams(query)
+    if not trigrams:
+      return []
+    self._ensure_current()
+    self.lock.acquire()
+    try:
+      common = {}
+      for trigram in trigrams:
+        for key in self.postings.get(trigram, ()):
+          if kinds is None or key[0] in kinds:
+            common[key] = common.get(key, 0) + 1
+      results = []
+      for key, count in common.iteritems():
+        score = 2.0 * count / (len(trigrams) + self.documents[key][0])
+        if score >= MIN_SCORE:
+          results.append((score, key[0], key[1]))
+    finally:
+      self.lock.release()
+    if limit is not None:
+      return heapq.nlargest(limit, results)
+    results.sort(reverse=True)
+    return results
+
+  def _changed(self, key, text):
+    self.lock.acquire()
+    try:
+      generation = bump_scope_generation(SCOPE)
+      if self.cursor is None or generation != self.generation + 1:
+        # Someone else changed something too; catch up on next use.
+        _request_local.checked_at = None
+        return
+      if text is None:
+        self._remove(key)
+      else:
+        self._add(key, text)
+      self.generation = generation
+    finally:
+      self.lock.release()
+
+  def city_saved(self, sender, instance, **kwargs):
+    """ Signal handler indexing a saved City. """
+    self._changed(('city', instance.id), instance.full_name_ascii())
+
+  def neighborhood_saved(self, sender, instance, **kwargs):
+    """ Signal handler indexing a saved Neighborhood. """
+    self._changed(('neighborhood', instance.id), instance.name)
+
+  def spot_saved(self, sender, instance, created=False, **kwargs):
+    """
+    Signal handler indexing a saved spot. Saves that leave the address alone
+    don't touch the index, or make other processes catch up.
+    """
+    if created or 'address' in instance.get_changed_fields():
+      self._changed((_model_label(sender), instance.pk), instance.address)
+
+  def city_deleted(self, sender, instance, **kwargs):
+    """ Signal handler dropping a deleted City from the index. """
+    self._changed(('city', instance.id), None)
+
+  def neighborhood_deleted(self, sender, instance, **kwargs):
+    """ Signal handler dropping a deleted Neighborhood from the index. """
+    self._changed(('neighborhood', instance.id), None)
+
+  def spot_deleted(self, sender, instance, **kwargs):
+    """ Signal handler dropping a deleted spot from the index. """
+    self._changed((_model_label(sender), instance.pk), None)
+
+
+
+
+def search_spots(queryset, query, location=None, bbox=None, limit=20):
+  """
+  Returns {'spot': row, 'score': score, 'distance': distance} dicts for the
+  spots in the queryset whose addresses match a query, best first, where
+  row is a SpotRow. The text candidates come from the index, so the address
+  column isn't scanned; they're then narrowed with the queryset and an
+  optional (west, south, east, north) bbox. If a (latitude, longitude)
+  location is given, the ranking combines text relevance with distance from
+  it: the score is divided by 1 + distance / DISTANCE_SCALE.
+
+  Only the best MAX_CANDIDATES text matches are considered. Without a
+  location, they're narrowed BULK_SIZE at a time, best first, until there
+  are limit results.
+  """
+  from spots.export import filter_by_bbox
+  from spots.rows import BULK_SIZE, get_spot_rows_in_bulk
+  from spots.utils import get_distance_between_locations
+  matches = text_index.search(query, kinds=[_model_label(queryset.model)], limit=MAX_CANDIDATES)
+  if bbox is not None:
+    queryset = filter_by_bbox(queryset, bbox)
+  results = []
+  for start in range(0, len(matches), BULK_SIZE):
+    batch = matches[start:start + BULK_SIZE]
+    rows = get_spot_rows_in_bulk(queryset, [ id for score, kind, id in batch ])
+    for score, kind, id in batch:
+      if id not in rows:
+        continue
+      row, distance = rows[id], None
+      if location is not None and row.latitude is not None and row.longitude is not None:
+        distance = get_distance_between_locations(location, row.location())
+        score = score / (1 + distance / DISTANCE_SCALE)
+      results.append({'spot': row, 'score': score, 'distance': distance})
+    if location is None and len(results) >= limit:
+      break
+  results.sort(key=lambda result: (-result['score'], result['spot'].id))
+  return results[:limit]
+
+
+def search_places(query, limit=10):
+  """
+  Returns (cities, neighborhoods) matching a query, best first, as
+  ({'city': record, 'score': score}, ...) and
+  ({'neighborhood': neighborhood, 'score': score}, ...) dicts. Cities are
+  CityRecords from the city catalog.
+  """
+  from spots.models import Neighborhood
+  cities = [ {'city': city_catalog.get(id), 'score': score} for score, kind, id in text_index.search(query, kinds=['city'], limit=limit) ]
+  matches = text_index.search(query, kinds=['neighborhood'], limit=limit)
+  neighborhoods = Neighborhood.objects.in_bulk([ id for score, kind, id in matches ])
+  return ([ city for city in cities if city['city'] ], [ {'neighborhood': neighborhoods[id], 'score': score} for score, kind, id in matches if id in neighborhoods ])
+
+
+def reset_checked(**kwargs):
+  """ Signal handler making the index check its generation at the start of each request. """
+  _request_local.checked_at = None
+
+
+text_index = TextIndex()
+request_started.connect(reset_checked)
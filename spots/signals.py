@@ -0,0 +1,79 @@
+"""
+Wires spots' models to the modules kept in step with them: the change feed,
+cached spots pages, map clusters, heatmaps, neighbours, the city catalog and
+the search index, and the router's pinning to the primary after writes.
+
+Spot is abstract, so its signals are sent by each concrete subclass.
+spots.models calls connect_spot_model() for each one as it's defined, which
+connects its receivers with it as the sender, after connecting the City and
+Neighborhood receivers the first time.
+"""
+from django.db.models import signals
+
+from spots import changes, clustering, heatmap, neighbors
+from spots.cache import city_changed, neighborhood_changed, spot_changed, spot_pre_save
+from spots.catalog import city_catalog
+from spots.models import City, Neighborhood
+from spots.routers import pin_primary
+from spots.search import text_index
+
+
+
+
+def spot_initialized(sender, instance, **kwargs):
+  """ Signal handler remembering a spot's tracked fields as it's loaded or saved. """
+  instance._remember_tracked_values()
+
+
+def spot_location_pre_save(sender, instance, **kwargs):
+  """ Signal handler marking the neighborhoods of a spot that has moved as unchecked. """
+  if instance.pk and instance.has_changed('latitude', 'longitude', 'city'):
+    instance.neighborhoods_checked = False
+
+
+
+
+def connect_place_signals():
+  """ Connects the receivers for every model, and for City and Neighborhood. """
+  signals.post_save.connect(pin_primary)
+  signals.post_delete.connect(pin_primary)
+  # The change feed is written before the in-memory indexes bump their
+  # generations, so other processes find the change when they catch up.
+  for model in (City, Neighborhood):
+    signals.post_save.connect(changes.object_saved, sender=model)
+    signals.post_delete.connect(changes.object_deleted, sender=model)
+  signals.post_save.connect(city_changed, sender=City)
+  signals.post_delete.connect(city_changed, sender=City)
+  signals.post_save.connect(city_catalog.city_saved, sender=City)
+  signals.post_delete.connect(city_catalog.city_deleted, sender=City)
+  signals.post_save.connect(neighborhood_changed, sender=Neighborhood)
+  signals.post_delete.connect(neighborhood_changed, sender=Neighborhood)
+  signals.post_save.connect(text_index.city_saved, sender=City)
+  signals.post_delete.connect(text_index.city_deleted, sender=City)
+  signals.post_save.connect(text_index.neighborhood_saved, sender=Neighborhood)
+  signals.post_delete.connect(text_index.neighborhood_deleted, sender=Neighborhood)
+
+
+def connect_spot_model(model):
+  """
+  Connects the spot receivers with a concrete spot model as the sender.
+  Connecting a model twice does nothing.
+  """
+  connect_place_signals()
+  signals.post_save.connect(changes.object_saved, sender=model)
+  signals.post_delete.connect(changes.object_deleted, sender=model)
+  signals.post_save.connect(text_index.spot_saved, sender=model)
+  signals.post_delete.connect(text_index.spot_deleted, sender=model)
+  signals.post_init.connect(spot_initialized, sender=model)
+  signals.pre_save.connect(spot_location_pre_save, sender=model)
+  signals.pre_save.connect(spot_pre_save, sender=model)
+  signals.post_save.connect(spot_changed, sender=model)
+  signals.pre_delete.connect(spot_changed, sender=model)
+  signals.post_save.connect(clustering.spot_saved, sender=model)
+  signals.post_delete.connect(clustering.spot_deleted, sender=model)
+  signals.post_save.connect(heatmap.spot_saved, sender=model)
+  signals.post_delete.connect(heatmap.spot_deleted, sender=model)
+  signals.post_save.connect(neighbors.spot_saved, sender=model)
+  signals.post_delete.connect(neighbors.spot_deleted, sender=model)
+  # Last, so the receivers above still see what changed.
+  signals.post_save.connect(spot_initialized, sender=model)
@@ -0,0 +1,160 @@
+import datetime
+import gzip
+import os
+import re
+from xml.sax.saxutils import escape
+
+from django.conf import settings
+from django.core.urlresolvers import NoReverseMatch
+
+from spots.catalog import city_catalog
+from spots.export import CHUNK_SIZE, iterate_in_chunks
+from spots.rows import get_row_fields, get_spot_url
+
+
+# The sitemap protocol allows at most 50,000 URLs in a file.
+SHARD_SIZE = getattr(settings, 'SPOTS_SITEMAP_SHARD_SIZE', 50000)
+SITEMAP_HEADER = '<?xml version="1.0" encoding="UTF-8"?>\n<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n'
+SITEMAP_FOOTER = '</urlset>\n'
+INDEX_HEADER = '<?xml version="1.0" encoding="UTF-8"?>\n<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n'
+INDEX_FOOTER = '</sitemapindex>\n'
+SHARD_FILENAME = re.compile(r'^sitemap-.+-\d+\.xml(\.gz)?$')
+
+
+
+
+def iterate_city_urls():
+  """
+  Yields the URL of every city, from the city catalog. Cities whose URL
+  can't be worked out are left out.
+  """
+  records, revision = city_catalog.records()
+  for record in sorted(records, key=lambda record: record.id):
+    try:
+      yield record.url()
+    except NoReverseMatch:
+      continue
+
+
+def iterate_neighborhood_urls(chunk_size=CHUNK_SIZE):
+  """
+  Yields the URL of every neighborhood. Only their city ids and slugs are
+  fetched, a chunk at a time, and the URLs come from the city catalog.
+  """
+  from spots.models import Neighborhood
+  for row in iterate_in_chunks(Neighborhood.objects.all(), ('city', 'slug'), chunk_size):
+    record = city_catalog.get(row['city'])
+    try:
+      url = record and record.neighborhood_url(row['slug'])
+    except NoReverseMatch:
+      continue
+    if url:
+      yield url
+
+
+def iterate_spot_urls(model, chunk_size=CHUNK_SIZE):
+  """
+  Yields the URL of every spot of the given model that has one. Only the
+  row fields are fetched, a chunk at a time.
+  """
+  for values in iterate_in_chunks(model._default_manager.all(), get_row_fields(model), chunk_size):
+    try:
+      url = get_spot_url(values['city'], values.get('slug'))
+    except NoReverseMatch:
+      continue
+    if url:
+      yield url
+
+
+def get_sections(spot_models):
+  """ Returns (name, URL iterator) for each sitemap section. """
+  sections = [('cities', iterate_city_urls()), ('neighborhoods', iterate_neighborhood_urls())]
+  for model in spot_models:
+    sections.append(("%s-%s" % (model._meta.app_label, model._meta.module_name), iterate_spot_urls(model)))
+  return sections
+
+
+
+
+class _ShardWriter(object):
+  # Writes URLs to numbered sitemap files, starting a new one every
+  # shard_size URLs. Each file is written under a temporary name and
+  # renamed into place once it's complete, so the files being served are
+  # never half written.
+  def __init__(self, directory, name, base_url, shard_size, compress):
+    self.directory, self.name, self.base_url = directory, name, base_url
+    self.shard_size, self.compress = shard_size, compress
+    self.filenames = []
+    self.file = None
+    self.path = None
+    self.count = 0
+
+  def _open(self):
+    filename = "sitemap-%s-%d.xml%s" % (self.name, len(self.filenames) + 1, self.compress and '.gz' or '')
+    self.path = os.path.join(self.directory, filename)
+    self.file = self.compress and gzip.open(self.path + '.tmp', 'wb') or open(self.path + '.tmp', 'wb')
+    self.file.write(SITEMAP_HEADER)
+    self.filenames.append(filename)
+    self.count = 0
+
+  def write(self, url):
+    if self.file is None or self.count >= self.shard_size:
+      self.close()
+      self._open()
+    self.file.write("<url><loc>%s</loc></url>\n" % escape(self.base_url + url).encode('utf-8'))
+    self.count += 1
+
+  def close(self):
+    if self.file is not None:
+      self.file.write(SITEMAP_FOOTER)
+      self.file.close()
+      os.rename(self.path + '.tmp', self.path)
+      self.file = None
+
+  def abort(self):
+    # Drops the file being written, leaving the one it would replace.
+    if self.file is not None:
+      self.file.close()
+      os.remove(self.path + '.tmp')
+      self.filenames.pop()
+      self.file = None
+
+
+def write_sitemaps(directory, base_url, spot_models=(), shard_size=SHARD_SIZE, compress=False):
+  """
+  Writes sitemaps of every city, neighborhood and spot (of the given spot
+  models) into a directory, with at most shard_size URLs per file, plus a
+  sitemap.xml index listing them. URLs are streamed from the database a
+  chunk at a time, so memory use doesn't grow with the number of URLs.
+  base_url is the site's URL without a trailing slash, like
+  "http://example.com", and the files are expected to be served from its
+  root. Every file is written under a temporary name and renamed into
+  place, the index last, and then the sitemap files the new index doesn't
+  list are deleted. Returns the names of the files written, index last.
+  """
+  filenames = []
+  for name, urls in get_sections(spot_models):
+    writer = _ShardWriter(directory, name, base_url, shard_size, compress)
+    try:
+      for url in urls:
+        writer.write(url)
+    except:
+      writer.abort()
+      raise
+    writer.close()
+    filenames += writer.filenames
+  today = datetime.date.today().isoformat()
+  path = os.path.join(directory, 'sitemap.xml')
+  index = open(path + '.tmp', 'wb')
+  try:
+    index.write(INDEX_HEADER)
+    for filename in filenames:
+      index.write("<sitemap><loc>%s/%s</loc><lastmod>%s</lastmod></sitemap>\n" % (escape(base_url), filename, today))
+    index.write(INDEX_FOOTER)
+  finally:
+    index.close()
+  os.rename(path + '.tmp', path)
+  for filename in os.listdir(directory):
+    if SHARD_FILENAME.match(filename) and filename not in filenames:
+      os.remove(os.path.join(directory, filename))
+  return filenames + ['sitemap.xml']
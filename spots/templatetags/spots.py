@@ -2,17 +2,17 @@ from django import template
 from django.template import Library
 from django.template import RequestContext
 from django.template import resolve_variable
+from django.template.loader import get_template
 from django.conf import settings
+from django.core.exceptions import ObjectDoesNotExist
+from django.utils import simplejson
 
+from spots.assets import render_assets
 from spots.models import *
 from spots.forms import *
 
 register = Library()
 
-INCLUDE_TEMPLATE = """
-<script src="http://maps.google.com/maps?file=api&amp;v=2&amp;key=%s" type="text/javascript"></script>
-"""
-
 BASIC_TEMPLATE = """
 <div class="map" id="map-%(name)s" style="width:%(width)spx;height:%(height)spx;"></div>
 <script type="text/javascript">
@@ -48,54 +48,99 @@ BASIC_TEMPLATE = """
 # {% gmap name:mimapa width:300 height:300 latitude:x longitude:y zoom:20 view:G_PHYSICAL_MAP clickable:true %} Message for a marker at that point {% endgmap %}
 
 class GMapNode (template.Node):
-    def __init__(self, params, nodelist):
-        self.params = params
+    def __init__(self, literals, variables, nodelist):
+        self.variables = variables
         self.nodelist = nodelist
+        self.template = _precompile_gmap_template(BASIC_TEMPLATE, literals, variables, ["message"])
         
     def render (self, context):
-        for k,v in self.params.items():
-            try:
-                self.params[k] = resolve_variable(v, context)
-            except:
-                pass
-        self.params["message"] = self.nodelist.render(context).replace("\n", "<br />")
-        return BASIC_TEMPLATE % self.params
+        params = _resolve_gmap_params(self.variables, context)
+        params["message"] = self.nodelist.render(context).replace("\n", "<br />")
+        return render_assets('maps') + self.template % params
+
+#Default values 
+GMAP_DEFAULTS={
+        'name'      : "default",
+        'width'     : "300",
+        'height'    : "300",
+        'latitude'  : "38.92522904714051",
+        'longitude' : "-95.3173828125",
+        'zoom'      : "15",
+        'view'      : "G_PHYSICAL_MAP",
+        'clickable' : "true",
+        'draggable' : "false",
+}
+
+def _is_gmap_literal(value):
+    """
+    Returns True for unquoted gmap parameters that are never context
+    variables: numbers, true/false and Google Maps constants like G_PHYSICAL_MAP.
+    """
+    if value in ("true", "false") or value.startswith("G_"):
+        return True
+    try:
+        float(value)
+        return True
+    except ValueError:
+        return False
+
+def _parse_gmap_params(items, defaults):
+    """
+    Splits "param:value" tag arguments into a dict of literal values and a
+    dict of (Variable, fallback) pairs to resolve at render time, starting
+    from the given defaults. Unknown parameters are ignored.
+    """
+    literals=dict(defaults)
+    variables={}
+    for item in items:
+        param, value = item.split(":", 1)
+        param = param.strip()
+        value = value.strip()
+        
+        if defaults.has_key(param):
+            if value[0]=="\"":
+                literals[param] = value[1:-1]
+                variables.pop(param, None)
+            elif _is_gmap_literal(value):
+                literals[param] = value
+                variables.pop(param, None)
+            else:
+                # Unresolvable variables render as the text given, as before.
+                variables[param] = (template.Variable(value), value)
+                literals.pop(param, None)
+    return literals, variables
+
+def _resolve_gmap_params(variables, context):
+    params = {}
+    for k, (variable, fallback) in variables.items():
+        try:
+            params[k] = variable.resolve(context)
+        except template.VariableDoesNotExist:
+            params[k] = fallback
+    return params
+
+def _precompile_gmap_template(source, literals, variables, dynamic=()):
+    # Fill in the literal parameters once, leaving placeholders for the
+    # ones that have to be resolved against each render's context.
+    placeholders = dict((k, v.replace("%", "%%")) for k, v in literals.items())
+    for k in variables.keys() + list(dynamic):
+        placeholders[k] = "%%(%s)s" % k
+    return source % placeholders
+
 def do_gmap(parser, token):
     items = token.split_contents()
 
     nodelist = parser.parse(('endgmap',))
     parser.delete_first_token()
     
-    #Default values 
-    parameters={
-            'name'      : "default",
-            'width'     : "300",
-            'height'    : "300",
-            'latitude'  : "38.92522904714051",
-            'longitude' : "-95.3173828125",
-            'zoom'      : "15",
-            'view'      : "G_PHYSICAL_MAP",
-            'message'   : "No message",
-            'clickable' : "true",
-            'draggable' : "false",
-    }
-    for item in items[1:]:
-        param, value = item.split(":")
-        param = param.strip()
-        value = value.strip()
-        
-        if parameters.has_key(param):
-            if value[0]=="\"":
-                value = value[1:-1]
-            parameters[param] = value
-        
-    return GMapNode(parameters, nodelist)
+    literals, variables = _parse_gmap_params(items[1:], GMAP_DEFAULTS)
+    return GMapNode(literals, variables, nodelist)
 
 class GMapScriptNode (template.Node):
     def __init__(self):
         pass        
     def render (self, context):
-        return INCLUDE_TEMPLATE % (settings.GOOGLE_MAPS_API_KEY)
+        return render_assets('maps')
 
 def do_gmap_script(parser, token):
     try:
@@ -104,10 +149,166 @@ def do_gmap_script(parser, token):
         raise template.TemplateSyntaxError("La etiqueta no requiere argumentos" % token.contents[0])
     return GMapScriptNode()
 
+
+SPOTS_TEMPLATE = """
+<div class="map" id="map-%(name)s" style="width:%(width)spx;height:%(height)spx;"></div>
+<script type="text/javascript">
+  function create_map_%(name)s() {
+    if (GBrowserIsCompatible()) {
+    
+      // Each marker is [latitude, longitude, title, url, count].
+      var markers = %(markers)s;
+      var map = new GMap2(document.getElementById("map-%(name)s"));
+      
+      // Center the map on the markers, or on the default point if there are none.
+      if (markers.length) {
+        var bounds = new GLatLngBounds();
+        for (var i = 0; i < markers.length; i++) {
+          bounds.extend(new GLatLng(markers[i][0], markers[i][1]));
+        }
+        map.setCenter(bounds.getCenter(), Math.min(map.getBoundsZoomLevel(bounds), %(zoom)s), %(view)s);
+      } else {
+        map.setCenter(new GLatLng(%(latitude)s,%(longitude)s), %(zoom)s, %(view)s);
+      }
+      map.addControl(new GSmallZoomControl());
+      
+      // Add the markers. Clicking a spot follows its link; clicking a cluster zooms in on it.
+      for (var i = 0; i < markers.length; i++) {
+        (function(m) {
+          var point = new GLatLng(m[0], m[1]);
+          var marker = new GMarker(point, { clickable:true, title:m[2] });
+          GEvent.addListener(marker, "click", function() {
+            if (m[4] > 1) { map.setCenter(point, map.getZoom() + 2); }
+            else if (m[3]) { window.location = m[3]; }
+          });
+          map.addOverlay(marker);
+        })(markers[i]);
+      }
+      return map;
+    }
+  }
+  jQuery(document).ready(function(){ create_map_%(name)s(); });
+</script>
+"""
+# {% gmap_spots spot_list name:nearby width:500 height:300 zoom:12 cluster:100 %}
+
+GMAP_SPOTS_DEFAULTS = dict(GMAP_DEFAULTS, cluster="0")
+GMAP_SPOTS_WHOLE_NUMBERS = ("cluster", "zoom")
+
+def _whole_number_param(params, literals, name):
+    """
+    Returns a gmap_spots parameter as a whole number. Variables that don't
+    resolve to one fall back to the default.
+    """
+    try:
+        return int(params.get(name, literals.get(name)))
+    except (TypeError, ValueError):
+        return int(GMAP_SPOTS_DEFAULTS[name])
+
+def get_spot_markers(spots):
+    """
+    Returns [latitude, longitude, title, url, 1] markers for a queryset or list
+    of spots. Lists may hold spots or the {'spot': spot} dicts spot_list
+    renders. Querysets only fetch the columns the markers need.
+    """
+    from spots.export import iterate_spot_rows
+    from spots.rows import get_spot_rows
+    if hasattr(spots, 'values_list'):
+        if spots.query.low_mark or spots.query.high_mark is not None:
+            # Sliced querysets, like a page's object_list, can't be fetched in
+            # chunks, but they're small enough to fetch at once.
+            spots = get_spot_rows(spots)
+        else:
+            return [ [row['latitude'], row['longitude'], row['address'], row['url'], 1] for row in iterate_spot_rows(spots) if row['latitude'] is not None and row['longitude'] is not None ]
+    markers = []
+    for spot in spots:
+        if isinstance(spot, dict):
+            spot = spot['spot']
+        if spot.latitude is None or spot.longitude is None:
+            continue
+        url = hasattr(spot, 'get_absolute_url') and spot.get_absolute_url() or None
+        markers.append([float(spot.latitude), float(spot.longitude), unicode(spot), url, 1])
+    return markers
+
+class GMapSpotsNode (template.Node):
+    def __init__(self, spots, literals, variables):
+        self.spots = spots
+        self.literals = literals
+        self.variables = variables
+        self.template = _precompile_gmap_template(SPOTS_TEMPLATE, literals, variables, ["markers"])
+        
+    def render (self, context):
+        params = _resolve_gmap_params(self.variables, context)
+        try:
+            spots = self.spots.resolve(context)
+        except template.VariableDoesNotExist:
+            spots = []
+        markers = get_spot_markers(spots)
+        
+        # Large lists are clustered on the server, so the page only carries
+        # one marker per grid cell.
+        cluster = _whole_number_param(params, self.literals, "cluster")
+        zoom = params["zoom"] = _whole_number_param(params, self.literals, "zoom")
+        if cluster and len(markers) > cluster:
+            from spots.clustering import cluster_locations
+            clusters = cluster_locations([ (m[0], m[1]) for m in markers ], zoom)
+            markers = [ [c['latitude'], c['longitude'], "%s spots" % c['count'], None, c['count']] for c in clusters ]
+        
+        params["markers"] = simplejson.dumps(markers).replace("</", "<\\/")
+        return render_assets('maps') + self.template % params
+
+def do_gmap_spots(parser, token):
+    items = token.split_contents()
+    if len(items) < 2:
+        raise template.TemplateSyntaxError("%r tag requires a list of spots as its first argument" % items[0])
+    literals, variables = _parse_gmap_params(items[2:], GMAP_SPOTS_DEFAULTS)
+    for param in GMAP_SPOTS_WHOLE_NUMBERS:
+        if param in literals and not literals[param].isdigit():
+            raise template.TemplateSyntaxError("%r tag's %s should be a whole number, not %r" % (items[0], param, literals[param]))
+    return GMapSpotsNode(parser.compile_filter(items[1]), literals, variables)
+
 register.tag('gmap', do_gmap)
+register.tag('gmap_spots', do_gmap_spots)
 register.tag('gmap-script', do_gmap_script)
 
 
+def get_user_location(request):
+  """
+  Returns the location of the request's user, or None if they're anonymous or
+  haven't set one. It's looked up once per request and kept on the request.
+  """
+  if not hasattr(request, '_spots_user_location'):
+    user_location = None
+    if request.user.is_authenticated():
+      try:
+        user_location = request.user.location
+      except ObjectDoesNotExist:
+        pass
+    request._spots_user_location = user_location
+  return request._spots_user_location
+
+
+def get_spot_dicts_for_location(spots, location=None):
+  """
+  Returns a list of {'spot': spot, 'distance': distance, 'direction': direction}
+  dicts with the distance and direction from each spot to the location (an
+  object with a location() method). Takes spots or spot dicts. If location is
+  None, distance and direction are None.
+  """
+  spots = [ isinstance(spot, dict) and spot['spot'] or spot for spot in spots ]
+  if location is None or None in location.location():
+    return [ {'spot': spot, 'distance': None, 'direction': None } for spot in spots ]
+  origin = location.location()
+  spot_dicts = []
+  for spot in spots:
+    distance = get_distance_between_locations(spot.location(), origin)
+    direction = None
+    if distance < 100.00:
+      direction = get_compass_direction_from_bearing(get_bearing_between_locations(spot.location(), origin))
+    spot_dicts.append({'spot': spot, 'distance': distance, 'direction': direction })
+  return spot_dicts
+
+
 @register.inclusion_tag('snippets/forms/current_location_form.html', takes_context=True)
 def render_current_location_form(context):
   """
@@ -116,10 +317,9 @@ def render_current_location_form(context):
   {% render_current_location_form %}
   """
   user = context['request'].user
-  if user.is_authenticated:
-    try:
-      user_location = UserLocation.objects.get(user=user)
-    except UserLocation.DoesNotExist:
+  if user.is_authenticated():
+    user_location = get_user_location(context['request'])
+    if user_location is None:
       user_location = UserLocation(user=user, created_by=user)
     return { 'location_form': UserLocationForm(instance=user_location, prefix="location"), }
   else:
@@ -128,11 +328,37 @@ def render_current_location_form(context):
 @register.inclusion_tag('snippets/lists/spot_dict.html', takes_context=True)
 def render_spot_list_item(context, spot):
   request = context['request']
-  if request.user.is_authenticated():
+  spot = get_spot_dicts_for_location([spot], get_user_location(request))[0]
+  return { 'item': spot, 'request': request }
+
+
+class SpotListNode(template.Node):
+  def __init__(self, spots):
+    self.spots = spots
+    self.item_template = None
+
+  def render(self, context):
+    request = context['request']
     try:
-      spot = {'spot': spot, 'distance': spot._get_distance_to_spot(request.user.location), 'direction': spot._get_compass_direction_to_spot(request.user.location) }
-    except UserLocation.DoesNotExist:
-      spot = {'spot': spot, 'distance': None, 'direction': None }
-  else:
-    spot = {'spot': spot, 'distance': None, 'direction': None }
-  return { 'item': spot, 'request': request }
\ No newline at end of file
+      spots = self.spots.resolve(context)
+    except template.VariableDoesNotExist:
+      return ""
+    if self.item_template is None:
+      self.item_template = get_template('snippets/lists/spot_dict.html')
+    items = get_spot_dicts_for_location(spots, get_user_location(request))
+    return "".join([ self.item_template.render(template.Context({ 'item': item, 'request': request }, autoescape=context.autoescape)) for item in items ])
+
+def do_render_spot_list(parser, token):
+  """
+  Renders each spot in a list with the same template as render_spot_list_item,
+  looking up the user's location once and computing the distances and
+  directions for the whole list in one pass.
+  
+  {% render_spot_list spots %}
+  """
+  bits = token.split_contents()
+  if len(bits) != 2:
+    raise template.TemplateSyntaxError("%r tag requires exactly one argument" % bits[0])
+  return SpotListNode(parser.compile_filter(bits[1]))
+
+register.tag('render_spot_list', do_render_spot_list)
@@ -0,0 +1,710 @@
+import sys
+import unittest
+from decimal import Decimal
+
+from django.core.cache import get_cache
+from django.db import models
+from django.http import HttpRequest, HttpResponse, QueryDict
+from django.test import TestCase
+
+from spots import clustering, heatmap
+from spots.models import City, Spot
+from spots.managers import SpotManager
+
+
+
+
+class TestSpot(Spot):
+  """ A concrete spot model for the tests. """
+  slug = models.SlugField(blank=True)
+
+  objects = SpotManager()
+
+
+def swap_cache(uri):
+  """
+  Points the cache of every spots module at a new cache made from a backend
+  URI. Returns a function that puts the old one back.
+  """
+  import django.core.cache
+  old, new = django.core.cache.cache, get_cache(uri)
+  patched = []
+  for name, module in sys.modules.items():
+    if module is not None and (name == 'django.core.cache' or name.split('.')[0] == 'spots') and getattr(module, 'cache', None) is old:
+      module.cache = new
+      patched.append(module)
+  def restore():
+    for module in patched:
+      module.cache = old
+  return restore
+
+
+def get_request(**query):
+  """ Returns an anonymous GET request with the given query parameters. """
+  from django.contrib.auth.models import AnonymousUser
+  from django.utils.datastructures import MergeDict
+  request = HttpRequest()
+  request.method = 'GET'
+  request.path = '/'
+  request.GET = QueryDict('', mutable=True)
+  request.GET.update(query)
+  request.REQUEST = MergeDict(request.POST, request.GET)
+  request.user = AnonymousUser()
+  return request
+
+
+def count_queries(function, *args, **kwargs):
+  """ Returns the number of queries a call to function makes. """
+  from spots.instrumentation import get_query_count
+  count = get_query_count()
+  function(*args, **kwargs)
+  return get_query_count() - count
+
+
+class SpotsTestCase(TestCase):
+  """
+  Runs each test against a fresh local-memory cache, and an empty city
+  catalog and search index, so nothing leaks between tests.
+  """
+  cache_backend = 'locmem://'
+
+  def setUp(self):
+    from spots.catalog import city_catalog
+    self.restore_cache = swap_cache(self.cache_backend)
+    city_catalog.clear()
+    self.city = City.objects.create(city="Lawrence", state="KS", country="us", slug="lawrence-ks-us", latitude=Decimal("38.9717"), longitude=Decimal("-95.2353"))
+
+  def tearDown(self):
+    from spots.catalog import city_catalog
+    self.restore_cache()
+    city_catalog.clear()
+
+  def make_spot(self, address, latitude, longitude, slug='', city=None):
+    return TestSpot.objects.create(address=address, latitude=Decimal(str(latitude)), longitude=Decimal(str(longitude)), slug=slug, city=city or self.city)
+
+
+
+
+class TileTests(unittest.TestCase):
+
+  def test_tile_for_location(self):
+    self.assertEqual(clustering.get_tile_for_location(0, 0, 0), (0, 0))
+    self.assertEqual(clustering.get_tile_for_location(45, -90, 1), (0, 0))
+    self.assertEqual(clustering.get_tile_for_location(-45, 90, 1), (1, 1))
+
+  def test_tile_for_location_clamps_to_the_edges(self):
+    self.assertEqual(clustering.get_tile_for_location(90, 180, 2), (3, 0))
+    self.assertEqual(clustering.get_tile_for_location(-90, -180, 2), (0, 3))
+
+  def test_tile_bbox(self):
+    west, south, east, north = clustering.get_tile_bbox(0, 0, 0)
+    self.assertEqual((west, east), (-180.0, 180.0))
+    self.assertAlmostEqual(north, clustering.MAX_LATITUDE, 6)
+    self.assertAlmostEqual(south, -clustering.MAX_LATITUDE, 6)
+    self.assertEqual(clustering.get_tile_bbox(1, 0, 1)[0], 0.0)
+
+  def test_tiles_for_bbox(self):
+    self.assertEqual(clustering.get_tiles_for_bbox((-10, -10, 10, 10), 1), [(0, 0), (0, 1), (1, 0), (1, 1)])
+    self.assertEqual(clustering.get_tiles_for_bbox((10, 10, 20, 20), 1), [(1, 0)])
+
+  def test_tiles_for_bbox_too_many(self):
+    self.assertRaises(ValueError, clustering.get_tiles_for_bbox, (-180, -80, 180, 80), 4, 16)
+    self.assertEqual(len(clustering.get_tiles_for_bbox((-180, -80, 180, 80), 2, 16)), 16)
+
+
+
+
+class AntimeridianTests(unittest.TestCase):
+
+  def test_world_view_visits_the_only_tile_once(self):
+    self.assertEqual(clustering.get_tiles_for_bbox((170, -10, -170, 10), 0), [(0, 0)])
+
+  def test_both_edges_in_one_column(self):
+    tiles = clustering.get_tiles_for_bbox((170, 10, 100, 20), 1)
+    self.assertEqual(sorted(tiles), [(0, 0), (1, 0)])
+
+  def test_wraps_from_the_last_column_to_the_first(self):
+    tiles = clustering.get_tiles_for_bbox((170, 10, -170, 20), 3)
+    self.assertEqual([ x for x, y in tiles ], [7, 0])
+
+  def test_never_repeats_a_tile(self):
+    for zoom in range(4):
+      for west, east in ((170, -170), (100, 90), (0, -1), (-179, -180)):
+        tiles = clustering.get_tiles_for_bbox((west, -10, east, 10), zoom)
+        self.assertEqual(len(tiles), len(set(tiles)))
+
+
+
+
+class HeatmapBlockTests(unittest.TestCase):
+
+  def test_block_for_location(self):
+    self.assertEqual(heatmap.get_cell(0, 0, 1), (90, 180))
+    self.assertEqual(heatmap.get_block(0, 0, 1), (2, 5))
+    self.assertEqual(heatmap.get_block(-90, -180, 10), (0, 0))
+
+  def test_block_bbox(self):
+    self.assertEqual(heatmap.get_block_bbox(0, 0, 10), (-180, -90, 140, 230))
+    self.assertEqual(heatmap.get_block_bbox(2, 5, 1), (-20, -26, 12, 6))
+
+  def test_blocks_for_bbox(self):
+    self.assertEqual(heatmap.get_blocks_for_bbox((-10, -10, 10, 10), 1), [(2, 5), (3, 5)])
+
+  def test_blocks_for_bbox_too_many(self):
+    self.assertRaises(ValueError, heatmap.get_blocks_for_bbox, (-180, -90, 180, 90), 0.1, 64)
+
+  def test_antimeridian_wraps_to_the_first_column(self):
+    self.assertEqual(heatmap.get_blocks_for_bbox((170, 10, -170, 20), 1), [(3, 10), (3, 11), (3, 0)])
+
+  def test_antimeridian_at_a_coarse_resolution(self):
+    self.assertEqual(heatmap.get_blocks_for_bbox((170, -10, 160, 10), 10), [(0, 1), (0, 0)])
+
+  def test_never_repeats_a_block(self):
+    for resolution in (10, 5, 1):
+      for west, east in ((170, -170), (100, 90), (0, -1), (-179, -180)):
+        blocks = heatmap.get_blocks_for_bbox((west, -10, east, 10), resolution)
+        self.assertEqual(len(blocks), len(set(blocks)))
+
+
+
+
+class CacheGenerationTests(SpotsTestCase):
+
+  def etag(self, request):
+    from spots.cache import spots_etag
+    view = spots_etag('spots')(lambda request: HttpResponse("spots"))
+    return view(request).get('ETag')
+
+  def test_bumping_a_scope_changes_its_keys(self):
+    from spots.cache import bump_scope_generation, get_cache_key
+    key = get_cache_key('spots', 'countries')
+    self.assertEqual(key, get_cache_key('spots', 'countries'))
+    bump_scope_generation('spots')
+    self.assertNotEqual(key, get_cache_key('spots', 'countries'))
+
+  def test_saving_a_spot_bumps_its_scopes(self):
+    from spots.cache import get_scope_generation
+    generations = [ get_scope_generation(scope) for scope in ('spots', 'country-us', 'state-us-ks', 'city-us-ks-lawrence') ]
+    self.make_spot("1 Main St", 38.97, -95.23)
+    for scope, generation in zip(('spots', 'country-us', 'state-us-ks', 'city-us-ks-lawrence'), generations):
+      self.assertNotEqual(get_scope_generation(scope), generation)
+
+  def test_etag_changes_with_the_generation(self):
+    from spots.cache import bump_scope_generation
+    etag = self.etag(get_request())
+    self.assertTrue(etag)
+    self.assertEqual(etag, self.etag(get_request()))
+    self.assertNotEqual(etag, self.etag(get_request(page='2')))
+    bump_scope_generation('spots')
+    self.assertNotEqual(etag, self.etag(get_request()))
+
+  def test_matching_etag_gets_a_304(self):
+    request = get_request()
+    request.META['HTTP_IF_NONE_MATCH'] = self.etag(get_request())
+    from spots.cache import spots_etag
+    view = spots_etag('spots')(lambda request: HttpResponse("spots"))
+    self.assertEqual(view(request).status_code, 304)
+
+
+class DummyCacheGenerationTests(SpotsTestCase):
+  cache_backend = 'dummy://'
+
+  def test_no_generation_means_no_etag(self):
+    from spots.cache import get_scope_generation, spots_etag
+    self.assertEqual(get_scope_generation('spots'), None)
+    view = spots_etag('spots')(lambda request: HttpResponse("spots"))
+    request = get_request()
+    request.META['HTTP_IF_NONE_MATCH'] = '"anything"'
+    response = view(request)
+    self.assertEqual(response.status_code, 200)
+    self.assertEqual(response.get('ETag'), None)
+
+  def test_no_generation_means_city_heatmaps_arent_cached(self):
+    from spots.heatmap import get_block_counts
+    row, column = heatmap.get_block(38.97, -95.23, 1)
+    self.assertEqual(count_queries(get_block_counts, City, row, column, 1), 1)
+    self.assertEqual(count_queries(get_block_counts, City, row, column, 1), 1)
+
+  def test_no_generation_means_no_caching(self):
+    from spots.cache import cache_spots_view, get_cache_key
+    self.assertEqual(get_cache_key('spots', 'countries'), None)
+    calls = []
+    def view(request):
+      calls.append(request)
+      return HttpResponse("spots")
+    view = cache_spots_view('spots')(view)
+    view(get_request())
+    view(get_request())
+    self.assertEqual(len(calls), 2)
+
+
+class NeighborRefreshTests(SpotsTestCase):
+
+  def setUp(self):
+    super(NeighborRefreshTests, self).setUp()
+    self.spots = [ self.make_spot("%d Main St" % i, 38.95 + i * 0.01, -95.25 + (i % 4) * 0.01) for i in range(14) ]
+
+  def stored(self):
+    from django.contrib.contenttypes.models import ContentType
+    from spots.neighbors import get_stored_neighbors
+    ids = list(TestSpot.objects.values_list('id', flat=True))
+    lists = get_stored_neighbors(ContentType.objects.get_for_model(TestSpot), ids)
+    return dict([ (id, [ (round(distance, 6), neighbor_id) for distance, neighbor_id, bearing in neighbors ]) for id, neighbors in lists.items() ])
+
+  def assertMatchesRebuild(self):
+    from spots.neighbors import rebuild_neighbors
+    refreshed = self.stored()
+    rebuild_neighbors(TestSpot)
+    self.assertEqual(refreshed, self.stored())
+
+  def test_saves_keep_the_neighbors_current(self):
+    self.assertMatchesRebuild()
+
+  def test_moving_a_spot_away(self):
+    from spots.neighbors import rebuild_neighbors
+    rebuild_neighbors(TestSpot)
+    spot = TestSpot.objects.get(pk=self.spots[3].pk)
+    spot.latitude, spot.longitude = Decimal("40.0"), Decimal("-100.0")
+    spot.save()
+    self.assertMatchesRebuild()
+
+  def test_deleting_a_spot(self):
+    from spots.neighbors import rebuild_neighbors
+    rebuild_neighbors(TestSpot)
+    TestSpot.objects.get(pk=self.spots[5].pk).delete()
+    self.assertMatchesRebuild()
+
+  def test_queries_for_a_save_dont_grow_with_the_spots_nearby(self):
+    from django.contrib.contenttypes.models import ContentType
+    from spots.neighbors import rebuild_neighbors, refresh_neighbors_of
+    ContentType.objects.get_for_model(TestSpot)
+    rebuild_neighbors(TestSpot)
+    queries = count_queries(self.make_spot, "1 Near Rd", 38.99, -95.24)
+    for i in range(20):
+      self.make_spot("%d Side St" % i, 38.96 + i * 0.005, -95.22)
+    self.assertEqual(count_queries(self.make_spot, "2 Near Rd", 38.98, -95.23), queries)
+    spot = self.spots[0]
+    self.assertTrue(count_queries(refresh_neighbors_of, TestSpot, spot.pk, spot.location()) <= 7)
+
+
+class GMapSpotsTagTests(unittest.TestCase):
+
+  def setUp(self):
+    from django.conf import settings
+    from spots.assets import reset_assets
+    self.key = getattr(settings, 'GOOGLE_MAPS_API_KEY', None)
+    settings.GOOGLE_MAPS_API_KEY = 'key'
+    reset_assets()
+
+  def tearDown(self):
+    from django.conf import settings
+    settings.GOOGLE_MAPS_API_KEY = self.key
+
+  def render(self, source, **context):
+    from django.template import Context, Template
+    return Template("{% load spots %}" + source).render(Context(context))
+
+  def test_variables_that_arent_numbers_fall_back_to_the_defaults(self):
+    html = self.render("{% gmap_spots spots cluster:cluster zoom:zoom %}", spots=[], cluster="lots", zoom=None)
+    self.assertTrue("var markers = [];" in html)
+    self.assertTrue("), 15, G_PHYSICAL_MAP);" in html)
+
+  def test_variables_that_are_numbers_are_used(self):
+    html = self.render("{% gmap_spots spots zoom:zoom %}", spots=[], zoom="9")
+    self.assertTrue("), 9, G_PHYSICAL_MAP);" in html)
+
+  def test_literals_that_arent_whole_numbers_are_syntax_errors(self):
+    from django.template import TemplateSyntaxError
+    self.assertRaises(TemplateSyntaxError, self.render, "{% gmap_spots spots cluster:1.5 %}", spots=[])
+    self.assertRaises(TemplateSyntaxError, self.render, '{% gmap_spots spots zoom:"close" %}', spots=[])
+
+
+class SpotURLTests(SpotsTestCase):
+  urls = 'spots.urls'
+
+  def test_spot_url_reverses_spot_detail(self):
+    spot = self.make_spot("1 Main St", 38.97, -95.23, slug="main-st")
+    self.assertEqual(spot.get_absolute_url(), '/us/ks/lawrence/main-st/')
+
+  def test_spot_in_a_city_without_a_province_has_no_url(self):
+    city = City.objects.create(city="Monaco", country="mc", slug="monaco-mc", latitude=Decimal("43.7333"), longitude=Decimal("7.4167"))
+    spot = self.make_spot("1 Rue Grimaldi", 43.73, 7.41, slug="rue-grimaldi", city=city)
+    self.assertEqual(spot.get_absolute_url(), None)
+
+  def test_spot_urls_are_kept_on_the_record(self):
+    from spots.catalog import city_catalog
+    record = city_catalog.get(self.city.id)
+    self.assertTrue(record.spot_url('main-st') is record.spot_url('main-st'))
+
+
+class StubGeocoderTests(SpotsTestCase):
+
+  def test_uninstall_puts_back_exactly_what_was_there(self):
+    import time
+    from spots import forms, models as spots_models
+    from spots.benchmark import StubGeocoder
+    names = ('get_location_from_address', 'get_city_from_address', 'get_city_from_point', 'get_address_from_location', 'get_address_from_point', 'UrbanMappingClient')
+    before = [ (module, name, module.__dict__.get(name, StubGeocoderTests)) for module in (forms, spots_models) for name in names ]
+    sleep = time.sleep
+    geocoder = StubGeocoder()
+    geocoder.install()
+    geocoder.uninstall()
+    for module, name, value in before:
+      self.assertTrue(module.__dict__.get(name, StubGeocoderTests) is value, name)
+    self.assertTrue(time.sleep is sleep)
+
+
+class InstrumentationTests(SpotsTestCase):
+
+  def test_view_queries_are_counted_without_debug(self):
+    from django.conf import settings
+    from spots.instrumentation import MemorySink, instrument_view, set_sink
+    def view(request):
+      list(City.objects.all())
+      return HttpResponse("cities")
+    sink = MemorySink()
+    old, debug = set_sink(sink), settings.DEBUG
+    settings.DEBUG = False
+    try:
+      instrument_view('cities')(view)(get_request())
+    finally:
+      set_sink(old)
+      settings.DEBUG = debug
+    self.assertEqual(sink.timings['view.cities.queries'], [1])
+
+  def test_percentile(self):
+    from spots.instrumentation import percentile
+    self.assertEqual(percentile([], 50), None)
+    self.assertEqual(percentile(range(101), 90), 90)
+
+
+class SpotRowsTests(SpotsTestCase):
+  urls = 'spots.urls'
+
+  def test_rows_are_fetched_a_chunk_at_a_time(self):
+    from spots.rows import iterate_spot_rows_in_chunks
+    spots = [ self.make_spot("%d Main St" % i, 38.97, -95.23, slug="main-st-%d" % i) for i in range(5) ]
+    iterator = iterate_spot_rows_in_chunks(TestSpot.objects.all(), chunk_size=2)
+    rows = []
+    self.assertEqual(count_queries(lambda: rows.append(iterator.next())), 1)
+    self.assertEqual(count_queries(lambda: rows.append(iterator.next())), 0)
+    rows.extend(iterator)
+    self.assertEqual([ row.id for row in rows ], [ spot.id for spot in spots ])
+    self.assertEqual(rows[0].url, '/us/ks/lawrence/main-st-0/')
+
+  def test_manager_rows_are_lazy(self):
+    self.make_spot("1 Main St", 38.97, -95.23)
+    rows = TestSpot.objects.rows()
+    self.assertFalse(isinstance(rows, list))
+    self.assertEqual([ row.address for row in TestSpot.objects.rows(TestSpot.objects.filter(address="1 Main St")) ], ["1 Main St"])
+
+
+class ReplicaRoutingTests(SpotsTestCase):
+
+  def setUp(self):
+    from spots import routers
+    super(ReplicaRoutingTests, self).setUp()
+    self.read_databases = routers.READ_DATABASES
+    routers.READ_DATABASES = ('replica',)
+
+  def tearDown(self):
+    from spots import routers
+    routers.READ_DATABASES = self.read_databases
+    super(ReplicaRoutingTests, self).tearDown()
+
+  def database_for(self, request, view=None):
+    from spots.routers import get_read_database, read_from_replica
+    databases = []
+    def record(request):
+      if view is not None:
+        view(request)
+      databases.append(get_read_database())
+      return HttpResponse()
+    read_from_replica(record)(request)
+    return databases[0]
+
+  def test_read_only_views_read_from_a_replica(self):
+    from spots.routers import get_read_database
+    self.assertEqual(self.database_for(get_request()), 'replica')
+    self.assertEqual(get_read_database(), 'default')
+
+  def test_recent_writers_read_from_the_primary(self):
+    import time
+    from spots.routers import PIN_COOKIE
+    request = get_request()
+    request.COOKIES[PIN_COOKIE] = str(int(time.time() + 60))
+    self.assertEqual(self.database_for(request), 'default')
+
+  def test_writes_pin_the_rest_of_the_request_to_the_primary(self):
+    self.assertEqual(self.database_for(get_request(), lambda request: self.make_spot("1 Main St", 38.97, -95.23)), 'default')
+
+  def test_indexes_read_from_the_primary(self):
+    from spots.routers import using_primary
+    if not hasattr(City.objects.all(), 'using'):
+      return
+    self.assertEqual(using_primary(City.objects.all()).db, 'default')
+
+
+class CatalogCatchUpTests(SpotsTestCase):
+
+  def test_catches_up_with_cities_changed_elsewhere(self):
+    from spots import catalog
+    from spots.cache import bump_scope_generation
+    from spots.changes import record_change
+    self.assertEqual(catalog.city_catalog.get(self.city.id).city, "Lawrence")
+    # Another process renames the city: the catalog here only hears of it
+    # through the change feed and the generation.
+    City.objects.filter(id=self.city.id).update(city="Topeka")
+    record_change(self.city, 'saved')
+    bump_scope_generation(catalog.SCOPE)
+    catalog._request_local.checked_at = None
+    self.assertEqual(catalog.city_catalog.get(self.city.id).city, "Topeka")
+
+
+class ChangeFeedTests(SpotsTestCase):
+
+  def setUp(self):
+    from spots import changes
+    super(ChangeFeedTests, self).setUp()
+    self.settle_seconds = changes.SETTLE_SECONDS
+    changes.SETTLE_SECONDS = 0
+    self.spots = [ self.make_spot("%d Main St" % i, 38.97, -95.23) for i in range(5) ]
+
+  def tearDown(self):
+    from spots import changes
+    changes.SETTLE_SECONDS = self.settle_seconds
+    super(ChangeFeedTests, self).tearDown()
+
+  def test_each_object_keeps_one_row(self):
+    from spots.models import SpotChange
+    spot = self.spots[0]
+    first = SpotChange.objects.get(object_id=spot.pk, content_type__model='testspot').id
+    spot.address = "1 Side St"
+    spot.save()
+    changes = SpotChange.objects.filter(object_id=spot.pk, content_type__model='testspot')
+    self.assertEqual(len(changes), 1)
+    self.assertTrue(changes[0].id > first)
+
+  def test_paging_sees_every_object_once(self):
+    from spots.changes import get_changes_since
+    cursor, more, seen = 0, True, []
+    while more:
+      changes, next_cursor, more = get_changes_since(cursor, 2, [TestSpot])
+      self.assertTrue(len(changes) <= 2)
+      self.assertTrue(next_cursor > cursor or not changes)
+      seen.extend([ change.object_id for change in changes ])
+      cursor = next_cursor
+    self.assertEqual(seen, [ spot.pk for spot in self.spots ])
+    self.assertEqual(get_changes_since(cursor, 2, [TestSpot]), ([], cursor, False))
+
+  def test_deletes_are_tombstones(self):
+    from spots.changes import get_changes_since
+    pk = self.spots[1].pk
+    self.spots[1].delete()
+    changes, cursor, more = get_changes_since(0, 100, [TestSpot])
+    self.assertEqual([ (change.object_id, change.action) for change in changes ][-1], (pk, 'deleted'))
+
+  def test_unsettled_changes_hold_the_cursor_back(self):
+    from spots import changes
+    changes.SETTLE_SECONDS = 60
+    self.assertEqual(changes.get_changes_since(0, 100), ([], 0, False))
+    changed, cursor, settled = changes.get_changed_objects_since(0, [TestSpot])
+    self.assertEqual(changed, [ (TestSpot, spot.pk) for spot in self.spots ])
+    self.assertEqual((cursor, settled), (0, False))
+    from spots.models import SpotChange
+    self.assertEqual(changes.get_latest_cursor(), SpotChange.objects.order_by('id')[0].id - 1)
+
+
+class SitemapTests(SpotsTestCase):
+  urls = 'spots.urls'
+
+  def setUp(self):
+    import tempfile
+    super(SitemapTests, self).setUp()
+    self.directory = tempfile.mkdtemp()
+
+  def tearDown(self):
+    import shutil
+    shutil.rmtree(self.directory)
+    super(SitemapTests, self).tearDown()
+
+  def test_stale_shards_are_deleted(self):
+    import os
+    from spots.sitemaps import write_sitemaps
+    spots = [ self.make_spot("%d Main St" % i, 38.97, -95.23, slug="main-st-%d" % i) for i in range(3) ]
+    filenames = write_sitemaps(self.directory, 'http://example.com', [TestSpot], shard_size=1)
+    self.assertTrue('sitemap-spots-testspot-3.xml' in filenames)
+    self.assertEqual(sorted(os.listdir(self.directory)), sorted(filenames))
+    spots[0].delete()
+    filenames = write_sitemaps(self.directory, 'http://example.com', [TestSpot], shard_size=1)
+    self.assertFalse('sitemap-spots-testspot-3.xml' in filenames)
+    self.assertEqual(sorted(os.listdir(self.directory)), sorted(filenames))
+
+  def test_a_failed_section_leaves_the_old_files(self):
+    import os
+    from spots import sitemaps
+    self.make_spot("1 Main St", 38.97, -95.23, slug="main-st")
+    sitemaps.write_sitemaps(self.directory, 'http://example.com', [TestSpot])
+    before = dict([ (filename, open(os.path.join(self.directory, filename)).read()) for filename in os.listdir(self.directory) ])
+    def failing(model, chunk_size=None):
+      yield '/us/ks/lawrence/other/'
+      raise RuntimeError
+    iterate_spot_urls, sitemaps.iterate_spot_urls = sitemaps.iterate_spot_urls, failing
+    try:
+      self.assertRaises(RuntimeError, sitemaps.write_sitemaps, self.directory, 'http://example.com', [TestSpot])
+    finally:
+      sitemaps.iterate_spot_urls = iterate_spot_urls
+    after = dict([ (filename, open(os.path.join(self.directory, filename)).read()) for filename in os.listdir(self.directory) ])
+    self.assertEqual(before, after)
+
+
+class SearchTests(SpotsTestCase):
+
+  def setUp(self):
+    from spots.search import text_index
+    super(SearchTests, self).setUp()
+    text_index.cursor = None
+    self.near = self.make_spot("12 Main St", 38.97, -95.23)
+    self.far = self.make_spot("14 Main St", 39.97, -96.23)
+    self.other = self.make_spot("3 Oak Ave", 38.97, -95.23)
+
+  def test_matches_the_address(self):
+    from spots.search import search_spots
+    results = search_spots(TestSpot.objects.all(), "main street")
+    self.assertEqual(sorted([ result['spot'].id for result in results ]), [self.near.id, self.far.id])
+
+  def test_limit_is_passed_to_the_index(self):
+    from spots.search import search_spots, text_index
+    self.assertEqual(len(text_index.search("main st", limit=1)), 1)
+    self.assertEqual(len(search_spots(TestSpot.objects.all(), "main st", limit=1)), 1)
+
+  def test_closer_spots_rank_higher(self):
+    from spots.search import search_spots
+    results = search_spots(TestSpot.objects.all(), "14 main st", location=(38.97, -95.23))
+    self.assertEqual(results[0]['spot'].id, self.near.id)
+    self.assertTrue(results[0]['distance'] < results[1]['distance'])
+
+  def test_queryset_narrows_the_matches(self):
+    from spots.search import search_spots
+    results = search_spots(TestSpot.objects.exclude(id=self.near.id), "main st", limit=1)
+    self.assertEqual([ result['spot'].id for result in results ], [self.far.id])
+
+
+class CityAutocompleteTests(SpotsTestCase):
+
+  def make_city(self, city, state="", province="", country="us"):
+    return City.objects.create(city=city, state=state, province=province, country=country, slug="-".join([ part for part in (city, state, province, country) if part ]).lower(), latitude=Decimal("0"), longitude=Decimal("0"))
+
+  def ids(self, prefix):
+    from spots.autocomplete import city_index
+    return [ id for id, name in city_index.search(prefix) ]
+
+  def test_prefix_search_in_alphabetical_order(self):
+    lawton = self.make_city("Lawton", state="OK")
+    self.make_city("Topeka", state="KS")
+    self.assertEqual(self.ids("law"), [self.city.id, lawton.id])
+    self.assertEqual(self.ids("LAWT"), [lawton.id])
+    self.assertEqual(self.ids(""), [])
+
+  def test_follows_changes_to_cities(self):
+    lawton = self.make_city("Lawton", state="OK")
+    self.assertEqual(self.ids("lawton"), [lawton.id])
+    lawton.city = "Tulsa"
+    lawton.save()
+    self.assertEqual(self.ids("lawton"), [])
+    self.assertEqual(self.ids("tulsa"), [lawton.id])
+    lawton.delete()
+    self.assertEqual(self.ids("tulsa"), [])
+
+  def test_names_are_folded_to_ascii(self):
+    zurich = self.make_city(u"Z\xfcrich", province="Zurich", country="ch")
+    self.assertEqual(self.ids(u"z\xfcr"), [zurich.id])
+    self.assertEqual(self.ids("zur"), [zurich.id])
+
+  def test_get_id(self):
+    from spots.autocomplete import city_index
+    self.assertEqual(city_index.get_id(self.city.full_name()), self.city.id)
+    self.assertEqual(city_index.get_id("Nowhere"), None)
+
+
+class ViewportSamplingTests(SpotsTestCase):
+
+  def setUp(self):
+    super(ViewportSamplingTests, self).setUp()
+    # A 4 x 4 grid of spots, 0.1 degrees apart, two to each location.
+    self.spots = []
+    for i in range(4):
+      for j in range(4):
+        for k in range(2):
+          self.spots.append(self.make_spot("%d%d%d Grid St" % (i, j, k), 38.05 + i * 0.1, -95.95 + j * 0.1))
+    self.bbox = (-96.0, 38.0, -95.6, 38.4)
+
+  def sample(self, limit, sample='grid', bbox=None):
+    from spots.viewport import get_spots_in_bbox
+    spots, sampled = get_spots_in_bbox(TestSpot.objects.all(), bbox or self.bbox, limit, sample)
+    return [ spot.id for spot in spots ], sampled
+
+  def test_boxes_under_the_limit_arent_sampled(self):
+    ids, sampled = self.sample(100)
+    self.assertEqual((ids, sampled), ([ spot.id for spot in self.spots ], False))
+
+  def test_grid_sample_takes_one_spot_per_cell(self):
+    ids, sampled = self.sample(16)
+    self.assertTrue(sampled)
+    locations = set([ (spot.latitude, spot.longitude) for spot in self.spots if spot.id in ids ])
+    self.assertEqual(len(ids), 16)
+    self.assertEqual(len(locations), 16)
+    self.assertEqual(self.sample(16), (ids, True))
+
+  def test_stride_sample_spreads_by_id(self):
+    ids, sampled = self.sample(4, 'stride')
+    self.assertTrue(sampled)
+    self.assertEqual(ids, [ spot.id for spot in self.spots ][::8])
+
+  def test_no_sampling_takes_the_lowest_ids(self):
+    ids, sampled = self.sample(5, None)
+    self.assertEqual((ids, sampled), ([ spot.id for spot in self.spots ][:5], False))
+
+  def test_box_across_the_antimeridian(self):
+    east = self.make_spot("1 Date Line Rd", 10.0, 179.5)
+    west = self.make_spot("2 Date Line Rd", 10.0, -179.5)
+    self.make_spot("3 Date Line Rd", 10.0, 170.0)
+    ids, sampled = self.sample(10, bbox=(179.0, 9.0, -179.0, 11.0))
+    self.assertEqual(ids, [east.id, west.id])
+
+  def test_unknown_sample(self):
+    self.assertRaises(ValueError, self.sample, 10, 'random')
+
+
+class DefaultQuerysetTests(SpotsTestCase):
+  """
+  Hits every spots URL without passing the views a queryset, so they list the
+  installed spot model rather than the abstract Spot.
+  """
+  urls = 'spots.urls'
+
+  def setUp(self):
+    from spots import views
+    super(DefaultQuerysetTests, self).setUp()
+    self.render_to_response = views.render_to_response
+    views.render_to_response = lambda template, context=None, context_instance=None: HttpResponse(template)
+    self.make_spot("1 Main St", 38.97, -95.23, slug="main-st")
+
+  def tearDown(self):
+    from spots import views
+    views.render_to_response = self.render_to_response
+    super(DefaultQuerysetTests, self).tearDown()
+
+  def test_default_spot_model(self):
+    from spots.models import get_default_spot_model
+    self.assertEqual(get_default_spot_model(), TestSpot)
+
+  def test_every_url(self):
+    for url in ('/', '/us/', '/us/ks/', '/us/ks/lawrence/', '/us/ks/lawrence/main-st/',
+                '/export.geojson', '/us/export.ndjson', '/us/ks/export.geojson', '/us/ks/lawrence/export.ndjson',
+                '/clusters/?bbox=-96,38,-95,39&zoom=10', '/search/?q=main', '/heatmap/?bbox=-96,38,-95,39&resolution=1',
+                '/bbox/?bbox=-96,38,-95,39', '/changes/', '/cities/autocomplete/?q=law'):
+      self.assertEqual(self.client.get(url).status_code, 200, url)
+
+  def test_missing_spot_is_a_404(self):
+    self.assertEqual(self.client.get('/us/ks/lawrence/nowhere/').status_code, 404)
@@ -49,6 +49,61 @@ urlpatterns = patterns('',
     view    = edit_spot,
     name    = 'edit_spot',
     ),
+  url(
+    regex   = r'^export\.(?P<format>geojson|ndjson)$',
+    view    = export_spots,
+    name    = 'export_spots',
+    ),
+  url(
+    regex   = r'^(?P<country>[a-z]{2})/export\.(?P<format>geojson|ndjson)$',
+    view    = export_spots,
+    name    = 'export_spots_for_country',
+    ),
+  url(
+    regex   = r'^(?P<country>[a-z]{2})/(?P<state>[-\w]+)/export\.(?P<format>geojson|ndjson)$',
+    view    = export_spots,
+    name    = 'export_spots_for_state',
+    ),
+  url(
+    regex   = r'^(?P<country>[a-z]{2})/(?P<state>[-\w]+)/(?P<city>[-\w]+)/export\.(?P<format>geojson|ndjson)$',
+    view    = export_spots,
+    name    = 'export_spots_for_city',
+    ),
+  url(
+    regex   = r'^(?P<country>[a-z]{2})/(?P<state>[-\w]+)/(?P<city>[-\w]+)/neighborhoods/(?P<slug>[-\w]+)/export\.(?P<format>geojson|ndjson)$',
+    view    = export_spots,
+    name    = 'export_spots_for_neighborhood',
+    ),
+  url(
+    regex   = r'^clusters/$',
+    view    = spot_clusters,
+    name    = 'spot_clusters',
+    ),
+  url(
+    regex   = r'^search/$',
+    view    = spot_search,
+    name    = 'spot_search',
+    ),
+  url(
+    regex   = r'^heatmap/$',
+    view    = spot_heatmap,
+    name    = 'spot_heatmap',
+    ),
+  url(
+    regex   = r'^bbox/$',
+    view    = spots_in_bbox,
+    name    = 'spots_in_bbox',
+    ),
+  url(
+    regex   = r'^changes/$',
+    view    = spot_changes,
+    name    = 'spot_changes',
+    ),
+  url(
+    regex   = r'^cities/autocomplete/$',
+    view    = city_autocomplete,
+    name    = 'city_autocomplete',
+    ),
   url(
     regex   = r'^add/$',
     view    = add_spot,
@@ -1,12 +1,10 @@
-import urllib2
-import xml.etree.ElementTree as ET
 import time
 from urllib import urlencode
 from decimal import Decimal
 
 from django.conf import settings
 
-from spots.models import *
+from spots import instrumentation
 
 
 
@@ -69,6 +67,7 @@ def fetch_and_parse_xml(url, auth_info=None):
   """
   Fetch an XML document (possibly given auth info) and return an ElementTree.
   """
+  import xml.etree.ElementTree as ET
   return ET.parse(fetch_resource(url, auth_info))
 
 
@@ -79,6 +78,7 @@ def fetch_resource(url, auth_info):
   """
   Fetch a resource and return the file-like object.
   """
+  import urllib2
   if auth_info:
     handler = urllib2.HTTPBasicAuthHandler()
     handler.add_password(*auth_info)
@@ -102,6 +102,7 @@ class UrbanMappingClient(object):
   def __repr__(self):
     return "<UrbanMappingClient: %s>" % self.method
 
+  @instrumentation.timed('urban_mapping.fetch')
   def __call__(self, **params):
     url = "http://api0.urbanmapping.com/neighborhoods/rest/" + self.method + "?" + urlencode(params) + "&format=xml"
     response = fetch_and_parse_xml(url)
@@ -110,12 +111,14 @@ class UrbanMappingClient(object):
 
 
 
+@instrumentation.timed('geocode.google')
 def get_location_from_address(address):
   """
   Geocodes this spot based on the address entered.
   Returns a tuple like (place, (latitude, longitude)).
   If the address could not be geocoded, returns ("", (None, None)).
   """
+  from geopy.geocoders.google import Google
   google_geocoder = Google(settings.GOOGLE_MAPS_API_KEY)
   location_list = [ (place, (lat,lng)) for place, (lat, lng) in google_geocoder.geocode(address, exactly_one=False) ]
   if len(location_list):
@@ -131,11 +134,12 @@ def get_street_address(address):
   try: return address.split(", ")[0]
   except: return ""
   
+@instrumentation.timed('geocode')
 def geocode(address):
   from spots.models import City
   """ Returns a tuple of useful info. Input can be an address string or a string like "lat,lng"  """
   import requests
-  time.sleep(.5)
+  instrumentation.sleep(.5, 'geocode')
   url="http://maps.googleapis.com/maps/api/geocode/json?address=%s&sensor=false" % address
   r = requests.get(url)
   json = r.json()
@@ -178,6 +182,50 @@ def get_city_from_point(latitude, longitude):
 def get_address_from_point(latitude, longitude):
   return geocode('%s, %s' % (latitude, longitude))[0]
 
+def get_bounding_box(location, miles):
+  """
+  Returns a (west, south, east, north) bounding box holding everything within
+  the given number of miles of a (latitude, longitude) tuple. A degree of
+  longitude shrinks away from the equator, so the box is widened to match.
+  """
+  import math
+  latitude, longitude = float(location[0]), float(location[1])
+  latitude_delta = float(miles) / 69.04
+  longitude_delta = latitude_delta / max(math.cos(math.radians(latitude)), 0.01)
+  return (longitude - longitude_delta, latitude - latitude_delta, longitude + longitude_delta, latitude + latitude_delta)
+
+
+def get_distance_between_locations(origin, location):
+  """
+  Returns the distance, in miles, between two (latitude, longitude) tuples.
+  """
+  import math
+  latitude, longitude = location
+  origin_latitude, origin_longitude = float(origin[0]), float(origin[1])
+  rad = math.pi / 180.0
+  y_distance = (float(latitude) - origin_latitude) * 69.04
+  x_distance = (math.cos(origin_latitude * rad) + math.cos(float(latitude) * rad)) * (float(longitude) - origin_longitude) * (69.04 / 2)
+  return math.sqrt( y_distance**2 + x_distance**2 )
+
+
+def get_bearing_between_locations(origin, location):
+  """
+  Returns the bearing, in degrees, from the origin (latitude, longitude) tuple
+  to another one.
+  """
+  import math
+  latitude, longitude = location
+  lat1 = float(latitude)
+  lat2 = float(origin[0])
+  lon1 = float(longitude)
+  lon2 = float(origin[1])
+  dLon = lon2 - lon1
+  y = math.sin(dLon) * math.cos(lat2)
+  x = math.cos(lat1) * math.sin(lat2) - math.sin(lat1) * math.cos(lat2) * math.cos(dLon)
+  degrees_180 = math.degrees(math.atan2(y, x))
+  return (degrees_180 + 360) % 360
+
+
 def get_compass_direction_from_bearing(d):
     d = (d % 360) + 360/64
     majorindex, minor = divmod(d, 90.)
@@ -197,6 +245,8 @@ def get_compass_direction_from_bearing(d):
     
   
 def get_neighborhood_from_urban_mapping(latitude, longitude, city=None):
+  from django.template.defaultfilters import slugify
+  from spots.models import Neighborhood
   neighborhood = None
   try:
     if not city:
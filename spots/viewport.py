@@ -0,0 +1,82 @@
+import math
+
+from django.db.models import Max, Min
+
+from spots.export import filter_by_bbox, get_column_sql, get_floor_sql
+
+
+SAMPLE_METHODS = ('grid', 'stride')
+
+
+
+
+def _first_id_per_cell(queryset, cells, limit):
+  # Groups the spots by the given SQL cell expressions in the database, and
+  # returns the lowest "limit" of the lowest ids in each group. Only one row
+  # per group is read.
+  select = dict([ ('cell_%d' % i, cell) for i, cell in enumerate(cells) ])
+  groups = queryset.order_by().extra(select=select).values(*select.keys()).annotate(first_id=Min('id'))
+  return sorted([ group['first_id'] for group in groups ])[:limit]
+
+
+def sample_ids_on_grid(queryset, bbox, limit):
+  """
+  Picks up to limit ids of spots in the queryset, spread evenly over the
+  (west, south, east, north) box. The box is split into a grid of at least
+  limit cells, and the lowest id in each cell is kept, so the same viewport
+  always gives the same spots. The database works out the cells.
+  """
+  west, south, east, north = bbox
+  width = (west > east and east + 360 or east) - west
+  height = north - south
+  side = int(math.ceil(math.sqrt(limit)))
+  latitude = get_column_sql(queryset.model, 'latitude')
+  longitude = get_column_sql(queryset.model, 'longitude')
+  if west > east:
+    # Shift longitudes past the antimeridian so they increase steadily from
+    # the box's west edge.
+    longitude = "(CASE WHEN %s < (%r) THEN %s + 360 ELSE %s END)" % (longitude, float(west), longitude, longitude)
+  # The cell sizes are written into the SQL, rather than passed as
+  # parameters, so the grouped expressions are the same as the selected ones.
+  column = get_floor_sql("((%s - (%r)) / %r)" % (longitude, float(west), float(width or 1) / side))
+  row = get_floor_sql("((%s - (%r)) / %r)" % (latitude, float(south), float(height or 1) / side))
+  return _first_id_per_cell(queryset, [column, row], limit)
+
+
+def sample_ids_by_stride(queryset, limit):
+  """
+  Picks up to limit ids of spots in the queryset, evenly spaced by id. The
+  range of ids is split into limit equal parts, and the lowest id in each
+  part is kept.
+  """
+  bounds = queryset.order_by().aggregate(first=Min('id'), last=Max('id'))
+  if bounds['first'] is None:
+    return []
+  size = float(bounds['last'] - bounds['first'] + 1) / limit
+  part = get_floor_sql("((%s - %d) / %r)" % (get_column_sql(queryset.model, 'id'), bounds['first'], size))
+  return _first_id_per_cell(queryset, [part], limit)
+
+
+def get_spots_in_bbox(queryset, bbox, limit=500, sample='grid'):
+  """
+  Returns a QuerySet of at most limit spots in a (west, south, east, north)
+  bounding box, ordered by id, and whether it was sampled. A box whose west
+  edge is greater than its east edge crosses the antimeridian.
+
+  If the box holds more than limit spots, they're sampled: "grid" spreads
+  them evenly over the box, "stride" spreads them evenly by id, and None
+  takes the limit spots with the lowest ids. Samples are picked by the
+  database with a GROUP BY, so however many spots the box holds, only about
+  limit rows are read. The sample only depends on the spots in the box, so
+  a viewport gives the same spots every time.
+  """
+  if sample is not None and sample not in SAMPLE_METHODS:
+    raise ValueError("Sample should be one of %s, or None." % ", ".join(SAMPLE_METHODS))
+  spots = filter_by_bbox(queryset, bbox).order_by('id')
+  if len(spots.values_list('id', flat=True)[:limit + 1]) <= limit or sample is None:
+    return spots[:limit], False
+  if sample == 'grid':
+    ids = sample_ids_on_grid(spots, bbox, limit)
+  else:
+    ids = sample_ids_by_stride(spots, limit)
+  return spots.filter(id__in=ids), True
@@ -1,13 +1,31 @@
+import heapq
+
 from django.shortcuts import get_object_or_404, get_list_or_404, render_to_response
-from django.http import HttpResponse, HttpResponseRedirect, Http404
+from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseRedirect, Http404
 from django.template import RequestContext
-from django.template.defaultfilters import slugify, dictsort, dictsortreversed
+from django.template.defaultfilters import slugify
 from django.core.urlresolvers import reverse
 from django.contrib.auth.decorators import login_required
+from django.core.cache import cache
+from django.db.models import get_model
+from django.utils import simplejson
 
+from spots.autocomplete import city_index
+from spots.catalog import city_catalog
+from spots.changes import MAX_LIMIT as MAX_CHANGES, get_changes_since, serialize_changes
+from spots.cache import cache_spots_view, spots_etag, get_cache_key, CACHE_TIMEOUT
+from spots.clustering import MAX_ZOOM, get_clusters
 from spots.constants import COUNTRY_CHOICES
+from spots.export import EXPORT_FORMATS, STREAMERS, filter_by_bbox, iterate_spot_rows, parse_bbox
 from spots.forms import *
+from spots.heatmap import RESOLUTIONS, get_heatmap
+from spots.instrumentation import instrument_view, record_cache_lookup
 from spots.models import *
+from spots.routers import pin_primary_after_write, read_from_replica, using_read_database
+from spots.rows import get_in_bulk, get_spot_rows, get_spot_rows_in_bulk
+from spots.search import search_places, search_spots
+from spots.utils import get_bearing_between_locations, get_bounding_box, get_compass_direction_from_bearing
+from spots.viewport import SAMPLE_METHODS, get_spots_in_bbox
 
 def format_qs(q):
   """
@@ -21,6 +39,50 @@ def format_qs(q):
   return kw
 
 
+def get_spot_queryset(queryset=None):
+  """
+  Returns the queryset a view was given, or all the spots of the default
+  spot model if it wasn't given one.
+  """
+  if queryset is None:
+    return get_default_spot_model()._default_manager.all()
+  return queryset
+
+
+def get_spots_by_distance(queryset, spot, start=0, stop=None, descending=False, max_distance=None, rows=False):
+  """
+  Returns dicts like {'spot': spot, 'distance': distance, 'direction': direction}
+  for the spots in the queryset from start to stop, ordered by distance from
+  the given spot. Only ids and coordinates are fetched to rank the spots, and
+  just the rows that are returned are loaded and get a compass direction. If
+  max_distance (in miles) is given, spots further away are left out. If rows
+  is True, the spots are SpotRows rather than model instances.
+  """
+  if max_distance is not None:
+    max_distance = float(max_distance)
+    queryset = filter_by_bbox(queryset, get_bounding_box(spot.location(), max_distance))
+  ranked = []
+  for id, latitude, longitude in queryset.values_list('id', 'latitude', 'longitude').iterator():
+    if latitude is None or longitude is None:
+      continue
+    distance = spot._get_distance_to_location((latitude, longitude))
+    if max_distance is None or distance <= max_distance:
+      ranked.append((distance, id))
+  if stop is None:
+    ranked.sort(reverse=descending)
+  elif descending:
+    ranked = heapq.nlargest(stop, ranked)
+  else:
+    ranked = heapq.nsmallest(stop, ranked)
+  ranked = ranked[start:stop]
+  # Without a stop, every spot is returned, so they're loaded in batches.
+  if rows:
+    spots = get_spot_rows_in_bulk(queryset, [ id for distance, id in ranked ])
+  else:
+    spots = get_in_bulk(queryset, [ id for distance, id in ranked ])
+  return [ {'spot': spots[id], 'distance': distance, 'direction': spot._get_compass_direction_to_spot(spots[id]) } for distance, id in ranked if id in spots ]
+
+
 def get_city_from_url_bits(country, city, state=None):
   """
   Utility function to find a city object from parts of a URL. If the city
@@ -30,8 +92,10 @@ def get_city_from_url_bits(country, city, state=None):
     city_slug = slugify(city + " " + state + " " + country)
   else: 
     city_slug = slugify(city + " " + country)
-  city = get_object_or_404(City, slug=city_slug)
-  return city
+  record = city_catalog.get_by_slug(city_slug)
+  if record is None:
+    raise Http404
+  return record.to_city()
 
 
 def build_breadcrumbs(country=None, state=None, city=None, spot=None):
@@ -45,9 +109,8 @@ def build_breadcrumbs(country=None, state=None, city=None, spot=None):
   breadcrumbs = [{'name': 'Spots', 'url': reverse('spot_list')}]
   view_name = "spots"
   if country:
-    country_display = City.objects.filter(country=country)[0].get_country_display()
-    country_code = City.objects.filter(country=country)[0].country
-    breadcrumbs.append({'view': 'country', 'name': country_display, 'url': reverse('spot_list_for_country', args=[country_code])})
+    country_display = dict(COUNTRY_CHOICES).get(country, country)
+    breadcrumbs.append({'view': 'country', 'name': country_display, 'url': reverse('spot_list_for_country', args=[country])})
     view_name = "country-%s" % country
   if state:
     breadcrumbs.append({'view': 'state/province', 'name': state, 'url': reverse('spot_list_for_state', args=[country, slugify(state)])})
@@ -61,16 +124,63 @@ def build_breadcrumbs(country=None, state=None, city=None, spot=None):
   return breadcrumbs, view_name
 
 
-def spot_list(request, queryset=Spot.objects.all(), template="spots/spot_list.html", relevant_to_spot=None, extra_context={}):
+def get_countries_with_spots():
+  """
+  Returns a list of dicts for the countries that have spots, for rendering in
+  templates. The list is cached until any spot, city or neighborhood changes.
+  """
+  key = get_cache_key('spots', 'countries')
+  countries = key and cache.get(key)
+  if key:
+    record_cache_lookup('cache.countries', countries is not None)
+  if countries is None:
+    cities_with_spots = City.objects.filter(id__in=get_spot_queryset().values('city'))
+    countries = []
+    for city in cities_with_spots:
+      for country in COUNTRY_CHOICES:
+        if country[0] == city.country:
+          country_dict = { 'code': city.country, 'name': country[1], 'url': reverse('spot_list_for_country', args=[city.country])}
+          if country_dict not in countries:
+            countries.append(country_dict)
+          break
+    if key:
+      cache.set(key, countries, CACHE_TIMEOUT)
+  return countries
+
+
+@instrument_view('spot_list')
+@read_from_replica
+@spots_etag('spots')
+@cache_spots_view('spots')
+def spot_list(request, queryset=None, template="spots/spot_list.html", relevant_to_spot=None, paginate_by=None, rows=False, extra_context={}):
   """
   Renders a list of spots. Defaults to all spots, but takes an optional
   QuerySet argument. If a Spot is passed to the "relevant_to_spot" argument, the output
   will include details as to the distance and direction of each spot from the 
-  relevant_to_spot.
+  relevant_to_spot. If paginate_by is given, only the requested "page" is rendered.
+  If rows is True, the list holds lightweight SpotRows (id, address, coordinates,
+  city id, slug and URL) instead of full spot instances.
   """
+  queryset = get_spot_queryset(queryset)
   spots         = queryset
   query         = dict(request.REQUEST.items())
   order_by      = query.pop('order_by', '-date_created')
+  max_distance  = query.pop('max_distance', None)
+  try:
+    page        = max(int(query.pop('page', 1)), 1)
+  except ValueError:
+    page        = 1
+  if max_distance is not None:
+    try:
+      max_distance = float(max_distance)
+    except ValueError:
+      max_distance = None
+  
+  # Work out which rows of the list are on the requested page.
+  if paginate_by:
+    start, stop = (page - 1) * paginate_by, page * paginate_by
+  else:
+    start, stop = 0, None
   
   # If a Django QS filter was submited with the request, apply it.
   if len(query):
@@ -83,23 +193,20 @@ def spot_list(request, queryset=Spot.objects.all(), template="spots/spot_list.ht
   
   # Create the spot dicts for rendering in templates. If relevant_to_spot was speficied,
   # include the distance and direction from that spot.
-  if relevant_to_spot:
-    spots = [ {'spot': spot, 'distance': relevant_to_spot._get_distance_to_spot(spot), 'direction': relevant_to_spot._get_compass_direction_to_spot(spot) } for spot in spots ]
-    if order_by == '-distance': spots = dictsort(spots, 'distance')
-    if order_by == 'distance': spots = dictsortreversed(spots, 'distance')
+  if relevant_to_spot and order_by in ('distance', '-distance'):
+    spots = get_spots_by_distance(spots, relevant_to_spot, start, stop, descending=order_by == '-distance', max_distance=max_distance, rows=rows)
   else:
-    spots = [ {'spot': spot, 'distance': None, 'direction': None } for spot in spots ]
+    if rows:
+      spots = get_spot_rows(spots[start:stop])
+    else:
+      spots = spots[start:stop]
+    if relevant_to_spot:
+      spots = [ {'spot': spot, 'distance': relevant_to_spot._get_distance_to_spot(spot), 'direction': relevant_to_spot._get_compass_direction_to_spot(spot) } for spot in spots ]
+    else:
+      spots = [ {'spot': spot, 'distance': None, 'direction': None } for spot in spots ]
   
   # Create a list of countries that have spots, for rendering in the templates.
-  cities_with_spots = City.objects.filter(spots__isnull=False).distinct()
-  countries = []
-  for city in cities_with_spots:
-    for country in COUNTRY_CHOICES:
-      if country[0] == city.country:
-        country_dict = { 'code': city.country, 'name': country[1], 'url': reverse('spot_list_for_country', args=[city.country])}
-        if country_dict not in countries:
-          countries.append(country_dict)
-        break
+  countries = get_countries_with_spots()
   
   # Build the breadcrumbs for this list.
   breadcrumbs, view_name = build_breadcrumbs()
@@ -108,6 +215,8 @@ def spot_list(request, queryset=Spot.objects.all(), template="spots/spot_list.ht
   context = { 
     'spots': spots, 
     'order_by': order_by, 
+    'page': page,
+    'paginate_by': paginate_by,
     'view_name': view_name, 
     'countries': countries,
   }
@@ -115,6 +224,9 @@ def spot_list(request, queryset=Spot.objects.all(), template="spots/spot_list.ht
   return render_to_response(template, context, context_instance=RequestContext(request))
 
 
+@instrument_view('spot_detail')
+@read_from_replica
+@spots_etag('spot', 'country', 'state', 'city', 'slug')
 def spot_detail(request, country, city, slug, state=None, template='spots/spot_detail.html', relevant_to_spot=None, extra_context={}):
   """
   Renders a individual spot's detail page. If a Spot is passed to the "relevant_to_spot" 
@@ -123,7 +235,7 @@ def spot_detail(request, country, city, slug, state=None, template='spots/spot_d
   """
   # Find the spot. If it's not found, 404.
   city = get_city_from_url_bits(country, city, state)
-  spot = get_object_or_404(Spot, city=city, slug=slug)
+  spot = get_object_or_404(get_spot_queryset(), city=city, slug=slug)
   
   # If relevant_to_spot was specified, get the distance and direction calculations.
   if relevant_to_spot:
@@ -151,6 +263,7 @@ def spot_detail(request, country, city, slug, state=None, template='spots/spot_d
   return render_to_response(template, context, context_instance=RequestContext(request))
 
 
+@pin_primary_after_write
 @login_required
 def add_spot(request, template="spots/add_spot.html", extra_context={}):
   """
@@ -176,6 +289,7 @@ def add_spot(request, template="spots/add_spot.html", extra_context={}):
   return render_to_response(template, context, context_instance=RequestContext(request))
 
 
+@pin_primary_after_write
 @login_required
 def edit_spot(request, country, city, slug, state=None, template="spots/edit_spot.html", extra_context={}):
   """
@@ -183,7 +297,7 @@ def edit_spot(request, country, city, slug, state=None, template="spots/edit_spo
   """
   # Find the spot. If it's not found, 404.
   city = get_city_from_url_bits(country, city, state)
-  spot = get_object_or_404(Spot, city=city, slug=slug)
+  spot = get_object_or_404(get_spot_queryset(), city=city, slug=slug)
   
   # If this is a POST, bind the data to the form and try to save the spot.
   if request.method == 'POST':
@@ -207,10 +321,16 @@ def edit_spot(request, country, city, slug, state=None, template="spots/edit_spo
   return render_to_response(template, context, context_instance=RequestContext(request))
 
 
-def spot_list_for_country(request, country, queryset=Spot.objects.all()):
+@instrument_view('spot_list_for_country')
+@read_from_replica
+@spots_etag('country', 'country')
+@cache_spots_view('country', 'country')
+def spot_list_for_country(request, country, queryset=None):
   """
   Displays a list of spots for a given country.
   """
+  queryset = get_spot_queryset(queryset)
+  
   # Find all the cites in this county.
   cities = City.objects.filter(country=country)
   
@@ -219,9 +339,9 @@ def spot_list_for_country(request, country, queryset=Spot.objects.all()):
   
   # Get a list of all states (or provinces) in this country.
   if country == "us":
-    states = City.objects.filter(country=country, spots__isnull=False).distinct().values('state').distinct()
+    states = cities.filter(id__in=queryset.values('city')).values('state').distinct()
   else:
-    states = City.objects.filter(country=country, spots__isnull=False).distinct().values('province').distinct()
+    states = cities.filter(id__in=queryset.values('city')).values('province').distinct()
   
   # For each state (or province), create a dictionary for inclusion in template. 
   # Dict keys are: name, url, code, count
@@ -229,14 +349,14 @@ def spot_list_for_country(request, country, queryset=Spot.objects.all()):
   for state in states:
     if country == "us":
       state = state['state']
-      state_dict = { 'name': cities.filter(state=state)[0].get_state_display(), 'url': reverse('spot_list_for_state', args=[country, slugify(state)]), 'code': state.lower(), 'count': Spot.objects.filter(city__in=cities, city__state=state).count() }
+      state_dict = { 'name': cities.filter(state=state)[0].get_state_display(), 'url': reverse('spot_list_for_state', args=[country, slugify(state)]), 'code': state.lower(), 'count': queryset.filter(city__in=cities, city__state=state).count() }
     else:
       province = state['province']
       try:
         province_url = reverse('spot_list_for_state', args=[country, slugify(province)])
       except:
         province_url = ''
-      state_dict = { 'name': province, 'url': province_url, 'code': province.lower(), 'count': Spot.objects.filter(city__in=cities, city__province=province).count() }
+      state_dict = { 'name': province, 'url': province_url, 'code': province.lower(), 'count': queryset.filter(city__in=cities, city__province=province).count() }
     state_list.append(state_dict)
   
   # Create the context and render the template.
@@ -248,15 +368,21 @@ def spot_list_for_country(request, country, queryset=Spot.objects.all()):
     'breadcrumbs': breadcrumbs, 
     'view_name': view_name
   }
-  return spot_list(request,queryset=Spot.objects.filter(city__in=cities), extra_context=context)
+  return spot_list(request, queryset=queryset.filter(city__in=cities), extra_context=context)
 
 
-def spot_list_for_state(request, country, state, queryset=Spot.objects.all()):
+@instrument_view('spot_list_for_state')
+@read_from_replica
+@spots_etag('state', 'country', 'state')
+@cache_spots_view('state', 'country', 'state')
+def spot_list_for_state(request, country, state, queryset=None):
   """
   Displays a list of spots for a given state (or province).
   """
+  queryset = get_spot_queryset(queryset)
+  
   # Get a list of all cities in this state (or province).
-  cities = City.objects.filter(slug__endswith=slugify(state + " " + country), spots__isnull=False).distinct()
+  cities = City.objects.filter(slug__endswith=slugify(state + " " + country), id__in=queryset.values('city'))
   
   # Determine the country for this city.
   country = cities[0].country
@@ -269,7 +395,7 @@ def spot_list_for_state(request, country, state, queryset=Spot.objects.all()):
       raise Exception
   except:
     try:
-      return city_detail(request=request, country=country, city=state) # This is probably supposed to be a city view, not a state view.
+      return city_detail(request=request, country=country, city=state, queryset=queryset) # This is probably supposed to be a city view, not a state view.
     except:
       raise Http404
   
@@ -292,13 +418,19 @@ def spot_list_for_state(request, country, state, queryset=Spot.objects.all()):
     'breadcrumbs': breadcrumbs, 
     'view_name': view_name,
   }
-  return spot_list(request,queryset=Spot.objects.filter(city__in=cities), extra_context=context)
+  return spot_list(request, queryset=queryset.filter(city__in=cities), extra_context=context)
 
 
-def city_detail(request, country, city, state=None, queryset=Spot.objects.all()):
+@instrument_view('city_detail')
+@read_from_replica
+@spots_etag('city', 'country', 'state', 'city')
+@cache_spots_view('city', 'country', 'state', 'city')
+def city_detail(request, country, city, state=None, queryset=None):
   """
   Displays the details of a particular city.
   """
+  queryset = get_spot_queryset(queryset)
+  
   # Determine the city. If this fails, it'll 404.
   city = get_city_from_url_bits(country, city, state)
   
@@ -319,13 +451,19 @@ def city_detail(request, country, city, state=None, queryset=Spot.objects.all())
     'breadcrumbs': breadcrumbs, 
     'view_name': view_name,
   }
-  return spot_list(request, queryset=Spot.objects.filter(city=city), extra_context=context)
+  return spot_list(request, queryset=queryset.filter(city=city), extra_context=context)
   
   
-def spot_list_for_neighborhood(request, country, city, slug, state=None, queryset=Spot.objects.all()):
+@instrument_view('spot_list_for_neighborhood')
+@read_from_replica
+@spots_etag('neighborhood', 'country', 'state', 'city', 'slug')
+@cache_spots_view('neighborhood', 'country', 'state', 'city', 'slug')
+def spot_list_for_neighborhood(request, country, city, slug, state=None, queryset=None):
   """
   Displays a list of spots for a given neighborhood (or province).
   """
+  queryset = get_spot_queryset(queryset)
+  
   # Determine the city. If this fails, it'll 404.
   city = get_city_from_url_bits(country, city, state)
   
@@ -347,9 +485,11 @@ def spot_list_for_neighborhood(request, country, city, slug, state=None, queryse
     'breadcrumbs': breadcrumbs, 
     'view_name': view_name,
   }
-  return spot_list(request, queryset=Spot.objects.filter(city=city, neighborhoods=neighborhood), extra_context=context)
+  return spot_list(request, queryset=queryset.filter(city=city, neighborhoods=neighborhood), extra_context=context)
   
   
+@instrument_view('neighborhood_list_for_city')
+@read_from_replica
 def neighborhood_list_for_city(request, country, city, state=None, template="spots/city_neighborhood_list.html", extra_context={}):
   """
   Displays a list of neighborhoods for a given city.
@@ -375,4 +515,208 @@ def neighborhood_list_for_city(request, country, city, state=None, template="spo
     'view_name': view_name,
   }
   context.update(extra_context)
-  return render_to_response(template, context, context_instance=RequestContext(request))
\ No newline at end of file
+  return render_to_response(template, context, context_instance=RequestContext(request))
+
+
+@instrument_view('export_spots')
+@read_from_replica
+def export_spots(request, format, country=None, state=None, city=None, slug=None, queryset=None):
+  """
+  Streams spots as GeoJSON or NDJSON. Narrow the export with the country,
+  state, city and neighborhood slug from the URL, and/or with a
+  "bbox=west,south,east,north" query parameter.
+  """
+  queryset = get_spot_queryset(queryset)
+  if format not in EXPORT_FORMATS:
+    raise Http404
+  spots = queryset
+  
+  # Narrow the spots to the geographic scope in the URL.
+  if city:
+    city = get_city_from_url_bits(country, city, state)
+    spots = spots.filter(city=city)
+    if slug:
+      neighborhood = get_object_or_404(Neighborhood, city=city, slug=slug)
+      spots = spots.filter(neighborhoods=neighborhood)
+  elif state:
+    spots = spots.filter(city__in=City.objects.filter(slug__endswith=slugify(state + " " + country)))
+  elif country:
+    spots = spots.filter(city__country=country)
+  
+  # If a bounding box was submitted with the request, apply it.
+  if 'bbox' in request.GET:
+    bbox = parse_bbox(request.GET['bbox'])
+    if bbox is None:
+      raise Http404
+    spots = filter_by_bbox(spots, bbox)
+  
+  # The rows are read as the response is sent, after this view has returned.
+  spots = using_read_database(spots)
+  return HttpResponse(STREAMERS[format](iterate_spot_rows(spots)), mimetype=EXPORT_FORMATS[format])
+
+
+@instrument_view('spot_clusters')
+@read_from_replica
+def spot_clusters(request, queryset=None):
+  """
+  Returns the spots in a viewport as JSON clusters, for drawing maps without
+  one marker per spot. Takes "bbox=west,south,east,north" and "zoom" query
+  parameters. Each cluster has a count, a centroid and a bounding box.
+  """
+  queryset = get_spot_queryset(queryset)
+  bbox = parse_bbox(request.GET.get('bbox'))
+  try:
+    zoom = int(request.GET.get('zoom', ''))
+  except ValueError:
+    zoom = None
+  if bbox is None or zoom is None or not 0 <= zoom <= MAX_ZOOM:
+    return HttpResponseBadRequest("Pass a bbox (west,south,east,north) and a zoom level between 0 and %s." % MAX_ZOOM)
+  try:
+    clusters = get_clusters(queryset, bbox, zoom)
+  except ValueError as e:
+    return HttpResponseBadRequest(str(e))
+  return HttpResponse(simplejson.dumps({'zoom': zoom, 'clusters': clusters}), mimetype='application/json')
+
+
+@instrument_view('spot_search')
+@read_from_replica
+def spot_search(request, queryset=None, template="spots/spot_search.html", limit=20, extra_context={}):
+  """
+  Renders the spots whose addresses match the "q" query parameter, and the
+  cities and neighborhoods whose names do. Spots are found with the
+  in-process text index rather than scanning addresses, and can be narrowed
+  with "bbox=west,south,east,north". With "latitude" and "longitude", they're
+  ranked by text relevance and distance from there together, and each comes
+  with its distance and direction. Spots are SpotRows.
+  """
+  queryset = get_spot_queryset(queryset)
+  query = request.GET.get('q', '').strip()
+  bbox = None
+  if 'bbox' in request.GET:
+    bbox = parse_bbox(request.GET['bbox'])
+    if bbox is None:
+      return HttpResponseBadRequest("The bbox should be west,south,east,north.")
+  try:
+    location = (float(request.GET['latitude']), float(request.GET['longitude']))
+  except (KeyError, ValueError):
+    location = None
+  
+  spots, cities, neighborhoods = [], [], []
+  if query:
+    spots = search_spots(queryset, query, location, bbox, limit)
+    cities, neighborhoods = search_places(query)
+  if location is not None:
+    for result in spots:
+      if result['distance'] is not None:
+        result['direction'] = get_compass_direction_from_bearing(get_bearing_between_locations(location, result['spot'].location()))
+  
+  # Build the breadcrumbs for this page.
+  breadcrumbs, view_name = build_breadcrumbs()
+  
+  # Create the context and render the template.
+  context = {
+    'query': query,
+    'spots': spots,
+    'cities': cities,
+    'neighborhoods': neighborhoods,
+    'breadcrumbs': breadcrumbs,
+    'view_name': view_name,
+  }
+  context.update(extra_context)
+  return render_to_response(template, context, context_instance=RequestContext(request))
+
+
+@instrument_view('spot_heatmap')
+@read_from_replica
+def spot_heatmap(request, queryset=None):
+  """
+  Returns how many spots (or, with "type=cities", cities) there are in each
+  cell of a grid over a viewport, as JSON [latitude, longitude, count] cells
+  for drawing heatmaps. Takes "bbox=west,south,east,north" and "resolution"
+  (the cell size in degrees) query parameters. Counts cover every spot of
+  the queryset's model.
+  """
+  queryset = get_spot_queryset(queryset)
+  model = request.GET.get('type') == 'cities' and City or queryset.model
+  bbox = parse_bbox(request.GET.get('bbox'))
+  try:
+    resolution = float(request.GET.get('resolution', ''))
+  except ValueError:
+    resolution = None
+  if bbox is None or resolution not in RESOLUTIONS:
+    return HttpResponseBadRequest("Pass a bbox (west,south,east,north) and a resolution of %s degrees." % ", ".join([ str(r) for r in RESOLUTIONS ]))
+  try:
+    cells = get_heatmap(model, bbox, resolution)
+  except ValueError as e:
+    return HttpResponseBadRequest(str(e))
+  return HttpResponse(simplejson.dumps({'resolution': resolution, 'cells': cells}), mimetype='application/json')
+
+
+@instrument_view('spots_in_bbox')
+@read_from_replica
+def spots_in_bbox(request, queryset=None, max_limit=1000):
+  """
+  Returns the spots in a viewport as JSON map markers, like the ones the
+  gmap_spots tag draws: [latitude, longitude, address, url, 1]. Takes
+  "bbox=west,south,east,north", and optional "limit" and "sample" (grid,
+  stride or none) query parameters. Viewports holding more than the limit
+  get a deterministic sample, and "sampled" is true.
+  """
+  queryset = get_spot_queryset(queryset)
+  bbox = parse_bbox(request.GET.get('bbox'))
+  try:
+    limit = min(int(request.GET.get('limit', 500)), max_limit)
+  except ValueError:
+    limit = None
+  sample = request.GET.get('sample', 'grid')
+  if sample == 'none':
+    sample = None
+  if bbox is None or not limit or limit < 1 or (sample is not None and sample not in SAMPLE_METHODS):
+    return HttpResponseBadRequest("Pass a bbox (west,south,east,north), and optionally a limit up to %s and a sample of %s or none." % (max_limit, ", ".join(SAMPLE_METHODS)))
+  spots, sampled = get_spots_in_bbox(queryset, bbox, limit, sample)
+  markers = [ [float(row.latitude), float(row.longitude), row.address, row.url, 1] for row in get_spot_rows(spots) ]
+  return HttpResponse(simplejson.dumps({'markers': markers, 'sampled': sampled}), mimetype='application/json')
+
+
+@instrument_view('spot_changes')
+def spot_changes(request):
+  """
+  Returns the spots, cities and neighborhoods changed since a cursor, as JSON,
+  for clients keeping their own copy in sync. Takes "cursor" (0, or the
+  cursor from the previous page), "limit" and "type" (a comma-separated list
+  like "spots.city,places.restaurant") query parameters. Deleted objects are
+  listed as tombstones; keep asking with the returned cursor while "more" is
+  true. Reads come from the primary, and changes are only listed once
+  they're SPOTS_CHANGE_SETTLE_SECONDS old, so a page never skips one.
+  """
+  try:
+    cursor = max(int(request.GET.get('cursor', 0)), 0)
+    limit = min(max(int(request.GET.get('limit', 100)), 1), MAX_CHANGES)
+  except ValueError:
+    return HttpResponseBadRequest("The cursor and limit should be whole numbers.")
+  models = None
+  if request.GET.get('type'):
+    models = []
+    for label in request.GET['type'].split(','):
+      try:
+        app_label, model_name = label.split('.')
+      except ValueError:
+        return HttpResponseBadRequest("Types should be given as app_label.modelname, not %r." % label)
+      model = get_model(app_label, model_name)
+      if model is None:
+        return HttpResponseBadRequest("There is no %s model." % label)
+      models.append(model)
+  changes, cursor, more = get_changes_since(cursor, limit, models)
+  return HttpResponse(simplejson.dumps({'changes': serialize_changes(changes), 'cursor': cursor, 'more': more}), mimetype='application/json')
+
+
+@instrument_view('city_autocomplete')
+@read_from_replica
+def city_autocomplete(request, limit=10):
+  """
+  Returns the cities whose names start with the "q" query parameter as JSON,
+  like [{"id": 1, "name": "Lawrence, KS, United States"}], for type-ahead
+  city fields. Answered from the in-memory city index.
+  """
+  cities = city_index.search(request.GET.get('q', ''), limit)
+  return HttpResponse(simplejson.dumps([ {'id': id, 'name': name} for id, name in cities ]), mimetype='application/json')
\ No newline at end of file
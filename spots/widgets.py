@@ -5,15 +5,17 @@ from django.utils.safestring import mark_safe
 from django.conf import settings
 from django.utils.encoding import smart_unicode
 
+from spots.assets import render_assets
+from spots.lookups import get_city_by_id
 from spots.models import *
 
 class CityInput(forms.TextInput):
   def render(self, name, value, attrs=None):
     if value:
-      try:
-        city = City.objects.get(id=int(value))
+      city = get_city_by_id(value)
+      if city:
         value = city.full_name()
-      except:
+      else:
         value = ""
     return super(CityInput, self).render(name, value, attrs=attrs)
 
@@ -32,48 +34,8 @@ class AddressInput(forms.TextInput):
   
   def render(self, name, value, attrs=None):
     output = super(AddressInput, self).render(name, value, attrs)
-    output = output + mark_safe(u'''<div id="address-map-wrapper"><a href="#" id="address-map-open" class="button">Map</a><div id="address-map"></div></div>''')
-    return output + mark_safe(u'''
-      <script src="http://maps.google.com/maps?file=api&amp;v=2&amp;key=%s" type="text/javascript"></script>
-      <script type="text/javascript">
-        function create_map() {
-          if (GBrowserIsCompatible()) {
-          
-            if (typeof(spot) !== 'undefined') {
-              if (spot.latitude && spot.longitude) {
-                point = new GLatLng(spot.latitude,spot.longitude);
-              }
-            } else if (typeof(user) !== 'undefined') {
-              if (user.latitude && user.longitude) {
-                point = new GLatLng(user.latitude,user.longitude);
-              } else {
-                  point = new GLatLng(%s,%s);
-                }
-            } else {
-              point = new GLatLng(%s,%s);
-            }
-            
-            var map = new GMap2(document.getElementById("address-map"));
-            map.setCenter(point, 14, G_PHYSICAL_MAP);
-            map.addControl(new GSmallZoomControl());
-            markerOptions = { clickable:true, draggable:true }
-            marker = new GMarker(point, markerOptions);
-            GEvent.addListener(marker, "dragend", function(){
-              var point = marker.getPoint();
-              $('#%s').val(point);
-            });
-            map.addOverlay(marker);
-            return map;
-          }
-        }
-        jQuery(document).ready(function(){
-          map = create_map();
-          $('#address-map-open').click(function(e){
-            e.preventDefault();
-            $('#address-map').toggle();
-            map.zoomIn();
-          });
-          $('#address-map').hide();
-        });
-      </script>
-    ''' % (settings.GOOGLE_MAPS_API_KEY, self.start_latitude, self.start_longitude, self.start_latitude, self.start_longitude, attrs['id']))
\ No newline at end of file
+    # The map itself is set up by the shared widgets script, from the data
+    # attributes on the wrapper. It goes by classes, not ids, so a form can
+    # have several of these.
+    output = output + mark_safe(u'''<div class="address-map-wrapper" data-input="%s" data-latitude="%s" data-longitude="%s"><a href="#" class="address-map-open button">Map</a><div class="address-map"></div></div>''' % (attrs['id'], self.start_latitude, self.start_longitude))
+    return output + mark_safe(render_assets('widgets'))
\ No newline at end of file